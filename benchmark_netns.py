@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Benchmark reprodutível das medições do Network Analyzer.
+
+Sobe o speedtest_server.py dentro de um network namespace ligado ao
+namespace atual por um par veth, com o enlace moldado pelo `tc netem`
+(atraso, perda e taxa em cada sentido). Para cada cenário mede download,
+upload, latência e perda com o código do analisador e verifica se os
+valores batem com o enlace configurado dentro da tolerância. Nos cenários
+de 1 e 10 Gbit/s registra o custo da medição (CPU por GB).
+
+Precisa de root (ip netns / tc):
+
+    sudo python3 benchmark_netns.py
+    sudo python3 benchmark_netns.py --scenario 100mbit-20ms --output bench.json
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from network_analyzer import NetworkPerformanceTester, ThroughputEngine
+
+NAMESPACE = 'na-bench'
+HOST_IF, NS_IF = 'na-veth0', 'na-veth1'
+HOST_IP, NS_IP = '10.200.0.1', '10.200.0.2'
+SERVER_PORT = 8080
+
+# rate_mbit: taxa em cada sentido; delay_ms: atraso em cada sentido (RTT = 2x);
+# loss_pct: perda no sentido servidor -> cliente. Com perda o TCP não atinge a
+# taxa do enlace, então esses cenários só verificam latência e perda.
+SCENARIOS = [
+    {'name': '100mbit-20ms', 'rate_mbit': 100, 'delay_ms': 10, 'loss_pct': 0},
+    {'name': '20mbit-80ms', 'rate_mbit': 20, 'delay_ms': 40, 'loss_pct': 0},
+    {'name': '50mbit-40ms-2loss', 'rate_mbit': 50, 'delay_ms': 20, 'loss_pct': 2},
+    {'name': '1gbit', 'rate_mbit': 1000, 'delay_ms': 1, 'loss_pct': 0, 'overhead': True},
+    {'name': '10gbit', 'rate_mbit': 10000, 'delay_ms': 0, 'loss_pct': 0, 'overhead': True},
+]
+
+# Tolerâncias: vazão medida / taxa do enlace, latência e perda absolutas
+THROUGHPUT_RANGE = (0.85, 1.02)
+LATENCY_TOLERANCE_MS = 1.5
+LATENCY_TOLERANCE_PCT = 10
+LOSS_TOLERANCE_PCT = 2.5
+
+
+def run(*command):
+    subprocess.run(command, check=True)
+
+
+def netns(*command):
+    run('ip', 'netns', 'exec', NAMESPACE, *command)
+
+
+def netem(rate_mbit, delay_ms, loss_pct=0):
+    """Argumentos do qdisc netem, com fila grande o bastante para o BDP."""
+    rate_bps = rate_mbit * 1e6
+    limit = max(1000, int(rate_bps * (delay_ms / 1000 + 0.05) / 8 / 1500 * 2))
+    args = ['netem', 'delay', f'{delay_ms}ms', 'rate', f'{rate_mbit}mbit', 'limit', str(limit)]
+    if loss_pct:
+        args += ['loss', f'{loss_pct}%']
+    return args
+
+
+def setup_link(scenario):
+    teardown_link()
+    run('ip', 'netns', 'add', NAMESPACE)
+    run('ip', 'link', 'add', HOST_IF, 'type', 'veth', 'peer', 'name', NS_IF)
+    run('ip', 'link', 'set', NS_IF, 'netns', NAMESPACE)
+    run('ip', 'addr', 'add', f'{HOST_IP}/24', 'dev', HOST_IF)
+    run('ip', 'link', 'set', HOST_IF, 'up')
+    netns('ip', 'addr', 'add', f'{NS_IP}/24', 'dev', NS_IF)
+    netns('ip', 'link', 'set', NS_IF, 'up')
+    netns('ip', 'link', 'set', 'lo', 'up')
+
+    # Cliente -> servidor (upload) e servidor -> cliente (download, com perda)
+    run('tc', 'qdisc', 'add', 'dev', HOST_IF, 'root',
+        *netem(scenario['rate_mbit'], scenario['delay_ms']))
+    netns('tc', 'qdisc', 'add', 'dev', NS_IF, 'root',
+          *netem(scenario['rate_mbit'], scenario['delay_ms'], scenario['loss_pct']))
+
+
+def teardown_link():
+    subprocess.run(['ip', 'netns', 'del', NAMESPACE], stderr=subprocess.DEVNULL)
+    subprocess.run(['ip', 'link', 'del', HOST_IF], stderr=subprocess.DEVNULL)
+
+
+def start_server():
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speedtest_server.py')
+    server = subprocess.Popen(
+        ['ip', 'netns', 'exec', NAMESPACE, sys.executable, server_path,
+         '--host', NS_IP, '--port', str(SERVER_PORT)],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((NS_IP, SERVER_PORT), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Speed test server did not start")
+
+
+def within(value, expected, low, high):
+    return value is not None and low * expected <= value <= high * expected
+
+
+def run_scenario(scenario, args):
+    server = None
+    try:
+        setup_link(scenario)
+        server = start_server()
+        base_url = f"http://{NS_IP}:{SERVER_PORT}"
+        tester = NetworkPerformanceTester()
+        engine = ThroughputEngine(streams=args.streams, warmup_s=args.warmup)
+        try:
+            download = engine.measure_download(f"{base_url}/__down?bytes=1000000000", args.duration)
+            upload = engine.measure_upload(f"{base_url}/__up", args.duration)
+        finally:
+            engine.close()
+        ping = tester._run_ping(NS_IP, count=args.ping_count, interval=0.02)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        teardown_link()
+
+    times = ping['times']
+    latency = sum(times) / len(times) if times else None
+    expected_rtt = 2 * scenario['delay_ms']
+    latency_tolerance = max(LATENCY_TOLERANCE_MS, expected_rtt * LATENCY_TOLERANCE_PCT / 100)
+
+    checks = {
+        'latency': latency is not None and abs(latency - expected_rtt) <= latency_tolerance,
+        'loss': ping['transmitted'] > 0 and abs(ping['packet_loss'] - scenario['loss_pct']) <= LOSS_TOLERANCE_PCT,
+    }
+    if not scenario['loss_pct'] and not scenario.get('overhead'):
+        checks['download'] = within(download['aggregate_mbps'], scenario['rate_mbit'], *THROUGHPUT_RANGE)
+        checks['upload'] = within(upload['aggregate_mbps'], scenario['rate_mbit'], *THROUGHPUT_RANGE)
+
+    return {
+        'scenario': scenario,
+        'download': download,
+        'upload': upload,
+        'latency_ms': round(latency, 3) if latency is not None else None,
+        'expected_rtt_ms': expected_rtt,
+        'packet_loss': round(ping['packet_loss'], 2),
+        'ping_backend': ping.get('backend'),
+        'checks': checks,
+        'passed': all(checks.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark das medições em enlace emulado (netns + tc netem)")
+    parser.add_argument('--scenario', action='append', help="roda só os cenários indicados")
+    parser.add_argument('--duration', type=float, default=10, help="duração de cada direção (s)")
+    parser.add_argument('--warmup', type=float, default=2, help="aquecimento descartado (s)")
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--ping-count', type=int, default=500)
+    parser.add_argument('--output', help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("requires root (ip netns / tc)")
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s['name'] in args.scenario]
+    results = []
+    for scenario in scenarios:
+        print(f"=== {scenario['name']} ===", flush=True)
+        result = run_scenario(scenario, args)
+        results.append(result)
+        print(f"  download {result['download']['aggregate_mbps']} Mbps "
+              f"({result['download']['cpu_s_per_gb']} CPU s/GB), "
+              f"upload {result['upload']['aggregate_mbps']} Mbps "
+              f"({result['upload']['cpu_s_per_gb']} CPU s/GB)")
+        print(f"  latency {result['latency_ms']} ms (expected {result['expected_rtt_ms']} ms), "
+              f"loss {result['packet_loss']}% (expected {scenario['loss_pct']}%)")
+        print(f"  {'PASS' if result['passed'] else 'FAIL'} {result['checks']}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    raise SystemExit(0 if all(r['passed'] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,182 @@
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, make_response, render_template, request
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from bson import ObjectId, json_util
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock, Thread
+import hashlib
+import hmac
 import numpy as np
 import os
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from schema import (
+    METRIC_FIELDS, RAW_RETENTION_DAYS, ROLLUP_GRANULARITIES, RttSamples, as_datetime, merge_rollups,
+    section_units, to_numeric_document
+)
+from storage import DatabaseHandler, write_isolating
 
 
 app = Flask(__name__)
 client = MongoClient('mongodb://localhost:27017/')
 db = client['network_analysis']
 collection = db['test_results']
+rollup_collections = {
+    granularity: db[f'test_results_{granularity}'] for granularity in ROLLUP_GRANULARITIES
+}
+
+# Gravação dos documentos recebidos em /api/ingest (também cria os índices)
+database = DatabaseHandler(retention_days=RAW_RETENTION_DAYS, ingest_url=None)
+
+# Alvo padrão de pontos por série em /api/history/metrics (~largura do gráfico)
+DEFAULT_MAX_POINTS = 1000
+# Seção do documento com as amostras de RTT de cada alvo de ping
+RTT_SAMPLE_SECTIONS = {
+    'internet': 'performance_results',
+    'gateway': 'gateway_ping_results',
+}
+# Até esta janela (em horas) o resumo usa os rollups por minuto
+MINUTE_ROLLUP_MAX_HOURS = 6
+# Quantos buckets por ponto final o MongoDB pré-agrega antes do LTTB
+PREAGGREGATION_FACTOR = 4
+
+# Ingestão de agentes remotos: token exigido em `Authorization: Bearer`
+# (sem token configurado, a ingestão fica desativada) e tamanho máximo do
+# lote descomprimido
+INGEST_TOKEN = os.environ.get('DASHBOARD_INGEST_TOKEN')
+INGEST_MAX_BYTES = int(os.environ.get('DASHBOARD_INGEST_MAX_BYTES', 32 * 1024 * 1024))
+INGEST_KINDS = {'results', 'trigger_decisions'}
+NDJSON_TYPES = {'application/x-ndjson', 'application/ndjson', 'application/jsonl'}
+MSGPACK_TYPES = {'application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack'}
+app.config['MAX_CONTENT_LENGTH'] = INGEST_MAX_BYTES
+
+# Intervalo mínimo entre verificações da versão dos dados, em segundos
+CACHE_VERSION_CHECK_INTERVAL = 2.0
+# Máximo de respostas guardadas no cache (as menos usadas saem primeiro)
+CACHE_MAX_ENTRIES = int(os.environ.get('DASHBOARD_CACHE_MAX_ENTRIES', 256))
+# Usa um change stream para invalidar o cache (requer MongoDB em replica set)
+CACHE_USE_CHANGE_STREAM = os.environ.get('DASHBOARD_CHANGE_STREAM', '0') == '1'
+
+class ResponseCache:
+    """
+    Cache em processo das respostas dos endpoints, chaveado por rota e pelos
+    parâmetros que cada endpoint declara. As entradas são descartadas quando
+    a versão dos dados muda (último `_id` inserido + contagem estimada),
+    verificada no máximo a cada `check_interval` segundos ou recebida de um
+    change stream, e o total é limitado a `max_entries` (LRU). Respostas
+    levam ETag, e polls com `If-None-Match` inalterado recebem 304.
+    """
+
+    def __init__(self, collection, check_interval=CACHE_VERSION_CHECK_INTERVAL, max_entries=CACHE_MAX_ENTRIES):
+        self.collection = collection
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.entries_version = None
+        self.lock = Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._watching = False
+
+    def _read_version(self):
+        latest = self.collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        latest_id = latest['_id'] if latest else None
+        return f"{latest_id}:{self.collection.estimated_document_count()}"
+
+    def version(self):
+        if self._watching and self._version is not None:
+            return self._version
+        now = time.monotonic()
+        if self._version is None or now - self._checked_at >= self.check_interval:
+            self._version = self._read_version()
+            self._checked_at = now
+        return self._version
+
+    def start_change_stream(self, max_backoff=300.0):
+        """
+        Escuta inserções em segundo plano. Se o stream cair (ou o MongoDB não
+        estiver em replica set), segue no polling e tenta de novo com backoff.
+        """
+        def listen():
+            backoff = 1.0
+            while True:
+                try:
+                    with self.collection.watch([{'$match': {'operationType': {'$in': ['insert', 'delete']}}}]) as stream:
+                        self._version = self._read_version()
+                        self._watching = True
+                        backoff = 1.0
+                        for _ in stream:
+                            self._version = self._read_version()
+                except PyMongoError as e:
+                    print(f"Change stream unavailable, polling for {backoff:.0f} s: {e}")
+                finally:
+                    self._watching = False
+                time.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+
+        Thread(target=listen, daemon=True).start()
+
+    def _get(self, key, version):
+        with self.lock:
+            if version != self.entries_version:
+                # Dados novos: nenhuma entrada antiga volta a ser válida
+                self.entries.clear()
+                self.entries_version = version
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self.lock:
+            if entry['version'] != self.entries_version:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def cached(self, *params):
+        """Decorador; só os parâmetros de `params` entram na chave do cache."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                version = self.version()
+                key = (request.path, tuple((param, request.args.get(param)) for param in params))
+                entry = self._get(key, version)
+
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    # Erros não são guardados no cache
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data()
+                    entry = {
+                        'version': version,
+                        'body': body,
+                        'mimetype': response.mimetype,
+                        'etag': hashlib.sha1(body).hexdigest(),
+                    }
+                    self._put(key, entry)
+
+                response = Response(entry['body'], mimetype=entry['mimetype'])
+                response.set_etag(entry['etag'])
+                response.headers['Cache-Control'] = 'no-cache'
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
+
+response_cache = ResponseCache(collection)
+if CACHE_USE_CHANGE_STREAM:
+    response_cache.start_change_stream()
 
 # Create templates directory
 templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
@@ -18,6 +186,62 @@ if not os.path.exists(templates_dir):
 def calculate_average(values):
     return sum(values) / len(values) if values else 0
 
+def numeric_projection():
+    """
+    Estágio $project que lê as métricas como double. Valores que não são
+    numéricos (documentos ainda não migrados) viram null.
+    """
+    projection = {"_id": 0, "timestamp": 1}
+    for metric, field in METRIC_FIELDS.items():
+        projection[metric] = {
+            "$convert": {"input": f"${field}", "to": "double", "onError": None, "onNull": None}
+        }
+    return projection
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: escolhe `threshold` índices de (x, y)
+    preservando a forma visual da série. Retorna um array de índices.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    bucket_size = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+
+        # Vértice C: média do próximo bucket
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        # Vértice B: ponto do bucket atual que forma o maior triângulo
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    selected[-1] = n - 1
+    return selected
+
+def format_timestamp(value):
+    """Timestamps em ISO 8601 (hora local) para o JavaScript interpretar corretamente."""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def format_with_unit(value, unit):
+    """Formata uma medição numérica com a sua unidade para exibição."""
+    if value is None:
+        return 'N/A'
+    if not isinstance(value, (int, float)):
+        return value
+    return f"{value} {unit}" if unit else value
+
 @app.route('/')
 def dashboard():
     return render_template('resume.html')
@@ -27,6 +251,7 @@ def area_charts():
     return render_template('graphs.html')
 
 @app.route('/api/ieee-standard', methods=['GET'])
+@response_cache.cached()
 def get_ieee_standard():
     """Get IEEE 802.11 standard information from the latest test"""
     try:
@@ -46,168 +271,129 @@ def get_ieee_standard():
 def get_ssids():
     # Busca SSIDs únicos dos últimos 7 dias
     time_threshold = datetime.now() - timedelta(days=7)
-    ssids = collection.distinct(
-        'wifi_info.SSID',
-        {'timestamp': {'$gte': time_threshold.strftime('%d/%m/%Y %H:%M:%S')}}
-    )
+    query = {'timestamp': {'$gte': time_threshold}}
+    host = request.args.get('host', 'all')
+    if host != 'all':
+        query['host'] = host
+    ssids = collection.distinct('wifi_info.SSID', query)
     return jsonify(list(filter(None, ssids)))  # Remove None/null values
 
+@app.route('/api/hosts', methods=['GET'])
+def get_hosts():
+    # Agentes com resultados nos últimos 7 dias
+    time_threshold = datetime.now() - timedelta(days=7)
+    hosts = collection.distinct('host', {'timestamp': {'$gte': time_threshold}})
+    return jsonify(sorted(filter(None, hosts)))
+
 @app.route('/api/history/metrics', methods=['GET'])
 def get_metrics_history():
     hours = int(request.args.get('hours', 24))
     ssid = request.args.get('ssid', 'all')
+    host = request.args.get('host', 'all')
+    max_points = max(3, int(request.args.get('max_points', DEFAULT_MAX_POINTS)))
     
     time_threshold = datetime.now() - timedelta(hours=hours)
     
     # Base query
     query = {
-        "timestamp": {"$gte": time_threshold.strftime('%Y-%m-%d %H:%M:%S')}
+        "timestamp": {"$gte": time_threshold}
     }
     
     # Add SSID filter if specified
     if ssid != 'all':
         query['wifi_info.SSID'] = ssid
+    if host != 'all':
+        query['host'] = host
     
-    results = list(collection.find(
-        query,
-        {"timestamp": 1, "gateway_ping_results": 1, "wifi_info": 1, "performance_results": 1, "bandwidth_results": 1}
-    ))
-
-    metrics = {
-        "timestamps": [],
-        "gateway_latency": [],
-        "wifi_signal": [],
-        "internet_latency": [],
-        "download_speed": [],
-        "upload_speed": [],
-        "gateway_packet_loss": [],
-        "internet_packet_loss": []
-    }
-
-    for result in results:
-        try:
-            # Timestamp
-            metrics["timestamps"].append(result.get("timestamp"))
-
-            # Gateway Latency
-            if result.get('gateway_ping_results') and 'Avg' in result['gateway_ping_results']:
-                gateway_latency = float(result['gateway_ping_results']['Avg'].split()[0])
-                metrics["gateway_latency"].append(gateway_latency)
-            else:
-                metrics["gateway_latency"].append(None)
-                
-            # Gateway Packet Loss
-            if result.get('gateway_ping_results') and 'Packet Loss' in result['gateway_ping_results']:
-                gateway_packet_loss = float(result['gateway_ping_results']['Packet Loss'].split()[0])
-                metrics["gateway_packet_loss"].append(gateway_packet_loss)
-            else:
-                metrics["gateway_packet_loss"].append(None)
-
-            # Internet Packet Loss
-            if result.get('performance_results') and 'Packet Loss' in result['performance_results']:
-                internet_packet_loss = float(result['performance_results']['Packet Loss'].split()[0])
-                metrics["internet_packet_loss"].append(internet_packet_loss)
-            else:
-                metrics["internet_packet_loss"].append(None)
-
-            # WiFi Signal
-            if result.get('wifi_info') and 'RSSI' in result['wifi_info']:
-                wifi_signal = float(result['wifi_info']['RSSI'].split()[0])
-                metrics["wifi_signal"].append(wifi_signal)
-            else:
-                metrics["wifi_signal"].append(None)
-
-            # Internet Latency
-            if result.get('performance_results') and 'Avg' in result['performance_results']:
-                internet_latency = float(result['performance_results']['Avg'].split()[0])
-                metrics["internet_latency"].append(internet_latency)
-            else:
-                metrics["internet_latency"].append(None)
-
-            # Download and Upload Speeds
-            if 'bandwidth_results' in result and 'bandwidth' in result['bandwidth_results']:
-                bandwidth_data = result['bandwidth_results']['bandwidth']
-                
-                # Download Speed
-                if isinstance(bandwidth_data, dict) and 'Download' in bandwidth_data:
-                    try:
-                        download_speed = float(bandwidth_data['Download'].split()[0])
-                        metrics["download_speed"].append(download_speed)
-                    except (ValueError, AttributeError):
-                        metrics["download_speed"].append(None)
-                else:
-                    metrics["download_speed"].append(None)
-
-                # Upload Speed
-                if isinstance(bandwidth_data, dict) and 'Upload' in bandwidth_data:
-                    try:
-                        upload_speed = float(bandwidth_data['Upload'].split()[0])
-                        metrics["upload_speed"].append(upload_speed)
-                    except (ValueError, AttributeError):
-                        metrics["upload_speed"].append(None)
-                else:
-                    metrics["upload_speed"].append(None)
-            else:
-                metrics["download_speed"].append(None)
-                metrics["upload_speed"].append(None)
-
-        except (ValueError, AttributeError, KeyError) as e:
-            print(f"Error processing result: {e}")
-            # Only append None to metrics that haven't been processed yet
-            if len(metrics["gateway_latency"]) < len(metrics["timestamps"]):
-                metrics["gateway_latency"].append(None)
-            if len(metrics["wifi_signal"]) < len(metrics["timestamps"]):
-                metrics["wifi_signal"].append(None)
-            if len(metrics["internet_latency"]) < len(metrics["timestamps"]):
-                metrics["internet_latency"].append(None)
-            if len(metrics["download_speed"]) < len(metrics["timestamps"]):
-                metrics["download_speed"].append(None)
-            if len(metrics["upload_speed"]) < len(metrics["timestamps"]):
-                metrics["upload_speed"].append(None)
-            if len(metrics["gateway_packet_loss"]) < len(metrics["timestamps"]):
-                metrics["gateway_packet_loss"].append(None)
-            if len(metrics["internet_packet_loss"]) < len(metrics["timestamps"]):
-                metrics["internet_packet_loss"].append(None)
+    # Projeção e conversão numérica feitas no próprio MongoDB
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"timestamp": 1}},
+        {"$project": numeric_projection()},
+    ]
+
+    # Em janelas longas, o MongoDB pré-agrega os pontos em buckets de tempo
+    # para que a transferência e o LTTB em Python tenham custo limitado
+    source_points = collection.count_documents(query)
+    preaggregate_buckets = max_points * PREAGGREGATION_FACTOR
+    if source_points > preaggregate_buckets:
+        output = {"timestamp": {"$min": "$timestamp"}}
+        output.update({metric: {"$avg": f"${metric}"} for metric in METRIC_FIELDS})
+        pipeline.append({
+            "$bucketAuto": {"groupBy": "$timestamp", "buckets": preaggregate_buckets, "output": output}
+        })
+    results = list(collection.aggregate(pipeline))
+
+    timestamps = [result.get("timestamp") for result in results]
+
+    # Cada série é reduzida com LTTB no eixo do tempo e leva os seus próprios
+    # timestamps, então nenhuma série passa de `max_points` pontos
+    metrics = {"source_points": source_points, "downsampled": False}
+    for metric in METRIC_FIELDS:
+        valid = [
+            i for i, result in enumerate(results)
+            if result.get(metric) is not None and isinstance(timestamps[i], datetime)
+        ]
+        x = np.array([timestamps[i].timestamp() for i in valid], dtype=float)
+        y = np.array([results[i][metric] for i in valid], dtype=float)
+        indices = [valid[i] for i in lttb_indices(x, y, max_points).tolist()] if valid else []
+        metrics["downsampled"] |= len(indices) < len(valid)
+        metrics[metric] = {
+            "timestamps": [format_timestamp(timestamps[i]) for i in indices],
+            "values": [results[i][metric] for i in indices],
+        }
+    metrics["downsampled"] |= len(results) < source_points
 
     return jsonify(metrics)
 
-@app.route('/report')
-def report():
-    last_result = collection.find_one({}, sort=[("timestamp", -1)])
-    if not last_result:
-        return "No data available", 404
+def dashboard_view(document):
+    """
+    Projeta o documento canônico de um ciclo no formato do relatório:
+    valores com unidade, saltos do MTR coloridos e jitter/p99 das amostras.
+    """
+    # Processar dados para o template: as medições são numéricas e as
+    # unidades vêm dos metadados do documento
+    units = document.get('units', {})
+
+    def with_units(section, values):
+        fields = section_units(units, section)
+        return {k: format_with_unit(v, fields.get(k)) for k, v in (values or {}).items()}
 
-    # Processar dados para o template
-    gateway_ping_results = last_result.get('gateway_ping_results', {})
+    gateway_ping_results = with_units('gateway_ping_results', document.get('gateway_ping_results'))
     network_info = {
-        'IP Address': last_result.get('network_info', {}).get('IP_Address', 'Unknown'),
-        'Subnet Mask': last_result.get('network_info', {}).get('Subnet_Mask', 'Unknown'),
-        'Gateway': last_result.get('network_info', {}).get('Default_Gateway', 'Unknown'),
-        'DNS Servers': last_result.get('network_info', {}).get('DNS_Servers', []),
+        'IP Address': document.get('network_info', {}).get('IP_Address', 'Unknown'),
+        'Subnet Mask': document.get('network_info', {}).get('Subnet_Mask', 'Unknown'),
+        'Gateway': document.get('network_info', {}).get('Default_Gateway', 'Unknown'),
+        'DNS Servers': document.get('network_info', {}).get('DNS_Servers', []),
         'gateway_latency_min': gateway_ping_results.get('Min', 'N/A'),
         'gateway_latency_max': gateway_ping_results.get('Max', 'N/A'),
         'gateway_latency_avg': gateway_ping_results.get('Avg', 'N/A'),
         'gateway_packet_loss': gateway_ping_results.get('Packet Loss', 'N/A'),
     }
 
-    wifi_info = last_result.get('wifi_info', {})
+    wifi_info = with_units('wifi_info', document.get('wifi_info'))
     
-    ieee_standard_info = last_result.get('ieee_standard_info', {})
+    ieee_standard_info = document.get('ieee_standard_info', {})
         
-    performance_results = last_result.get('performance_results', {})
+    # As amostras de RTT (binárias) viram jitter e p99 no relatório
+    raw_performance = dict(document.get('performance_results') or {})
+    rtt_samples = raw_performance.pop('rtt_samples', None)
+    performance_results = with_units('performance_results', raw_performance)
+    if rtt_samples:
+        distribution = RttSamples(rtt_samples).summary()
+        for label, key in (('P99', 'p99'), ('Jitter', 'jitter')):
+            if distribution[key] is not None:
+                performance_results[label] = format_with_unit(round(distribution[key], 2), 'ms')
     
-    connection_info = last_result.get('bandwidth_results', {}).get('connection_info', {})
-    {
-        'IPv4': last_result.get('IPv4', 'Unknown'),
-        'ISP': last_result.get('ISP', 'Unknown'),
-        'Primary DNS': last_result.get('Primary DNS','Unknown'),
-        'Location': last_result.get('Location', 'Unknown'),
-    }
-
-    mtr_results = last_result.get('mtr_results', [])
-    for hop in mtr_results:
-        loss_str = hop.get('Loss', '0%')
-        loss = float(loss_str.strip('%')) if '%' in loss_str else 0.0
+    connection_info = document.get('bandwidth_results', {}).get('connection_info', {})
+
+    mtr_results = []
+    for raw_hop in document.get('mtr_results', []):
+        loss = raw_hop.get('Loss')
+        loss = loss if isinstance(loss, (int, float)) else 0.0
+        hop = with_units('mtr_results', raw_hop)
+        hop['Host'] = hop.get('Host') or '???'  # salto sem resposta
+        mtr_results.append(hop)
         if loss > 20:
             hop['Color'] = '#fca5a5'  # Vermelho para perda > 20%
         elif loss > 5:
@@ -215,9 +401,38 @@ def report():
         else:
             hop['Color'] = '#86efac'  # Verde para perda <= 5%
 
-    bandwidth_data = last_result.get('bandwidth_results', {}).get('bandwidth', {})
+    bandwidth_data = with_units(
+        'bandwidth_results.bandwidth', document.get('bandwidth_results', {}).get('bandwidth')
+    )
     
-    dns_results = last_result.get('bandwidth_results', {}).get('dns_tests', {})
+    dns_results = document.get('bandwidth_results', {}).get('dns_tests', {})
+
+    # Timestamp do relatório
+    report_timestamp = document.get('timestamp')
+    if not isinstance(report_timestamp, datetime):
+        report_timestamp = datetime.now()
+
+    # Formatar a data antes de enviar para o template
+    report_timestamp = report_timestamp.strftime('%d/%m/%Y %H:%M:%S')
+
+    return {
+        'network_info': network_info,
+        'wifi_info': wifi_info,
+        'ieee_standard_info': ieee_standard_info,
+        'performance_results': performance_results,
+        'connection_info': connection_info,
+        'mtr_results': mtr_results,
+        'bandwidth_data': bandwidth_data,
+        'dns_results': dns_results,
+        'report_timestamp': report_timestamp,
+    }
+
+@app.route('/report')
+@response_cache.cached()
+def report():
+    last_result = collection.find_one({}, sort=[("timestamp", -1)])
+    if not last_result:
+        return "No data available", 404
 
     # Funções auxiliares para o template
     def format_signal_quality(rssi_str):
@@ -234,30 +449,10 @@ def report():
         else:
             return "Poor"
 
-    # Timestamp do relatório
-    report_timestamp = last_result.get('timestamp', datetime.now())
-    try:
-        report_timestamp = datetime.strptime(report_timestamp, '%d/%m/%Y %H:%M:%S')
-    except:
-        report_timestamp = datetime.now()
-
-    # Formatar a data antes de enviar para o template
-    report_timestamp = report_timestamp.strftime('%d/%m/%Y %H:%M:%S')
-
-    return render_template(
-        'report.html',
-        network_info=network_info,
-        wifi_info=wifi_info,
-        ieee_standard_info=ieee_standard_info,
-        performance_results=performance_results,
-        connection_info=connection_info,
-        mtr_results=mtr_results,
-        bandwidth_data=bandwidth_data,
-        dns_results=dns_results,
-        report_timestamp=report_timestamp
-    )
+    return render_template('report.html', **dashboard_view(last_result))
     
 @app.route('/api/wifi/detailed', methods=['GET'])
+@response_cache.cached()
 def get_detailed_wifi_info():
     """Get detailed WiFi information including IEEE standards"""
     try:
@@ -278,16 +473,50 @@ def get_detailed_wifi_info():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+def to_json_document(document):
+    """
+    Prepara um documento bruto para o jsonify: `_id` como texto e as amostras
+    binárias de RTT trocadas pelo resumo (não são serializáveis em JSON).
+    """
+    document['_id'] = str(document['_id'])
+    for section in RTT_SAMPLE_SECTIONS.values():
+        results = document.get(section)
+        if results and results.get('rtt_samples'):
+            results['rtt_samples'] = RttSamples(results['rtt_samples']).summary()
+    return document
+
 @app.route('/api/report/last', methods=['GET'])
+@response_cache.cached()
 def get_last_report():
     last_result = collection.find_one({}, sort=[("timestamp", -1)])
-    return jsonify(last_result)
+    return jsonify(to_json_document(last_result) if last_result else None)
+
+@app.route('/api/latency/distribution', methods=['GET'])
+@response_cache.cached('target', 'bins')
+def get_latency_distribution():
+    """Distribuição por pacote (percentis, jitter, histograma) do último teste de ping"""
+    target = request.args.get('target', 'internet')
+    bins = int(request.args.get('bins', 20))
+    section = RTT_SAMPLE_SECTIONS.get(target)
+    if not section:
+        return jsonify({"error": f"Unknown target: {target}"}), 400
+
+    last_result = collection.find_one(
+        {f"{section}.rtt_samples": {"$exists": True}},
+        {"timestamp": 1, f"{section}.rtt_samples": 1},
+        sort=[("timestamp", -1)]
+    )
+    if not last_result:
+        return jsonify({"error": "No data available"}), 404
 
-def calculate_percentile(values):
-    """Calculate the 95 percentile of a list of values"""
-    if not values:
-        return None
-    return float(np.percentile(values, 95))
+    samples = RttSamples(last_result[section]['rtt_samples'])
+    return jsonify({
+        "target": target,
+        "timestamp": format_timestamp(last_result.get('timestamp')),
+        **samples.summary(),
+        "histogram": samples.histogram(bins),
+        "loss_burst_lengths": samples.loss_bursts(),
+    })
 
 def generate_insights(data):
     """Gera insights baseados nos dados de métricas da rede."""
@@ -388,167 +617,229 @@ def generate_insights(data):
     return insights
 
 @app.route('/api/summary', methods=['GET'])
+@response_cache.cached('hours', 'ssid', 'host')
 def get_summary():
-    time_threshold = datetime.now() - timedelta(hours=24)
-    results = list(collection.find({"timestamp": {"$gte": time_threshold.strftime('%Y-%m-%d %H:%M:%S')}}))
+    hours = float(request.args.get('hours', 24))
+    ssid = request.args.get('ssid', 'all')
+    host = request.args.get('host', 'all')
+
+    # Lê apenas rollups (algumas dezenas/centenas de documentos pequenos),
+    # independente do tamanho do histórico bruto: janelas curtas usam os
+    # rollups por minuto, as demais os rollups por hora
+    granularity = 'minute' if hours <= MINUTE_ROLLUP_MAX_HOURS else 'hour'
+    time_threshold = datetime.now() - timedelta(hours=hours)
+    query = {"bucket": {"$gte": ROLLUP_GRANULARITIES[granularity](time_threshold)}}
+    if ssid != 'all':
+        query['ssid'] = ssid
+    if host != 'all':
+        query['host'] = host
+    rollups = list(rollup_collections[granularity].find(query, {"applied": 0}, sort=[("bucket", 1)]))
     
-    if not results:
+    if not rollups:
         return jsonify({"error": "No data available"})
 
-    # Initialize metric lists
-    gateway_latencies = []
-    gateway_packet_losses = []
-    rssi_values = []
-    internet_latencies = []
-    internet_packet_losses = []
-    download_speeds = []
-    upload_speeds = []
-
-    # Process results
-    for result in results:
-        try:
-            # Gateway Metrics
-            gateway_results = result.get('gateway_ping_results', {})
-            if gateway_results:
-                try:
-                    if 'Avg' in gateway_results:
-                        avg_value = gateway_results['Avg']
-                        if isinstance(avg_value, str):
-                            gateway_latencies.append(float(avg_value.split()[0]))
-                        elif isinstance(avg_value, (int, float)):
-                            gateway_latencies.append(float(avg_value))
-                            
-                    if 'Packet Loss' in gateway_results:
-                        loss_value = gateway_results['Packet Loss']
-                        if isinstance(loss_value, str):
-                            # Remove '%' if present and convert to float
-                            loss_value = loss_value.replace('%', '').strip()
-                            gateway_packet_losses.append(float(loss_value))
-                        elif isinstance(loss_value, (int, float)):
-                            gateway_packet_losses.append(float(loss_value))
-                except (ValueError, IndexError) as e:
-                    print(f"Error processing gateway metrics: {e}")
-            
-            # RSSI Values
-            wifi_info = result.get('wifi_info', {})
-            if wifi_info and 'RSSI' in wifi_info:
-                try:
-                    rssi_value = wifi_info['RSSI']
-                    if isinstance(rssi_value, str):
-                        rssi_values.append(float(rssi_value.split()[0]))
-                    elif isinstance(rssi_value, (int, float)):
-                        rssi_values.append(float(rssi_value))
-                except (ValueError, IndexError):
-                    pass
-
-            # Internet Metrics
-            performance_results = result.get('performance_results', {})
-            if performance_results:
-                try:
-                    if 'Avg' in performance_results:
-                        avg_value = performance_results['Avg']
-                        if isinstance(avg_value, str):
-                            internet_latencies.append(float(avg_value.split()[0]))
-                        elif isinstance(avg_value, (int, float)):
-                            internet_latencies.append(float(avg_value))
-                            
-                    if 'Packet Loss' in performance_results:
-                        loss_value = performance_results['Packet Loss']
-                        if isinstance(loss_value, str):
-                            # Remove '%' if present and convert to float
-                            loss_value = loss_value.replace('%', '').strip()
-                            internet_packet_losses.append(float(loss_value))
-                        elif isinstance(loss_value, (int, float)):
-                            internet_packet_losses.append(float(loss_value))
-                except (ValueError, IndexError) as e:
-                    print(f"Error processing internet metrics: {e}")
-
-            # Bandwidth Metrics
-            bandwidth_results = result.get('bandwidth_results', {}).get('bandwidth', {})
-            if isinstance(bandwidth_results, dict):
-                if 'Download' in bandwidth_results:
-                    try:
-                        download_value = bandwidth_results['Download']
-                        if isinstance(download_value, str):
-                            download_speeds.append(float(download_value.split()[0]))
-                        elif isinstance(download_value, (int, float)):
-                            download_speeds.append(float(download_value))
-                    except (ValueError, IndexError):
-                        pass
-                        
-                if 'Upload' in bandwidth_results:
-                    try:
-                        upload_value = bandwidth_results['Upload']
-                        if isinstance(upload_value, str):
-                            upload_speeds.append(float(upload_value.split()[0]))
-                        elif isinstance(upload_value, (int, float)):
-                            upload_speeds.append(float(upload_value))
-                    except (ValueError, IndexError):
-                        pass
-
-        except Exception as e:
-            print(f"Error processing result: {e}")
-            continue
+    # Os percentis vêm da fusão dos sketches de cada intervalo
+    stats = merge_rollups(rollups)
+
+    def metric_stats(metric):
+        values = stats.get(metric)
+        if not values or not values["count"]:
+            return {key: None for key in ("current", "p50", "p95", "p99", "mean", "min", "max")}
+        # O erro relativo do sketch pode ultrapassar os extremos exatos
+        def quantile(q):
+            return min(max(values["sketch"].quantile(q), values["min"]), values["max"])
+
+        return {
+            "current": values["current"],
+            "p50": quantile(0.50),
+            "p95": quantile(0.95),
+            "p99": quantile(0.99),
+            "mean": values["sum"] / values["count"],
+            "min": values["min"],
+            "max": values["max"],
+        }
 
     # Prepare summary response with 95th percentile
     summary = {
         "local_network": {
-            "gateway_latency": {
-                "current": gateway_latencies[-1] if gateway_latencies else None,
-                "p95": calculate_percentile(gateway_latencies),  # Key changed to "p95"
-                "min": min(gateway_latencies) if gateway_latencies else None,
-                "max": max(gateway_latencies) if gateway_latencies else None
-            },
-            "gateway_packet_loss": {
-                "current": gateway_packet_losses[-1] if gateway_packet_losses else None,
-                "p95": calculate_percentile(gateway_packet_losses)  # Key changed to "p95"
-            },
-            "rssi": {
-                "current": rssi_values[-1] if rssi_values else None,
-                "p95": calculate_percentile(rssi_values)  # Key changed to "p95"
-            }
+            "gateway_latency": metric_stats("gateway_latency"),
+            "gateway_packet_loss": metric_stats("gateway_packet_loss"),
+            "rssi": metric_stats("wifi_signal")
         },
         "internet": {
-            "latency": {
-                "current": internet_latencies[-1] if internet_latencies else None,
-                "p95": calculate_percentile(internet_latencies),  # Key changed to "p95"
-                "min": min(internet_latencies) if internet_latencies else None,
-                "max": max(internet_latencies) if internet_latencies else None
-            },
-            "packet_loss": {
-                "current": internet_packet_losses[-1] if internet_packet_losses else None,
-                "p95": calculate_percentile(internet_packet_losses)  # Key changed to "p95"
-            },
+            "latency": metric_stats("internet_latency"),
+            "packet_loss": metric_stats("internet_packet_loss"),
             "speed": {
-                "download": {
-                    "current": download_speeds[-1] if download_speeds else None,
-                    "p95": calculate_percentile(download_speeds)  # Key changed to "p95"
-                },
-                "upload": {
-                    "current": upload_speeds[-1] if upload_speeds else None,
-                    "p95": calculate_percentile(upload_speeds)  # Key changed to "p95"
-                }
+                "download": metric_stats("download_speed"),
+                "upload": metric_stats("upload_speed")
             }
         },
+        "window": {"hours": hours, "ssid": ssid, "host": host, "granularity": granularity},
     }
     
-    last_result = collection.find_one({}, sort=[("timestamp", -1)])
-    summary['ieee_standard_info'] = last_result.get('ieee_standard_info', {})
+    last_result = collection.find_one(
+        {} if host == 'all' else {"host": host}, {"ieee_standard_info": 1}, sort=[("timestamp", -1)]
+    )
+    summary['ieee_standard_info'] = last_result.get('ieee_standard_info', {}) if last_result else {}
 
 
     summary['insights'] = generate_insights(summary)
     
     return jsonify(summary)
 
+def read_ingest_body():
+    """
+    Corpo de /api/ingest descomprimido, ou None se passar de INGEST_MAX_BYTES.
+    Um corpo gzip pode ter vários membros concatenados; fluxo truncado ou
+    dados depois do fluxo deflate levantam zlib.error.
+    """
+    data = request.get_data(cache=False)
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding == 'identity':
+        return data
+    members = []
+    remaining = INGEST_MAX_BYTES
+    while data:
+        if remaining <= 0:
+            return None
+        # gzip (wbits=31) ou zlib/deflate (wbits=15), limitando o tamanho de saída
+        decompressor = zlib.decompressobj(wbits=31 if encoding == 'gzip' else 15)
+        member = decompressor.decompress(data, remaining)
+        if decompressor.unconsumed_tail or not decompressor.eof and len(member) >= remaining:
+            return None
+        if not decompressor.eof:
+            raise zlib.error("truncated compressed stream")
+        members.append(member)
+        remaining -= len(member)
+        data = decompressor.unused_data
+        if data and encoding != 'gzip':
+            raise zlib.error("trailing data after the deflate stream")
+    return b''.join(members)
+
+def decode_ingest_records(data, content_type):
+    """Registros do lote e os erros de decodificação (linha a linha no NDJSON)."""
+    records, errors = [], []
+    if content_type in NDJSON_TYPES:
+        for number, line in enumerate(data.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json_util.loads(line))
+            except ValueError as e:
+                errors.append(f"line {number}: {e}")
+    else:
+        # Fluxo de objetos MessagePack, ou um array de objetos
+        unpacker = msgpack.Unpacker(raw=False, timestamp=3, max_buffer_size=max(len(data), 1))
+        unpacker.feed(data)
+        try:
+            for item in unpacker:
+                records.extend(item if isinstance(item, list) else [item])
+        except (ValueError, msgpack.UnpackException) as e:
+            errors.append(f"record {len(records) + 1}: {e}")
+    return records, errors
+
+def prepare_ingest_record(record, agent_id, kind):
+    """Normaliza um registro recebido para o formato gravado pelo analisador."""
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+
+    # _id do agente (ObjectId, 24 hex ou 12 bytes) torna o reenvio idempotente
+    record_id = record.get('_id')
+    if record_id is None:
+        record['_id'] = ObjectId()
+    elif isinstance(record_id, (str, bytes)) and ObjectId.is_valid(record_id):
+        record['_id'] = ObjectId(record_id)
+    elif not isinstance(record_id, ObjectId):
+        raise ValueError("invalid _id")
+
+    host = agent_id or record.get('host')
+    if not host:
+        raise ValueError("missing agent id")
+    record['host'] = host
+
+    # Os timestamps do analisador são locais e sem fuso
+    timestamp = record.get('timestamp')
+    if isinstance(timestamp, str):
+        timestamp = as_datetime(timestamp) or datetime.fromisoformat(timestamp)
+    if not isinstance(timestamp, datetime):
+        raise ValueError("missing timestamp")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    record['timestamp'] = timestamp
+
+    if kind == 'results':
+        to_numeric_document(record)
+    return record
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest():
+    """
+    Recebe lotes de registros de agentes remotos (HttpReporter do analisador)
+    em NDJSON/Extended JSON ou MessagePack, opcionalmente com gzip/deflate.
+    O agente é identificado por `X-Agent-Id` (ou pelo `host` de cada
+    registro). Resultados passam pelos rollups e vão para `test_results` em
+    insert_many não ordenado; `?kind=trigger_decisions` grava decisões do
+    gatilho. Registros inválidos são recusados individualmente.
+    """
+    if not INGEST_TOKEN:
+        return jsonify({"error": "Ingest is disabled: set DASHBOARD_INGEST_TOKEN on the collector"}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {INGEST_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    kind = request.args.get('kind', 'results')
+    if kind not in INGEST_KINDS:
+        return jsonify({"error": f"Unknown kind: {kind}"}), 400
+    if request.headers.get('Content-Encoding', 'identity').lower() not in ('identity', 'gzip', 'deflate'):
+        return jsonify({"error": "Unsupported Content-Encoding"}), 415
+    if request.mimetype in MSGPACK_TYPES and msgpack is None:
+        return jsonify({"error": "MessagePack support requires the msgpack package"}), 415
+    if request.mimetype not in NDJSON_TYPES | MSGPACK_TYPES:
+        return jsonify({"error": "Expected application/x-ndjson or application/msgpack"}), 415
+
+    try:
+        data = read_ingest_body()
+    except zlib.error as e:
+        return jsonify({"error": f"Invalid compressed body: {e}"}), 400
+    if data is None:
+        return jsonify({"error": "Batch too large"}), 413
+
+    records, errors = decode_ingest_records(data, request.mimetype)
+    received = len(records) + len(errors)
+    agent_id = request.headers.get('X-Agent-Id')
+    accepted = []
+    for index, record in enumerate(records):
+        try:
+            accepted.append(prepare_ingest_record(record, agent_id, kind))
+        except (TypeError, ValueError) as e:
+            errors.append(f"record {index + 1}: {e}")
+
+    if received and not accepted:
+        return jsonify({"error": "No valid records", "errors": errors[:20]}), 400
+
+    write = database.write_results if kind == 'results' else database.write_decisions
+    try:
+        # Documentos recusados pelo MongoDB (ex.: inválidos) não são repetidos
+        rejected = write_isolating(write, accepted) if accepted else []
+    except Exception as e:
+        # Erro transitório: 503 faz o agente repetir o lote; os _id evitam duplicatas
+        return jsonify({"error": f"Database unavailable: {e}"}), 503
+    errors.extend(rejected)
+    return jsonify({
+        "received": received,
+        "accepted": len(accepted) - len(rejected),
+        "rejected": len(errors),
+        "errors": errors[:20],
+    })
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
     time_threshold = datetime.now() - timedelta(hours=24)
     results = list(collection.find(
-        {"timestamp": {"$gte": time_threshold.strftime('%Y-%m-%d %H:%M:%S')}},
+        {"timestamp": {"$gte": time_threshold}},
         {"timestamp": 1, "performance_results": 1, "gateway_ping_results": 1}
     ))
     
-    return jsonify(results)
+    return jsonify([to_json_document(result) for result in results])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
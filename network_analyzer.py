@@ -1,42 +1,57 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import atexit
+import http.client
+import json
+import math
 import subprocess
 import re
 import os
 import platform
+import random
+import select
+import signal
+import socket
 import statistics
+import struct
+import numpy as np
 import requests
 from datetime import datetime
-from typing import Dict, Any
-from pymongo import MongoClient
-from threading import Thread
+from urllib.parse import urlparse
+from typing import Dict, Any, Callable, Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Event, Lock, Thread
 import time
 
-class DatabaseHandler:
-    def __init__(self, db_name="network_analysis", collection_name="test_results"):
-        self.client = MongoClient("mongodb://localhost:27017/")
-        self.db = self.client[db_name]
-        self.collection = self.db[collection_name]
+from schema import pack_rtt_samples
+from storage import DatabaseHandler
 
-    def save_results(self, data: Dict[str, Any]):
-        try:
-            self.collection.insert_one(data)
-            print("Results saved to MongoDB.")
-        except Exception as e:
-            print(f"Error saving to database: {e}")
+# Alvos WAN sondados a cada ciclo, além do gateway e dos servidores DNS
+WAN_TARGETS = [
+    target.strip()
+    for target in os.environ.get('NETWORK_ANALYZER_WAN_TARGETS', '8.8.8.8,1.1.1.1').split(',')
+    if target.strip()
+]
 
-    def get_last_test_latency(self):
-            try:
-                last_result = self.collection.find_one(
-                    {}, sort=[("timestamp", -1)]
-                )  # Obter o último teste
-                if last_result and "performance_results" in last_result:
-                    avg_latency = last_result["performance_results"].get("Avg")
-                    if avg_latency:
-                        return float(avg_latency.split()[0])  # Extrair o valor numérico
-                return None
-            except Exception as e:
-                print(f"Error retrieving last test latency: {e}")
-                return None
+# Taxa máxima de sondas por alvo (pacotes/s), no formato "alvo=pps,alvo=pps"
+TARGET_RATE_LIMITS = {
+    target.strip(): float(rate)
+    for target, _, rate in (
+        item.partition('=') for item in os.environ.get('NETWORK_ANALYZER_TARGET_RATES', '').split(',')
+    )
+    if target.strip() and rate
+}
+
+# Sensibilidade (limiar do CUSUM, em desvios) por métrica do gatilho de
+# mudança de regime, no formato "metrica=limiar,metrica=limiar"
+CHANGE_THRESHOLDS = {
+    metric.strip(): float(threshold)
+    for metric, _, threshold in (
+        item.partition('=') for item in os.environ.get('NETWORK_ANALYZER_CHANGE_THRESHOLDS', '').split(',')
+    )
+    if metric.strip() and threshold
+}
 
 class NetworkAnalyzer:
     def __init__(self):
@@ -52,14 +67,100 @@ class NetworkAnalyzer:
             print(f"Error executing command: {str(e)}")
             return None
 
+    # ioctls de sockets.h para endereço e máscara IPv4 de uma interface
+    SIOCGIFADDR = 0x8915
+    SIOCGIFNETMASK = 0x891b
+    RTF_UP = 0x0001
+    RTF_GATEWAY = 0x0002
+
     def get_linux_info(self):
-        network_info = {
+        """
+        Informações de rede da interface sem fio. Lê /proc e /sys e usa
+        ioctls, sem criar processos; se a leitura nativa falhar, usa os
+        comandos iwconfig/ip.
+        """
+        try:
+            return self.get_linux_info_native()
+        except OSError as e:
+            print(f"Native network info unavailable ({e}), falling back to shell commands")
+            return self.get_linux_info_shell()
+
+    @staticmethod
+    def _new_network_info():
+        return {
             'IP_Address': None,
             'Subnet_Mask': None,
             'Default_Gateway': None,
             'DNS_Servers': [],
         }
 
+    @staticmethod
+    def wireless_interfaces():
+        """Interfaces sem fio, pela ordem de /proc/net/dev (a mesma do iwconfig)."""
+        with open('/proc/net/dev') as f:
+            interfaces = [line.split(':')[0].strip() for line in f.readlines()[2:]]
+        return [
+            name for name in interfaces
+            if os.path.isdir(f'/sys/class/net/{name}/wireless')
+            or os.path.isdir(f'/sys/class/net/{name}/phy80211')
+        ]
+
+    def _interface_ioctl(self, interface, request):
+        """Executa um ioctl SIOCGIF* e retorna o endereço IPv4, ou None."""
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            ifreq = struct.pack('256s', interface.encode()[:15])
+            try:
+                result = fcntl.ioctl(sock.fileno(), request, ifreq)
+            except OSError:
+                return None  # ex.: interface sem endereço IPv4
+        return socket.inet_ntoa(result[20:24])
+
+    def _default_gateway(self):
+        """Gateway da rota padrão de menor métrica em /proc/net/route."""
+        best = None
+        with open('/proc/net/route') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) < 7 or fields[1] != '00000000':
+                    continue
+                flags = int(fields[3], 16)
+                if not (flags & self.RTF_UP and flags & self.RTF_GATEWAY):
+                    continue
+                metric = int(fields[6])
+                if best is None or metric < best[0]:
+                    best = (metric, socket.inet_ntoa(struct.pack('<L', int(fields[2], 16))))
+        return best[1] if best else None
+
+    @staticmethod
+    def _dns_servers():
+        servers = []
+        if os.path.exists('/etc/resolv.conf'):
+            with open('/etc/resolv.conf', 'r') as f:
+                for line in f:
+                    if line.startswith('nameserver'):
+                        servers.append(line.split()[1].strip())
+        return servers
+
+    def get_linux_info_native(self):
+        network_info = self._new_network_info()
+
+        interfaces = self.wireless_interfaces()
+        if not interfaces:
+            print("No wireless interface found")
+            return None
+        interface = interfaces[0]
+
+        network_info['IP_Address'] = self._interface_ioctl(interface, self.SIOCGIFADDR)
+        if network_info['IP_Address']:
+            network_info['Subnet_Mask'] = self._interface_ioctl(interface, self.SIOCGIFNETMASK)
+        network_info['Default_Gateway'] = self._default_gateway()
+        network_info['DNS_Servers'] = self._dns_servers()
+        return network_info
+
+    def get_linux_info_shell(self):
+        network_info = self._new_network_info()
+
         iw_output = self.run_command("iwconfig 2>/dev/null | grep -o '^[[:alnum:]]*'")
         if not iw_output:
             print("No wireless interface found")
@@ -80,11 +181,7 @@ class NetworkAnalyzer:
             if gateway_match:
                 network_info['Default_Gateway'] = gateway_match.group(1)
 
-        if os.path.exists('/etc/resolv.conf'):
-            with open('/etc/resolv.conf', 'r') as f:
-                for line in f:
-                    if line.startswith('nameserver'):
-                        network_info['DNS_Servers'].append(line.split()[1].strip())
+        network_info['DNS_Servers'] = self._dns_servers()
         return network_info
 
     def cidr_to_netmask(self, cidr):
@@ -99,8 +196,578 @@ class NetworkAnalyzer:
             print(f"Unsupported operating system: {self.os_type}")
             return None
 
+class Nl80211Client:
+    """
+    Cliente mínimo de generic netlink para consultar o nl80211 (o mesmo
+    canal usado pelo `iw`) direto do kernel, sem criar processos: interface,
+    SSID, frequência e largura do canal, e os dados da estação (AP) do
+    enlace: sinal e taxas de TX/RX com os flags HT/VHT/HE/EHT da taxa atual.
+    """
+
+    NETLINK_GENERIC = 16
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_ACK = 0x4
+    NLM_F_DUMP = 0x300
+    NLA_TYPE_MASK = 0x3FFF
+
+    GENL_ID_CTRL = 0x10
+    CTRL_CMD_GETFAMILY = 3
+    CTRL_ATTR_FAMILY_ID = 1
+    CTRL_ATTR_FAMILY_NAME = 2
+
+    # nl80211.h
+    CMD_GET_WIPHY = 1
+    CMD_GET_INTERFACE = 5
+    CMD_GET_STATION = 17
+    ATTR_WIPHY = 1
+    ATTR_IFINDEX = 3
+    ATTR_IFNAME = 4
+    ATTR_IFTYPE = 5
+    ATTR_MAC = 6
+    ATTR_STA_INFO = 21
+    ATTR_WIPHY_BANDS = 22
+    ATTR_WIPHY_FREQ = 38
+    ATTR_SSID = 52
+    ATTR_CHANNEL_WIDTH = 159
+    ATTR_SPLIT_WIPHY_DUMP = 174
+    IFTYPE_STATION = 2
+    STA_INFO_SIGNAL = 7
+    STA_INFO_TX_BITRATE = 8
+    STA_INFO_SIGNAL_AVG = 13
+    STA_INFO_RX_BITRATE = 14
+
+    # nl80211_rate_info
+    RATE_BITRATE = 1
+    RATE_MCS = 2
+    RATE_40_MHZ = 3
+    RATE_SHORT_GI = 4
+    RATE_BITRATE32 = 5
+    RATE_VHT_MCS = 6
+    RATE_VHT_NSS = 7
+    RATE_80_MHZ = 8
+    RATE_80P80_MHZ = 9
+    RATE_160_MHZ = 10
+    RATE_10_MHZ = 11
+    RATE_5_MHZ = 12
+    RATE_HE_MCS = 13
+    RATE_HE_NSS = 14
+    RATE_320_MHZ = 18
+    RATE_EHT_MCS = 19
+    RATE_EHT_NSS = 20
+
+    # nl80211_band_attr, nl80211_frequency_attr e nl80211_band_iftype_attr
+    BAND_ATTR_FREQS = 1
+    BAND_ATTR_HT_MCS_SET = 3
+    BAND_ATTR_HT_CAPA = 4
+    BAND_ATTR_VHT_MCS_SET = 7
+    BAND_ATTR_VHT_CAPA = 8
+    BAND_ATTR_IFTYPE_DATA = 9
+    FREQUENCY_ATTR_FREQ = 1
+    FREQUENCY_ATTR_DISABLED = 2
+    BAND_IFTYPE_ATTR_IFTYPES = 1
+    BAND_IFTYPE_ATTR_HE_CAP_PHY = 3
+    BAND_IFTYPE_ATTR_HE_CAP_MCS_SET = 4
+    BAND_IFTYPE_ATTR_EHT_CAP_PHY = 9
+
+    # nl80211_band -> nome da banda
+    BANDS = {0: "2.4 GHz", 1: "5 GHz", 2: "60 GHz", 3: "6 GHz"}
+
+    # nl80211_chan_width -> MHz
+    CHANNEL_WIDTHS = {0: 20, 1: 20, 2: 40, 3: 80, 4: 160, 5: 160, 6: 5, 7: 10, 13: 320}
+
+    def __init__(self, timeout=1.0):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_GENERIC)
+        self.sock.settimeout(timeout)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        self.family_id = self.resolve_family('nl80211')
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def attr(attr_type, payload: bytes) -> bytes:
+        length = 4 + len(payload)
+        return struct.pack('=HH', length, attr_type) + payload + b'\x00' * (-length % 4)
+
+    @classmethod
+    def parse_attrs(cls, data: bytes) -> Dict[int, bytes]:
+        attrs = {}
+        offset = 0
+        while offset + 4 <= len(data):
+            length, attr_type = struct.unpack_from('=HH', data, offset)
+            if length < 4:
+                break
+            attrs[attr_type & cls.NLA_TYPE_MASK] = data[offset + 4:offset + length]
+            offset += (length + 3) & ~3
+        return attrs
+
+    def request(self, family, cmd, attrs=b'', dump=False):
+        """Envia um comando genl e retorna os atributos de cada resposta."""
+        self.seq += 1
+        flags = self.NLM_F_REQUEST | (self.NLM_F_DUMP if dump else self.NLM_F_ACK)
+        payload = struct.pack('=BBH', cmd, 1, 0) + attrs
+        self.sock.send(struct.pack('=IHHII', 16 + len(payload), family, flags, self.seq, 0) + payload)
+
+        messages = []
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msg_type, _, seq, _ = struct.unpack_from('=IHHII', data, offset)
+                if seq == self.seq:
+                    if msg_type == self.NLMSG_ERROR:
+                        error = struct.unpack_from('=i', data, offset + 16)[0]
+                        if error:
+                            raise OSError(-error, os.strerror(-error))
+                        return messages
+                    if msg_type == self.NLMSG_DONE:
+                        return messages
+                    # Pula o cabeçalho netlink (16) e o genl (4)
+                    messages.append(self.parse_attrs(data[offset + 20:offset + length]))
+                offset += (length + 3) & ~3
+
+    def resolve_family(self, name):
+        replies = self.request(
+            self.GENL_ID_CTRL, self.CTRL_CMD_GETFAMILY,
+            self.attr(self.CTRL_ATTR_FAMILY_NAME, name.encode() + b'\x00'),
+        )
+        for attrs in replies:
+            if self.CTRL_ATTR_FAMILY_ID in attrs:
+                return struct.unpack('=H', attrs[self.CTRL_ATTR_FAMILY_ID][:2])[0]
+        raise OSError(f"Generic netlink family {name} not found")
+
+    @staticmethod
+    def _u32(value):
+        return struct.unpack('=I', value[:4])[0] if value else None
+
+    @staticmethod
+    def _mac(value):
+        return ':'.join(f'{b:02x}' for b in value) if value else None
+
+    @classmethod
+    def parse_rate_info(cls, data):
+        """Decodifica um nl80211_rate_info: taxa em Mbps, MCS/NSS e largura."""
+        attrs = cls.parse_attrs(data)
+        rate = {}
+        if cls.RATE_BITRATE32 in attrs:
+            rate['bitrate_mbps'] = cls._u32(attrs[cls.RATE_BITRATE32]) / 10
+        elif cls.RATE_BITRATE in attrs:
+            rate['bitrate_mbps'] = struct.unpack('=H', attrs[cls.RATE_BITRATE][:2])[0] / 10
+
+        for name, key in (('ht_mcs', cls.RATE_MCS), ('vht_mcs', cls.RATE_VHT_MCS), ('vht_nss', cls.RATE_VHT_NSS),
+                          ('he_mcs', cls.RATE_HE_MCS), ('he_nss', cls.RATE_HE_NSS),
+                          ('eht_mcs', cls.RATE_EHT_MCS), ('eht_nss', cls.RATE_EHT_NSS)):
+            if key in attrs:
+                rate[name] = attrs[key][0]
+
+        rate['width_mhz'] = 20
+        for width, key in ((320, cls.RATE_320_MHZ), (160, cls.RATE_160_MHZ), (160, cls.RATE_80P80_MHZ),
+                           (80, cls.RATE_80_MHZ), (40, cls.RATE_40_MHZ), (10, cls.RATE_10_MHZ), (5, cls.RATE_5_MHZ)):
+            if key in attrs:
+                rate['width_mhz'] = width
+                break
+        rate['short_gi'] = cls.RATE_SHORT_GI in attrs
+        return rate
+
+    def link_info(self, interface=None):
+        """
+        Estado do enlace da primeira interface em modo estação (ou de
+        `interface`). Retorna {'interface': None} se não houver interface.
+        """
+        link = {'interface': None, 'connected': False}
+        for attrs in self.request(self.family_id, self.CMD_GET_INTERFACE, dump=True):
+            name = attrs.get(self.ATTR_IFNAME, b'').rstrip(b'\x00').decode(errors='replace')
+            if interface and name != interface:
+                continue
+            if not interface and self._u32(attrs.get(self.ATTR_IFTYPE)) != self.IFTYPE_STATION:
+                continue
+            link.update({
+                'interface': name,
+                'ifindex': self._u32(attrs.get(self.ATTR_IFINDEX)),
+                'wiphy': self._u32(attrs.get(self.ATTR_WIPHY)),
+                'mac': self._mac(attrs.get(self.ATTR_MAC)),
+                'ssid': attrs[self.ATTR_SSID].decode(errors='replace') if self.ATTR_SSID in attrs else None,
+                'frequency_mhz': self._u32(attrs.get(self.ATTR_WIPHY_FREQ)),
+                'channel_width_mhz': self.CHANNEL_WIDTHS.get(self._u32(attrs.get(self.ATTR_CHANNEL_WIDTH))),
+            })
+            break
+        if link['interface'] is None:
+            return link
+
+        station = self.station_info(link['ifindex'])
+        link.update(station)
+        link['connected'] = bool(station)
+        return link
+
+    def station_info(self, ifindex):
+        """
+        Dados da estação (o AP, em modo estação) da interface `ifindex`:
+        BSSID, sinal e taxas de TX/RX. Vazio se não houver conexão.
+        """
+        stations = self.request(
+            self.family_id, self.CMD_GET_STATION,
+            self.attr(self.ATTR_IFINDEX, struct.pack('=I', ifindex)), dump=True,
+        )
+        station = {}
+        for attrs in stations:
+            sta_info = self.parse_attrs(attrs.get(self.ATTR_STA_INFO, b''))
+            station['bssid'] = self._mac(attrs.get(self.ATTR_MAC))
+            if self.STA_INFO_SIGNAL in sta_info:
+                station['signal_dbm'] = struct.unpack('=b', sta_info[self.STA_INFO_SIGNAL][:1])[0]
+            if self.STA_INFO_SIGNAL_AVG in sta_info:
+                station['signal_avg_dbm'] = struct.unpack('=b', sta_info[self.STA_INFO_SIGNAL_AVG][:1])[0]
+            if self.STA_INFO_TX_BITRATE in sta_info:
+                station['tx_rate'] = self.parse_rate_info(sta_info[self.STA_INFO_TX_BITRATE])
+            if self.STA_INFO_RX_BITRATE in sta_info:
+                station['rx_rate'] = self.parse_rate_info(sta_info[self.STA_INFO_RX_BITRATE])
+            break
+        return station
+
+    @staticmethod
+    def _mcs_map_streams(mcs_map):
+        """Streams suportados num mapa MCS VHT/HE (2 bits por stream, 3 = não suportado)."""
+        return sum(1 for i in range(8) if (mcs_map >> (2 * i)) & 3 != 3)
+
+    @classmethod
+    def parse_band(cls, attrs):
+        """Resume as capacidades de uma banda de um wiphy (formato de summarize_capabilities)."""
+        band = {'ht': False, 'vht': False, 'he': False, 'eht': False,
+                'channel_widths': {20}, 'spatial_streams': 1, 'channels': 0}
+
+        for freq in cls.parse_attrs(attrs.get(cls.BAND_ATTR_FREQS, b'')).values():
+            if cls.FREQUENCY_ATTR_DISABLED not in cls.parse_attrs(freq):
+                band['channels'] += 1
+
+        if cls.BAND_ATTR_HT_CAPA in attrs:
+            band['ht'] = True
+            if struct.unpack('=H', attrs[cls.BAND_ATTR_HT_CAPA][:2])[0] & 0x0002:
+                band['channel_widths'].add(40)
+            rx_mask = attrs.get(cls.BAND_ATTR_HT_MCS_SET, b'')[:4]
+            band['spatial_streams'] = max(band['spatial_streams'], sum(1 for b in rx_mask if b))
+
+        if cls.BAND_ATTR_VHT_CAPA in attrs:
+            band['vht'] = True
+            band['channel_widths'].add(80)
+            if (cls._u32(attrs[cls.BAND_ATTR_VHT_CAPA]) >> 2) & 3 in (1, 2):
+                band['channel_widths'].add(160)
+            if len(attrs.get(cls.BAND_ATTR_VHT_MCS_SET, b'')) >= 2:
+                rx_map = struct.unpack('<H', attrs[cls.BAND_ATTR_VHT_MCS_SET][:2])[0]
+                band['spatial_streams'] = max(band['spatial_streams'], cls._mcs_map_streams(rx_map))
+
+        # Capacidades HE/EHT do modo estação (ou do primeiro modo listado)
+        iftype_data = [cls.parse_attrs(data) for data in cls.parse_attrs(attrs.get(cls.BAND_ATTR_IFTYPE_DATA, b'')).values()]
+        iftype_data.sort(key=lambda data: cls.IFTYPE_STATION not in cls.parse_attrs(data.get(cls.BAND_IFTYPE_ATTR_IFTYPES, b'')))
+        if iftype_data and cls.BAND_IFTYPE_ATTR_HE_CAP_PHY in iftype_data[0]:
+            data = iftype_data[0]
+            band['he'] = True
+            width_set = data[cls.BAND_IFTYPE_ATTR_HE_CAP_PHY][0]
+            if width_set & 0x02:
+                band['channel_widths'].add(40)
+            if width_set & 0x04:
+                band['channel_widths'].update((40, 80))
+            if width_set & 0x18:
+                band['channel_widths'].add(160)
+            if len(data.get(cls.BAND_IFTYPE_ATTR_HE_CAP_MCS_SET, b'')) >= 2:
+                rx_map = struct.unpack('<H', data[cls.BAND_IFTYPE_ATTR_HE_CAP_MCS_SET][:2])[0]
+                band['spatial_streams'] = max(band['spatial_streams'], cls._mcs_map_streams(rx_map))
+            if cls.BAND_IFTYPE_ATTR_EHT_CAP_PHY in data:
+                band['eht'] = True
+                if data[cls.BAND_IFTYPE_ATTR_EHT_CAP_PHY][0] & 0x02:
+                    band['channel_widths'].add(320)
+        return band
+
+    def wiphy_capabilities(self, wiphy):
+        """
+        Capacidades de um wiphy (NL80211_CMD_GET_WIPHY em modo split, com as
+        bandas espalhadas em várias mensagens), já resumidas.
+        """
+        request = (self.attr(self.ATTR_WIPHY, struct.pack('=I', wiphy))
+                   + self.attr(self.ATTR_SPLIT_WIPHY_DUMP, b''))
+        merged = {}
+        for attrs in self.request(self.family_id, self.CMD_GET_WIPHY, request, dump=True):
+            if self._u32(attrs.get(self.ATTR_WIPHY)) != wiphy:
+                continue
+            for index, data in self.parse_attrs(attrs.get(self.ATTR_WIPHY_BANDS, b'')).items():
+                merged.setdefault(index, {}).update(self.parse_attrs(data))
+        return summarize_capabilities({
+            self.BANDS[index]: self.parse_band(attrs) for index, attrs in merged.items() if index in self.BANDS
+        })
+
+# Padrões em ordem crescente, para escolher o mais alto suportado
+IEEE_STANDARDS = [
+    "802.11b", "802.11g", "802.11a", "802.11n (WiFi 4)", "802.11ac (WiFi 5)",
+    "802.11ad", "802.11ax (WiFi 6)", "802.11ax (WiFi 6E)", "802.11be (WiFi 7)",
+]
+
+def band_standards(band_name, band):
+    """Padrões IEEE 802.11 suportados em uma banda."""
+    standards = {
+        "2.4 GHz": ["802.11b", "802.11g"],
+        "5 GHz": ["802.11a"],
+        "60 GHz": ["802.11ad"],
+    }.get(band_name, [])
+    if band['ht'] and band_name in ("2.4 GHz", "5 GHz"):
+        standards.append("802.11n (WiFi 4)")
+    if band['vht'] and band_name == "5 GHz":
+        standards.append("802.11ac (WiFi 5)")
+    if band['he']:
+        standards.append("802.11ax (WiFi 6E)" if band_name == "6 GHz" else "802.11ax (WiFi 6)")
+    if band['eht']:
+        standards.append("802.11be (WiFi 7)")
+    return standards
+
+def summarize_capabilities(bands: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Consolida as capacidades por banda (ht/vht/he/eht, larguras de canal,
+    streams espaciais e canais) nos campos de `ieee_standard_info`.
+    """
+    supported_bands = {}
+    standards = set()
+    widths = set()
+    for band_name, band in bands.items():
+        band_list = band_standards(band_name, band)
+        standards.update(band_list)
+        widths.update(band['channel_widths'])
+        # Chaves sem ponto, que o MongoDB não aceita bem em nomes de campo
+        supported_bands[band_name.replace('.', '_').replace(' ', '')] = {
+            'band': band_name,
+            'standards': band_list,
+            'channel_widths': sorted(band['channel_widths']),
+            'spatial_streams': band['spatial_streams'],
+            'channels': band['channels'],
+        }
+
+    supported_standards = [standard for standard in IEEE_STANDARDS if standard in standards]
+    return {
+        'highest_standard': supported_standards[-1] if supported_standards else 'Unknown',
+        'supported_standards': supported_standards,
+        'supported_bands': supported_bands,
+        'supported_channel_widths': sorted(widths),
+        'capabilities': {
+            'HT': any(band['ht'] for band in bands.values()),
+            'VHT': any(band['vht'] for band in bands.values()),
+            'HE': any(band['he'] for band in bands.values()),
+            'EHT': any(band['eht'] for band in bands.values()),
+            'max_spatial_streams': max((band['spatial_streams'] for band in bands.values()), default=None),
+        },
+    }
+
+def parse_iw_capabilities(iw_info: str) -> Dict[str, Any]:
+    """Extrai as capacidades por banda da saída de `iw phy <phy> info` (ou `iw list`)."""
+    band_names = {'1': "2.4 GHz", '2': "5 GHz", '3': "60 GHz", '4': "6 GHz"}
+    sections = re.split(r'^\s*Band (\d+):', iw_info, flags=re.MULTILINE)
+    bands = {}
+    for number, section in zip(sections[1::2], sections[2::2]):
+        if number not in band_names:
+            continue
+        band = {
+            'ht': 'HT20' in section or 'HT Max RX data rate' in section,
+            'vht': 'VHT Capabilities' in section,
+            'he': 'HE PHY Capabilities' in section,
+            'eht': 'EHT PHY Capabilities' in section,
+            'channel_widths': {20},
+            'spatial_streams': 1,
+            'channels': len([
+                line for line in re.findall(r'\* \d+(?:\.\d+)? MHz \[\d+\].*', section) if 'disabled' not in line
+            ]),
+        }
+        if 'HT20/HT40' in section or 'HE40' in section:
+            band['channel_widths'].add(40)
+        if band['vht'] or 'HE40/HE80' in section:
+            band['channel_widths'].update((40, 80))
+        if re.search(r'Supported Channel Width: 160 MHz|HE160', section):
+            band['channel_widths'].add(160)
+        if 'EHT320' in section or '320MHz' in section:
+            band['channel_widths'].add(320)
+
+        ht_mcs = re.search(r'HT TX/RX MCS rate indexes supported: 0-(\d+)', section)
+        if ht_mcs:
+            band['spatial_streams'] = max(band['spatial_streams'], (int(ht_mcs.group(1)) + 1) // 8)
+        streams = {int(n) for n in re.findall(r'(\d) streams: MCS', section)}
+        if streams:
+            band['spatial_streams'] = max(band['spatial_streams'], max(streams))
+        bands[band_names[number]] = band
+    return summarize_capabilities(bands)
+
+class CapabilityRegistry:
+    """
+    Cache das capacidades dos adaptadores, que não mudam enquanto o
+    adaptador está conectado. A chave é (phy, MAC permanente do phy); a
+    entrada é invalidada quando o índice do wiphy muda (hot-plug ou recarga
+    do driver criam um wiphy novo) ou após um reboot (boot_id). Leituras
+    que falham ou não trazem nenhuma banda não entram no cache. Se `path`
+    for informado, o cache é persistido em JSON entre execuções.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        # Usado pelos jobs do agendador, em threads diferentes
+        self.lock = Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring capability cache {path}: {e}")
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return f.read().strip()
+
+    def identify(self, interface):
+        """Retorna (chave, fingerprint) do phy da interface, pelo sysfs."""
+        phy = self._read(f'/sys/class/net/{interface}/phy80211/name')
+        mac = self._read(f'/sys/class/ieee80211/{phy}/macaddress')
+        index = self._read(f'/sys/class/ieee80211/{phy}/index')
+        boot_id = self._read('/proc/sys/kernel/random/boot_id')
+        return f"{phy}@{mac}", f"{boot_id}:{index}", phy
+
+    def get(self, interface, loader: Callable[[str], Dict[str, Any]]):
+        """
+        Capacidades do adaptador de `interface`; `loader(phy)` só é chamado
+        quando não há entrada válida.
+        """
+        try:
+            key, fingerprint, phy = self.identify(interface)
+        except OSError:
+            return loader(None)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['fingerprint'] == fingerprint:
+                return entry['capabilities']
+
+            capabilities = loader(phy)
+            if not capabilities or not capabilities.get('supported_bands'):
+                # Falha de leitura (ex.: saída do `iw` vazia): tenta de novo na próxima
+                return capabilities
+
+            boot_id = fingerprint.split(':')[0]
+            # Entradas de boots anteriores não são mais válidas
+            self.entries = {
+                k: v for k, v in self.entries.items() if v['fingerprint'].split(':')[0] == boot_id
+            }
+            self.entries[key] = {'fingerprint': fingerprint, 'capabilities': capabilities}
+            self.save()
+            return capabilities
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving capability cache: {e}")
+
+# Compartilhado entre os WifiAnalyzer criados a cada ciclo
+CAPABILITY_REGISTRY = CapabilityRegistry(os.environ.get('NETWORK_ANALYZER_CAPABILITY_CACHE'))
+
+def frequency_to_band(freq_mhz):
+    if 2400 <= freq_mhz <= 2500:
+        return "2.4 GHz"
+    if 5150 <= freq_mhz <= 5895:
+        return "5 GHz"
+    if 5925 <= freq_mhz <= 7125:
+        return "6 GHz"
+    return "Unknown"
+
+def frequency_to_channel(freq_mhz):
+    if freq_mhz == 2484:
+        return 14
+    if 2407 < freq_mhz < 2484:
+        return (freq_mhz - 2407) // 5
+    if freq_mhz == 5935:
+        return 2
+    if 5950 < freq_mhz <= 7125:
+        return (freq_mhz - 5950) // 5
+    if 5000 < freq_mhz < 5925:
+        return (freq_mhz - 5000) // 5
+    return None
+
+def link_standard(rate, band):
+    """Padrão IEEE 802.11 do enlace a partir dos flags da taxa atual."""
+    rate = rate or {}
+    if 'eht_mcs' in rate:
+        return "802.11be (WiFi 7)"
+    if 'he_mcs' in rate:
+        return "802.11ax (WiFi 6E)" if band == "6 GHz" else "802.11ax (WiFi 6)"
+    if 'vht_mcs' in rate:
+        return "802.11ac (WiFi 5)"
+    if 'ht_mcs' in rate:
+        return "802.11n (WiFi 4)"
+    if band == "5 GHz":
+        return "802.11a"
+    if band == "2.4 GHz":
+        return "802.11b" if rate.get('bitrate_mbps', 54) <= 11 else "802.11g"
+    return "Unknown"
+
 class WifiAnalyzer:
+    def __init__(self, capability_registry: CapabilityRegistry = None):
+        # Desligado na primeira falha do netlink; daí em diante usa o `iw`
+        self.use_netlink = True
+        self.capability_registry = capability_registry or CAPABILITY_REGISTRY
+
+    def _load_capabilities_netlink(self, wiphy):
+        with Nl80211Client() as client:
+            return client.wiphy_capabilities(wiphy)
+
+    @staticmethod
+    def _load_capabilities_iw(phy):
+        return parse_iw_capabilities(subprocess.getoutput(f"iw phy {phy} info" if phy else "iw list"))
+
+    def get_link_info(self):
+        """Estado do enlace via nl80211, ou None se o netlink não estiver disponível."""
+        if not self.use_netlink:
+            return None
+        try:
+            with Nl80211Client() as client:
+                return client.link_info()
+        except (OSError, struct.error) as e:
+            print(f"nl80211 unavailable ({e}), falling back to iw")
+            self.use_netlink = False
+            return None
+
     def get_connected_wifi_info(self):
+        link = self.get_link_info()
+        if link is None:
+            return self.get_connected_wifi_info_iw()
+        if not link['interface']:
+            print("No wireless interface found")
+            return {}
+        if not link['connected'] or not link.get('frequency_mhz'):
+            print("Frequency not found")
+            return {}
+
+        rssi = link.get('signal_dbm')
+        tx_rate = link.get('tx_rate', {})
+        rx_rate = link.get('rx_rate', {})
+        return {
+            "SSID": link.get('ssid') or "Unknown",
+            "BSSID": link.get('bssid'),
+            "Frequency": float(f"{link['frequency_mhz'] / 1000:.4}"),
+            "Channel": frequency_to_channel(link['frequency_mhz']),
+            "Channel Width": link.get('channel_width_mhz'),
+            "TX Bitrate": tx_rate.get('bitrate_mbps'),
+            "RX Bitrate": rx_rate.get('bitrate_mbps'),
+            "RSSI": rssi,
+            "Signal Quality": self.signal_quality(rssi),
+        }
+
+    def get_connected_wifi_info_iw(self):
         try:
             # Verificar a interface sem fio conectada
             iw_output = subprocess.getoutput("iw dev")
@@ -132,7 +799,7 @@ class WifiAnalyzer:
 
             return {
                 "SSID": self.get_connected_ssid(),
-                "Frequency": f"{frequency:.4} GHz",
+                "Frequency": float(f"{frequency:.4}"),
                 "Channel": channel,
                 **signal_data
             }
@@ -146,6 +813,20 @@ class WifiAnalyzer:
         ssid_match = re.search(r'\"(.+)\"', output)
         return ssid_match.group(1) if ssid_match else "Unknown"
 
+    @staticmethod
+    def signal_quality(rssi):
+        """Determina a qualidade do sinal a partir do RSSI"""
+        if rssi is None:
+            return "Unknown"
+        if rssi > -50:
+            return "Excelent"
+        elif -51 <= rssi <= -60:
+            return "Good"
+        elif -61 <= rssi <= -70:
+            return "Fair"
+        else:
+            return "Weak"
+
     def get_signal_strength_and_quality(self, interface):
         """Obtém a intensidade do sinal da rede conectada e determina a qualidade"""
         try:
@@ -154,35 +835,69 @@ class WifiAnalyzer:
             
             if signal_match:
                 rssi = int(signal_match.group(1))
-                quality = None
-
-                # Determinar a qualidade do sinal
-                if rssi > -50:
-                    quality = "Excelent"
-                elif -51 <= rssi <= -60:
-                    quality = "Good"
-                elif -61 <= rssi <= -70:
-                    quality = "Fair"
-                else:
-                    quality = "Weak"
-
                 return {
-                    "RSSI": f"{rssi} dBm",
-                    "Signal Quality": quality
+                    "RSSI": rssi,
+                    "Signal Quality": self.signal_quality(rssi)
                 }
             else:
                 return {
-                    "RSSI": "Unknown",
+                    "RSSI": None,
                     "Signal Quality": "Unknown"
                 }
         except Exception as e:
             print(f"Error getting signal strength: {e}")
             return {
-                "RSSI": "Unknown",
+                "RSSI": None,
                 "Signal Quality": "Unknown"
             }
 
     def get_ieee_standard(self):
+        """
+        Identifica o padrão IEEE 802.11 da conexão atual a partir da taxa do
+        enlace reportada pelo nl80211 (flags HT/VHT/HE/EHT), e não apenas do
+        que o adaptador suporta.
+        """
+        link = self.get_link_info()
+        if link is None:
+            return self.get_ieee_standard_iw()
+        if not link['interface']:
+            return {"error": "No wireless interface found"}
+        if not link['connected'] or not link.get('frequency_mhz'):
+            return {"error": "No active connection"}
+
+        band = frequency_to_band(link['frequency_mhz'])
+        tx_rate = link.get('tx_rate', {})
+        # Sem flags de MCS na taxa de TX (ex.: taxa legada de gerência), usa a de RX
+        rate = tx_rate if any(key.endswith('_mcs') for key in tx_rate) else link.get('rx_rate') or tx_rate
+        standard = link_standard(rate, band)
+
+        try:
+            capabilities = self.capability_registry.get(
+                link['interface'], lambda phy: self._load_capabilities_netlink(link['wiphy'])
+            )
+        except (OSError, struct.error) as e:
+            print(f"Error reading adapter capabilities: {e}")
+            capabilities = {}
+
+        return {
+            **capabilities,
+            "interface standard": standard,
+            "interface": link['interface'],
+            "current_connection": {
+                "standard": standard,
+                "band": band,
+                "frequency_mhz": link['frequency_mhz'],
+                "channel": frequency_to_channel(link['frequency_mhz']),
+                "channel_width_mhz": link.get('channel_width_mhz') or rate.get('width_mhz'),
+                "tx_bitrate_mbps": tx_rate.get('bitrate_mbps'),
+                "rx_bitrate_mbps": link.get('rx_rate', {}).get('bitrate_mbps'),
+                "mcs": rate.get('eht_mcs', rate.get('he_mcs', rate.get('vht_mcs', rate.get('ht_mcs')))),
+                "spatial_streams": rate.get('eht_nss', rate.get('he_nss', rate.get('vht_nss'))),
+                "short_gi": rate.get('short_gi', False),
+            },
+        }
+
+    def get_ieee_standard_iw(self):
         """
         Identifica o padrão IEEE 802.11 da conexão atual do adaptador wireless
         """
@@ -199,15 +914,15 @@ class WifiAnalyzer:
             if not iw_link or "Connected to" not in iw_link:
                 return {"error": "No active connection"}
             
-            # Obter capacidades do adaptador para determinar o padrão
-            iw_list = subprocess.getoutput(f"iw list")
-            if not iw_list:
+            # Obter capacidades do adaptador (em cache enquanto ele estiver conectado)
+            capabilities = self.capability_registry.get(interface, self._load_capabilities_iw)
+            if not capabilities.get('supported_bands'):
                 return {"error": "Unable to get adapter capabilities"}
             
             # Verificar suporte aos padrões
-            he_support = "HE capabilities" in iw_list or "HE PHY" in iw_list
-            vht_support = "VHT capabilities" in iw_list or "VHT80" in iw_list
-            ht_support = "HT capabilities" in iw_list or "HT20" in iw_list
+            he_support = capabilities['capabilities']['HE']
+            vht_support = capabilities['capabilities']['VHT']
+            ht_support = capabilities['capabilities']['HT']
             
             # Extrair frequência da conexão atual
             freq_match = re.search(r'freq: (\d+)', iw_link)
@@ -242,306 +957,1599 @@ class WifiAnalyzer:
             else:
                 current_standard = "Unknown"
             
-            return {"interface standard": current_standard}
+            return {**capabilities, "interface": interface, "interface standard": current_standard}
             
         except Exception as e:
             return {"error": f"Error detecting IEEE standard: {str(e)}"}
-            
-            
-class NetworkPerformanceTester:
-    def test_gateway_ping(self):
-        """Test ping to local gateway"""
+
+
+class SignalSampler:
+    """
+    Amostrador de sinal em segundo plano: lê RSSI, ruído e taxa de TX do
+    enlace a `rate_hz` (nl80211, ou /proc/net/wireless sem taxa) para um
+    buffer circular NumPy de tamanho fixo, de modo que CPU e memória ficam
+    constantes. Cada documento recebe as estatísticas do intervalo desde o
+    documento anterior, capturando quedas de sinal entre os ciclos; o buffer
+    deve cobrir o maior intervalo entre ciclos (`window_s` em start()), e
+    intervalos maiores saem marcados com `truncated`.
+    """
+
+    # Colunas do buffer: instante (monotônico), RSSI, ruído, taxa de TX
+    COLUMNS = ('t', 'rssi', 'noise', 'bitrate')
+    # Espera antes de procurar de novo a interface sem fio pelo nl80211
+    NETLINK_RETRY_S = 30.0
+
+    def __init__(self, rate_hz=10.0, window_s=900, dip_threshold_dbm=-70.0):
+        self.rate_hz = rate_hz
+        self.window_s = window_s
+        self.dip_threshold_dbm = dip_threshold_dbm
+        # Alocado em start(): importar o módulo não reserva o buffer
+        self.capacity = 0
+        self.buffer = np.empty((0, len(self.COLUMNS)))
+        self.count = 0  # total de amostras já escritas
+        self.interval_start = time.monotonic()
+        self.lock = Lock()
+        self.running = False
+        self.thread = None
+        self.client = None
+        self.ifindex = None
+        self.use_netlink = True
+        self.netlink_retry_at = 0.0
+
+    def start(self, background=True, window_s=None):
+        """
+        Inicia a amostragem com um buffer de `window_s` segundos (padrão: o
+        do construtor). Com `background=False` nenhuma thread é criada e
+        quem chama step() a `rate_hz` é o chamador.
+        """
+        if self.running:
+            return
+        self.window_s = window_s or self.window_s
+        capacity = max(1, int(self.rate_hz * self.window_s))
+        with self.lock:
+            if capacity != self.capacity:
+                self.capacity = capacity
+                self.buffer = np.full((capacity, len(self.COLUMNS)), np.nan)
+                self.count = 0
+        self.running = True
+        self.interval_start = time.monotonic()
+        if background:
+            self.thread = Thread(target=self._run, name='signal-sampler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    @staticmethod
+    def _read_proc_wireless():
+        """(RSSI, ruído) da primeira interface em /proc/net/wireless."""
+        with open('/proc/net/wireless') as f:
+            for line in f.readlines()[2:]:
+                fields = line.split(':', 1)[1].split()
+                level, noise = float(fields[2].rstrip('.')), float(fields[3].rstrip('.'))
+                # -256 (ou 0 no nível) indica valor não reportado pelo driver
+                return (level if level not in (0, -256) else np.nan,
+                        noise if noise != -256 else np.nan)
+        return np.nan, np.nan
+
+    def _read_netlink(self):
+        """(RSSI, taxa de TX) pelo nl80211, mantendo o socket aberto entre amostras."""
+        if not self.use_netlink:
+            return np.nan, np.nan
+        if self.client is None:
+            if time.monotonic() < self.netlink_retry_at:
+                return np.nan, np.nan
+            try:
+                self.client = Nl80211Client()
+            except OSError:
+                self.use_netlink = False  # sem nl80211 neste kernel
+                raise
+            link = self.client.link_info()
+            if not link['interface']:
+                raise OSError("No wireless interface found")
+            self.ifindex = link['ifindex']
+        station = self.client.station_info(self.ifindex)
+        return station.get('signal_dbm', np.nan), station.get('tx_rate', {}).get('bitrate_mbps', np.nan)
+
+    def sample(self):
+        """Lê uma amostra (RSSI, ruído, taxa de TX); valores indisponíveis são NaN."""
+        rssi = bitrate = noise = np.nan
         try:
-            # Get the default gateway from network info
-            network_analyzer = NetworkAnalyzer()
-            network_info = network_analyzer.get_network_info()
-            
-            if not network_info or not network_info.get('Default_Gateway'):
-                print("Unable to retrieve default gateway")
-                return None
+            rssi, bitrate = self._read_netlink()
+        except (OSError, struct.error):
+            if self.client:
+                self.client.close()
+            # Reabre (e redescobre a interface) depois de NETLINK_RETRY_S, sem
+            # refazer a descoberta a cada amostra quando não há interface
+            self.client = None
+            self.netlink_retry_at = time.monotonic() + self.NETLINK_RETRY_S
+        try:
+            proc_rssi, noise = self._read_proc_wireless()
+            if np.isnan(rssi):
+                rssi = proc_rssi
+        except (OSError, IndexError, ValueError):
+            pass
+        return rssi, noise, bitrate
 
-            gateway = network_info['Default_Gateway']
-            
-            # Run ping test to gateway
-            stdout = subprocess.getoutput(f"ping -c 300 -i 0.1 {gateway}")
-            
-            # Extract ping times
-            times = [float(m.group(1)) for m in re.finditer(r'time=(\d+\.?\d*)', stdout)]
-            
-            # Extract packet loss with improved regex and validation
-            packet_loss = None
-            
-            # Look for the statistics line that contains packet loss information
-            # This regex looks for the pattern "X packets transmitted, Y received, Z% packet loss"
-            stats_match = re.search(r'(\d+) packets transmitted,\s*(\d+) (?:received|packets received),.*?(\d+(?:\.\d+)?)% packet loss', stdout)
-            
-            if stats_match:
-                transmitted = int(stats_match.group(1))
-                received = int(stats_match.group(2))
-                reported_loss = float(stats_match.group(3))
-                
-                # Calculate actual packet loss to validate
-                if transmitted > 0:
-                    calculated_loss = ((transmitted - received) / transmitted) * 100
-                    
-                    # Use the calculated value if it's reasonable, otherwise cap at 100%
-                    if 0 <= calculated_loss <= 100:
-                        packet_loss = calculated_loss
-                    elif reported_loss <= 100:
-                        packet_loss = reported_loss
-                    else:
-                        # If both values are problematic, calculate from the data we have
-                        packet_loss = min(calculated_loss, 100.0)
-                else:
-                    packet_loss = 0
+    def record(self, rssi, noise, bitrate, timestamp=None):
+        with self.lock:
+            if not self.capacity:
+                return
+            row = self.count % self.capacity
+            self.buffer[row] = (time.monotonic() if timestamp is None else timestamp, rssi, noise, bitrate)
+            self.count += 1
+
+    def step(self):
+        self.record(*self.sample())
+
+    def _run(self):
+        period = 1.0 / self.rate_hz
+        next_sample = time.monotonic()
+        while self.running:
+            self.step()
+            next_sample += period
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
             else:
-                # Fallback: try the original regex but cap at 100%
-                packet_loss_match = re.search(r'(\d+(?:\.\d+)?)% packet loss', stdout)
-                if packet_loss_match:
-                    raw_loss = float(packet_loss_match.group(1))
-                    packet_loss = min(raw_loss, 100.0)  # Cap at 100%
-            
-            # Ensure packet_loss is not None and is within valid range
-            if packet_loss is None:
-                packet_loss = 0  # Default to 0 if we can't determine packet loss
-            
-            # Final validation: ensure packet loss is between 0 and 100
-            packet_loss = max(0.0, min(packet_loss, 100.0))
-            
-            return {
-                'Gateway': gateway,
-                'Min': f"{min(times):.2f} ms" if times else "N/A",
-                'Max': f"{max(times):.2f} ms" if times else "N/A",
-                'Avg': f"{statistics.mean(times):.2f} ms" if times else "N/A",
-                'Packet Loss': f"{packet_loss:.1f} %" if packet_loss is not None else "N/A",
-            }
-            
-        except Exception as e:
-            print(f"Error in gateway ping test: {e}")
-            return None    
-    
-    def __init__(self):
-        self.google_dns = "8.8.8.8"
-        self.download_url = "https://speed.cloudflare.com/__down?bytes=25000000"  # 25MB test file
-        self.upload_url = "https://speed.cloudflare.com/__up"
+                next_sample = time.monotonic()  # atrasado: não tenta compensar em rajada
 
-    def test_dns(self):
-        """Testa conectividade com DNS e capacidade de resolução usando o DNS do sistema Linux"""
-        results = {
-            'DNS_Server': 'Unknown',
-            'Port_Test': 'Failed',
-            'Resolution_Test': 'Failed',
-            'Resolved_IPs': []
+    def _samples_since(self, start):
+        """Amostras desde `start` e se amostras do intervalo já foram sobrescritas."""
+        with self.lock:
+            filled = self.buffer[:min(self.count, self.capacity)].copy()
+            wrapped = self.count > self.capacity
+        truncated = wrapped and len(filled) > 0 and np.nanmin(filled[:, 0]) > start
+        return filled[filled[:, 0] >= start], bool(truncated)
+
+    def stats(self, start=None):
+        """Estatísticas das amostras desde `start` (monotônico)."""
+        samples, truncated = self._samples_since(self.interval_start if start is None else start)
+        samples = samples[np.argsort(samples[:, 0])]
+        rssi = samples[:, 1][~np.isnan(samples[:, 1])]
+        noise = samples[:, 2][~np.isnan(samples[:, 2])]
+        bitrate = samples[:, 3][~np.isnan(samples[:, 3])]
+
+        # Quedas: quantas vezes o RSSI cruzou para baixo do limite
+        below = rssi < self.dip_threshold_dbm
+        dips = int(below[0]) + int(np.count_nonzero(below[1:] & ~below[:-1])) if len(rssi) else 0
+
+        def rounded(values, func):
+            return round(float(func(values)), 2) if len(values) else None
+
+        return {
+            'samples': int(len(samples)),
+            'rate_hz': self.rate_hz,
+            'window_s': round(float(samples[-1, 0] - samples[0, 0]), 1) if len(samples) else 0.0,
+            'truncated': truncated,
+            'rssi_min': rounded(rssi, np.min),
+            'rssi_mean': rounded(rssi, np.mean),
+            'rssi_p5': rounded(rssi, lambda v: np.percentile(v, 5)),
+            'rssi_p95': rounded(rssi, lambda v: np.percentile(v, 95)),
+            'rssi_dips': dips,
+            'dip_threshold': self.dip_threshold_dbm,
+            'time_below_threshold_s': round(float(np.count_nonzero(below)) / self.rate_hz, 2),
+            'noise_mean': rounded(noise, np.mean),
+            'bitrate_min': rounded(bitrate, np.min),
+            'bitrate_mean': rounded(bitrate, np.mean),
         }
 
-        try:
-            # Obtém o DNS do sistema Linux usando NetworkAnalyzer
-            network_analyzer = NetworkAnalyzer()
-            network_info = network_analyzer.get_linux_info()
-            
-            if network_info and network_info.get('DNS_Servers'):
-                # Usa o primeiro servidor DNS da lista
-                dns_ip = network_info['DNS_Servers'][0]
-                results['DNS_Server'] = dns_ip
+    def interval_stats(self):
+        """Estatísticas desde a chamada anterior, iniciando um novo intervalo."""
+        now = time.monotonic()
+        stats = self.stats(self.interval_start)
+        self.interval_start = now
+        return stats
 
-                # Testa conectividade na porta 53 (DNS)
-                try:
-                    nc_output = subprocess.getoutput(f"nc -zv {dns_ip} 53 2>&1")
-                    if 'succeeded' in nc_output.lower():
-                        results['Port_Test'] = 'Success'
-                    else:
-                        results['Port_Test'] = 'Failed'
-                        results['Port_Test_Error'] = nc_output.strip()
-                except Exception as e:
-                    results['Port_Test'] = 'Failed'
-                    results['Port_Test_Error'] = str(e)
-
-                # Testa resolução DNS
-                try:
-                    nslookup_output = subprocess.getoutput(f"nslookup www.google.com {dns_ip}")
-                    if 'Address:' in nslookup_output:
-                        results['Resolution_Test'] = 'Success'
-                        for line in nslookup_output.splitlines():
-                            if 'Address:' in line and not line.endswith(dns_ip):
-                                ip = line.split('Address:')[-1].strip()
-                                results['Resolved_IPs'].append(ip)
-                    else:
-                        results['Resolution_Test'] = 'Failed'
-                        results['Resolution_Test_Error'] = nslookup_output.strip()
-                except Exception as e:
-                    results['Resolution_Test'] = 'Failed'
-                    results['Resolution_Test_Error'] = str(e)
+# Amostrador compartilhado; iniciado (e o buffer alocado) pelo __main__
+SIGNAL_SAMPLER = SignalSampler(
+    rate_hz=float(os.environ.get('NETWORK_ANALYZER_SIGNAL_RATE_HZ', 10)),
+    dip_threshold_dbm=float(os.environ.get('NETWORK_ANALYZER_RSSI_DIP_DBM', -70)),
+)
 
-        except Exception as e:
-            print(f"Erro no teste de DNS: {e}")
-            results['Error'] = str(e)
+class IcmpProber:
+    """
+    Sonda ICMP em processo, usando os sockets ICMP não privilegiados do Linux
+    (SOCK_DGRAM + IPPROTO_ICMP, liberados para os grupos em
+    net.ipv4.ping_group_range). Evita um fork do `ping` por teste e o parse
+    do texto de saída; os RTTs usam o timestamp de recepção do kernel
+    (SO_TIMESTAMPNS) em vez do relógio do processo.
+    """
 
-        return results
+    ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+    SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+    SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+    TIMESPEC = struct.Struct('@qq')
 
-    def test_ping(self, count=300, interval=0.1):
-        """Test ping to Google DNS with improved packet loss validation"""
-        try:
-            stdout = subprocess.getoutput(f"ping -c {count} -i {interval} {self.google_dns}")
-            
-            # Extract ping times
-            times = [float(m.group(1)) for m in re.finditer(r'time=(\d+\.?\d*)', stdout)]
-            
-            # Extract packet loss with improved regex and validation
-            packet_loss = None
-            
-            # Look for the statistics line that contains packet loss information
-            # This regex looks for the pattern "X packets transmitted, Y received, Z% packet loss"
-            stats_match = re.search(r'(\d+) packets transmitted,\s*(\d+) (?:received|packets received),.*?(\d+(?:\.\d+)?)% packet loss', stdout)
-            
-            if stats_match:
-                transmitted = int(stats_match.group(1))
-                received = int(stats_match.group(2))
-                reported_loss = float(stats_match.group(3))
-                
-                # Calculate actual packet loss to validate
-                if transmitted > 0:
-                    calculated_loss = ((transmitted - received) / transmitted) * 100
-                    
-                    # Use the calculated value if it's reasonable, otherwise cap at 100%
-                    if 0 <= calculated_loss <= 100:
-                        packet_loss = calculated_loss
-                    elif reported_loss <= 100:
-                        packet_loss = reported_loss
-                    else:
-                        # If both values are problematic, calculate from the data we have
-                        packet_loss = min(calculated_loss, 100.0)
-                else:
-                    packet_loss = 0
-            else:
-                # Fallback: try the original regex but cap at 100%
-                packet_loss_match = re.search(r'(\d+(?:\.\d+)?)% packet loss', stdout)
-                if packet_loss_match:
-                    raw_loss = float(packet_loss_match.group(1))
-                    packet_loss = min(raw_loss, 100.0)  # Cap at 100%
-            
-            # Ensure packet_loss is not None and is within valid range
-            if packet_loss is None:
-                packet_loss = 0  # Default to 0 if we can't determine packet loss
-            
-            # Final validation: ensure packet loss is between 0 and 100
-            packet_loss = max(0.0, min(packet_loss, 100.0))
-            
-            return {
-                'Min': f"{min(times):.2f} ms" if times else "N/A",
-                'Max': f"{max(times):.2f} ms" if times else "N/A", 
-                'Avg': f"{statistics.mean(times):.2f} ms" if times else "N/A",
-                'Packet Loss': f"{packet_loss:.1f} %",
-            } if times else None
-            
-        except Exception as e:
-            print(f"Error in ping test: {e}")
-            return None
+    def __init__(self, payload_size=56, timeout=1.0):
+        self.payload_size = payload_size
+        self.timeout = timeout
 
-    def test_mtr(self):
+    @staticmethod
+    def open_socket():
+        """Abre o socket ICMP; levanta PermissionError se o grupo não é permitido."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
         try:
-            output = subprocess.getoutput(f"mtr -rn -c 10 --report-wide {self.google_dns}")
-            hops_data = []
-            for line in output.splitlines()[2:]:  # Ignorar cabeçalho
-                parts = line.split()
-                if len(parts) < 8:  # Verificar formato esperado
-                    continue
-                
-                #Extrair dados
-                raw_hop = parts[0].strip()
-                hop_match = re.match(r'(\d+)', raw_hop)
-                hop = hop_match.group(1) if hop_match else "?"
-                host = parts[1].strip()
-                loss = float(parts[2].strip('%'))
-                avg_latency = float(parts[7])
+            sock.setsockopt(socket.SOL_SOCKET, IcmpProber.SO_TIMESTAMPNS, 1)
+        except OSError:
+            pass  # sem timestamp do kernel, usa time.time_ns() na recepção
+        sock.setblocking(False)
+        return sock
 
-                hops_data.append({
-                    "Hop": hop,
-                    "Host": host,
-                    "Loss": f"{loss} %",
-                    "Latency": f"{avg_latency} ms"
-                })
+    @staticmethod
+    def _checksum(data: bytes) -> int:
+        if len(data) % 2:
+            data += b'\x00'
+        total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
 
-            return hops_data
-        except Exception as e:
-            print(f"Error in MTR test: {e}")
-            return []
+    def _echo_request(self, seq):
+        # O kernel substitui o identificador pela "porta" do socket
+        payload = bytes(self.payload_size)
+        header = struct.pack('!BBHHH', self.ICMP_ECHO_REQUEST, 0, 0, 0, seq & 0xFFFF)
+        checksum = self._checksum(header + payload)
+        return struct.pack('!BBHHH', self.ICMP_ECHO_REQUEST, 0, checksum, 0, seq & 0xFFFF) + payload
 
-    def get_connection_info(self):
-        """Get IP, ISP, Primary DNS and location information"""
-        try:
-            # Inicializar dicionário de retorno
-            connection_info = {
-                'IPv4': 'Unknown',
-                'ISP': 'Unknown',
-                'Location': 'Unknown',
-                'Primary DNS': 'Unknown',
-            }
+    def _receive_time_ns(self, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == self.SCM_TIMESTAMPNS and len(data) >= self.TIMESPEC.size:
+                sec, nsec = self.TIMESPEC.unpack(data[:self.TIMESPEC.size])
+                return sec * 1_000_000_000 + nsec, True
+        return time.time_ns(), False
 
-            # Coletar informações de IP e ISP
-            ip_info_response = requests.get('http://ip-api.com/json/')
-            if ip_info_response.status_code == 200:
-                ip_info = ip_info_response.json()
-                if ip_info.get('status') == 'success':
-                    connection_info.update({
-                        'IPv4': ip_info.get('query', 'Unknown'),
-                        'ISP': ip_info.get('isp', 'Unknown'),
-                        'Location': f"{ip_info.get('city', '')}, {ip_info.get('country', '')}"
-                    })
-
-            # Coletar DNS do ISP
-            dns_info_response = requests.get('https://edns.ip-api.com/json')
-            if dns_info_response.status_code == 200:
-                dns_info = dns_info_response.json()
-                connection_info['Primary DNS'] = dns_info.get('dns', {}).get('ip', 'Unknown')
-
-            return connection_info
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching connection info: {e}")
-            return {
-                'IPv4': 'Unknown',
-                'ISP': 'Unknown',
-                'Location': 'Unknown',
-                'Primary DNS': 'Unknown',
+    def _drain(self, sock, sent, replies):
+        while True:
+            try:
+                data, ancdata, _, _ = sock.recvmsg(2048, socket.CMSG_SPACE(self.TIMESPEC.size))
+            except (BlockingIOError, InterruptedError):
+                return
+            # Em sockets SOCK_DGRAM o kernel entrega só o cabeçalho ICMP (sem IP)
+            if len(data) < 8 or data[0] != self.ICMP_ECHO_REPLY:
+                continue
+            seq = struct.unpack('!H', data[6:8])[0]
+            if seq not in sent or seq in replies:
+                continue
+            received_ns, kernel = self._receive_time_ns(ancdata)
+            replies[seq] = {
+                'rtt_ms': (received_ns - sent[seq]) / 1e6,
+                'received_ns': received_ns,
+                'kernel_timestamp': kernel,
             }
 
-    def test_bandwidth(self, duration=60):
-        """Test download and upload speeds."""
+    def _send(self, sock, address, seq, sent):
+        packet = self._echo_request(seq)
+        sent[seq] = time.time_ns()
         try:
-            # Get connection info first
-            connection_info = self.get_connection_info()
+            sock.sendto(packet, (address, 0))
+        except PermissionError:
+            raise
+        except OSError:
+            pass  # Ex.: rede inalcançável; a sonda conta como perdida
+
+    def ping(self, target, count=300, interval=0.1):
+        """
+        Envia `count` echo requests para `target` a cada `interval` segundos
+        e retorna uma lista por sonda: seq, sent_ns, rtt_ms (None se perdida),
+        received_ns e kernel_timestamp. Levanta PermissionError se o socket
+        ICMP não for permitido para este usuário. Com `count` < 1 não envia
+        nada e retorna uma lista vazia.
+        """
+        if count < 1:
+            return []
+        address = socket.gethostbyname(target)
+        sock = self.open_socket()
+        sent, replies = {}, {}
+        try:
+            seq = 0
+            next_send = time.monotonic()
+            deadline = None
+            while True:
+                now = time.monotonic()
+                if seq < count and now >= next_send:
+                    seq += 1
+                    self._send(sock, address, seq, sent)
+                    next_send += interval
+                    if seq == count:
+                        deadline = now + self.timeout
+
+                if seq == count and (len(replies) == count or now >= deadline):
+                    break
+
+                wait_for = (next_send if seq < count else deadline) - time.monotonic()
+                readable, _, _ = select.select([sock], [], [], max(0.0, wait_for))
+                if readable:
+                    self._drain(sock, sent, replies)
+        finally:
+            sock.close()
+
+        return self._collect(count, sent, replies)
+
+    @staticmethod
+    def _collect(count, sent, replies):
+        probes = []
+        for probe_seq in range(1, count + 1):
+            reply = replies.get(probe_seq, {})
+            probes.append({
+                'seq': probe_seq,
+                'sent_ns': sent.get(probe_seq),
+                'rtt_ms': reply.get('rtt_ms'),
+                'received_ns': reply.get('received_ns'),
+                'kernel_timestamp': reply.get('kernel_timestamp', False),
+            })
+        return probes
+
+    @staticmethod
+    def summarize(probes):
+        """Converte as sondas no mesmo formato de `_parse_ping_output`."""
+        times = [p['rtt_ms'] for p in probes if p['rtt_ms'] is not None]
+        lost_seq = [p['seq'] for p in probes if p['rtt_ms'] is None]
+        transmitted = len(probes)
+        return {
+            'times': times,
+            'lost_seq': lost_seq,
+            'transmitted': transmitted,
+            'packet_loss': 100.0 * len(lost_seq) / transmitted if transmitted else 0.0,
+        }
+
+class MultiTargetProber:
+    """
+    Motor de sondas ICMP em asyncio: todos os alvos (gateway, servidores DNS,
+    alvos WAN) são sondados ao mesmo tempo em um único event loop, cada um
+    com seu socket e seu limite de taxa, de modo que uma varredura completa
+    leva o mesmo tempo de parede que um único alvo.
+    """
+
+    def __init__(self, prober: IcmpProber = None, fallback: Callable[..., Dict[str, Any]] = None,
+                 rate_limits: Dict[str, float] = None):
+        self.prober = prober or IcmpProber()
+        # fallback(target, count, interval) usado quando o socket ICMP não é permitido
+        self.fallback = fallback
+        self.rate_limits = TARGET_RATE_LIMITS if rate_limits is None else rate_limits
+
+    def _schedule_for(self, target, count, interval):
+        """
+        Ajusta (count, interval) ao limite de taxa do alvo mantendo a mesma
+        janela de tempo: alvos limitados recebem menos sondas, não mais tempo.
+        """
+        rate = self.rate_limits.get(target)
+        if not rate or 1.0 / rate <= interval:
+            return count, interval
+        window = count * interval
+        return max(1, int(window * rate)), 1.0 / rate
+
+    async def _probe_target(self, target, count, interval):
+        if count < 1:
+            return IcmpProber.summarize([])
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(target, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        address = infos[0][4][0]
+        count, interval = self._schedule_for(target, count, interval)
+
+        try:
+            sock = self.prober.open_socket()
+        except OSError:
+            if not self.fallback:
+                raise
+            return await loop.run_in_executor(None, self.fallback, target, count, interval)
+        sent, replies = {}, {}
+        complete = asyncio.Event()
+
+        def on_readable():
+            self.prober._drain(sock, sent, replies)
+            if len(replies) >= count:
+                complete.set()
+
+        loop.add_reader(sock.fileno(), on_readable)
+        try:
+            start = loop.time()
+            for seq in range(1, count + 1):
+                self.prober._send(sock, address, seq, sent)
+                if seq < count:
+                    await asyncio.sleep(max(0.0, start + seq * interval - loop.time()))
+            try:
+                await asyncio.wait_for(complete.wait(), self.prober.timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        return IcmpProber.summarize(IcmpProber._collect(count, sent, replies))
+
+    async def _fallback_target(self, target, count, interval):
+        loop = asyncio.get_running_loop()
+        count, interval = self._schedule_for(target, count, interval)
+        return await loop.run_in_executor(None, self.fallback, target, count, interval)
+
+    async def _sweep(self, targets, count, interval, use_socket):
+        probe = self._probe_target
+        if not use_socket:
+            probe = self._fallback_target
+        elif self.fallback:
+            try:
+                self.prober.open_socket().close()
+            except OSError as e:
+                # Não só PermissionError: EAFNOSUPPORT, ENETUNREACH etc. também
+                print(f"ICMP socket unavailable ({e}), falling back to ping subprocess")
+                probe = self._fallback_target
+        return await asyncio.gather(
+            *(probe(target, count, interval) for target in targets), return_exceptions=True
+        )
+
+    def sweep(self, targets: Iterable[str], count=300, interval=0.1, use_socket=True) -> Dict[str, Any]:
+        """
+        Sonda todos os `targets` em paralelo e retorna {alvo: resultado}, com
+        o resultado no formato de `_parse_ping_output` (None se o alvo falhou).
+        """
+        targets = list(dict.fromkeys(targets))
+        if not targets:
+            return {}
+        results = asyncio.run(self._sweep(targets, count, interval, use_socket))
+
+        sweep = {}
+        for target, result in zip(targets, results):
+            if isinstance(result, PermissionError) and not self.fallback:
+                raise result
+            if isinstance(result, Exception):
+                print(f"Error probing {target}: {result}")
+                result = None
+            sweep[target] = result
+        return sweep
+
+# Nomes resolvidos no teste de DNS; o primeiro alimenta os campos legados
+DNS_TEST_NAMES = [
+    name.strip()
+    for name in os.environ.get('NETWORK_ANALYZER_DNS_NAMES', 'www.google.com,www.cloudflare.com,www.wikipedia.org').split(',')
+    if name.strip()
+]
+
+class _DnsDatagram(asyncio.DatagramProtocol):
+    def __init__(self, query_id, future):
+        self.query_id = query_id
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 2 and struct.unpack('!H', data[:2])[0] == self.query_id and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+class DnsProbe:
+    """
+    Sonda de DNS nativa: consultas A enviadas direto por UDP (com TCP se a
+    resposta vier truncada) a todos os resolvedores ao mesmo tempo, medindo
+    a latência de cada consulta. Para cada nome, uma consulta a um subdomínio
+    aleatório força a resolução recursiva completa ("cold", fora do cache do
+    resolvedor); em seguida o próprio nome é consultado uma vez para aquecer
+    o cache e mais `cached_repeats` vezes ("cached").
+    """
+
+    QTYPE_A = 1
+    QCLASS_IN = 1
+    # Resolvedor com esse número de timeouts seguidos é dado como inacessível
+    MAX_CONSECUTIVE_TIMEOUTS = 2
+
+    def __init__(self, names=None, timeout=2.0, cached_repeats=3):
+        self.names = names or DNS_TEST_NAMES
+        self.timeout = timeout
+        self.cached_repeats = cached_repeats
+
+    @classmethod
+    def build_query(cls, query_id, name):
+        header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)  # RD
+        qname = b''.join(bytes([len(label)]) + label.encode() for label in name.strip('.').split('.')) + b'\x00'
+        return header + qname + struct.pack('!HH', cls.QTYPE_A, cls.QCLASS_IN)
+
+    @staticmethod
+    def _skip_name(data, offset):
+        while True:
+            length = data[offset]
+            if length & 0xC0 == 0xC0:  # ponteiro de compressão
+                return offset + 2
+            offset += 1 + length
+            if length == 0:
+                return offset
+
+    @classmethod
+    def parse_response(cls, data):
+        """Extrai rcode, flag TC e os endereços IPv4 das respostas."""
+        query_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+        offset = 12
+        for _ in range(qdcount):
+            offset = cls._skip_name(data, offset) + 4
+        answers = []
+        for _ in range(ancount):
+            offset = cls._skip_name(data, offset)
+            rtype, _, _, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            if rtype == cls.QTYPE_A and rdlength == 4:
+                answers.append(socket.inet_ntoa(data[offset:offset + 4]))
+            offset += rdlength
+        return {'id': query_id, 'rcode': flags & 0x000F, 'truncated': bool(flags & 0x0200), 'answers': answers}
+
+    async def _query_udp(self, server, query_id, query):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DnsDatagram(query_id, future), remote_addr=(server, 53)
+        )
+        try:
+            transport.sendto(query)
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+
+    async def _query_tcp(self, server, query):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(server, 53), self.timeout)
+        try:
+            writer.write(struct.pack('!H', len(query)) + query)
+            await writer.drain()
+            length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+
+    async def query(self, server, name):
+        """Resolve `name` em `server` e retorna o resultado com a latência."""
+        query_id = struct.unpack('!H', os.urandom(2))[0]
+        query = self.build_query(query_id, name)
+        start = time.perf_counter()
+        try:
+            response = self.parse_response(await self._query_udp(server, query_id, query))
+            if response['truncated']:
+                response = self.parse_response(await self._query_tcp(server, query))
+                response['transport'] = 'tcp'
+        except (asyncio.TimeoutError, OSError, struct.error, IndexError, asyncio.IncompleteReadError) as e:
+            return {'name': name, 'latency_ms': None, 'error': str(e) or type(e).__name__}
+        response['name'] = name
+        response['latency_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return response
+
+    async def _tcp_connect(self, server):
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(server, 53), self.timeout)
+            writer.close()
+            return round((time.perf_counter() - start) * 1000, 3), None
+        except (asyncio.TimeoutError, OSError) as e:
+            return None, str(e) or type(e).__name__
+
+    @staticmethod
+    def _stats(results):
+        latencies = [r['latency_ms'] for r in results if r.get('latency_ms') is not None]
+        return {
+            'queries': len(results),
+            'answered': len(latencies),
+            'timeouts': len(results) - len(latencies),
+            'min_ms': round(min(latencies), 3) if latencies else None,
+            'avg_ms': round(statistics.mean(latencies), 3) if latencies else None,
+            'median_ms': round(statistics.median(latencies), 3) if latencies else None,
+            'max_ms': round(max(latencies), 3) if latencies else None,
+        }
+
+    async def _probe_resolver(self, server):
+        tcp_connect_ms, tcp_error = await self._tcp_connect(server)
+        cold, cached, names = [], [], {}
+        consecutive_timeouts = 0
+        error = None
+
+        for name in self.names:
+            sequence = [('cold', f"{os.urandom(6).hex()}.{name}"), ('warm', name)]
+            sequence += [('cached', name)] * self.cached_repeats
+            for kind, qname in sequence:
+                result = await self.query(server, qname)
+                if result['latency_ms'] is None:
+                    consecutive_timeouts += 1
+                    error = result['error']
+                else:
+                    consecutive_timeouts = 0
+                if kind == 'cold':
+                    cold.append(result)
+                elif kind == 'cached':
+                    cached.append(result)
+                elif result.get('rcode') == 0:
+                    names[name] = result['answers']
+                elif result['latency_ms'] is not None:
+                    error = f"rcode {result['rcode']}"
+                if consecutive_timeouts >= self.MAX_CONSECUTIVE_TIMEOUTS:
+                    break
+            if consecutive_timeouts >= self.MAX_CONSECUTIVE_TIMEOUTS:
+                break
+
+        return {
+            'server': server,
+            'reachable': consecutive_timeouts < self.MAX_CONSECUTIVE_TIMEOUTS,
+            'tcp_connect_ms': tcp_connect_ms,
+            'tcp_error': tcp_error,
+            'cold': self._stats(cold),
+            'cached': self._stats(cached),
+            'resolved': names,
+            'error': error,
+        }
+
+    def run(self, servers: Iterable[str]):
+        """Sonda todos os resolvedores em paralelo; um resultado por resolvedor."""
+        servers = list(dict.fromkeys(servers))
+
+        async def probe_all():
+            return await asyncio.gather(*(self._probe_resolver(server) for server in servers))
+
+        return asyncio.run(probe_all()) if servers else []
+
+# Destinos adicionais do traceroute (o alvo de ping principal é sempre incluído)
+TRACE_TARGETS = [
+    target.strip()
+    for target in os.environ.get('NETWORK_ANALYZER_TRACE_TARGETS', '').split(',')
+    if target.strip()
+]
+
+class PathTracer:
+    """
+    Traceroute em processo. A cada rodada envia ao mesmo tempo uma sonda para
+    cada TTL (um socket por TTL) e lê os ICMP "time exceeded" pela fila de
+    erros do socket (IP_RECVERR / MSG_ERRQUEUE), sem privilégios de root:
+    com sockets ICMP não privilegiados (echo request) quando o grupo está em
+    net.ipv4.ping_group_range, ou UDP para portas altas caso contrário. Uma
+    rodada completa leva cerca de um RTT até o destino, em vez de um mtr
+    serial. Guarda o último caminho de cada destino para detectar mudanças de
+    rota entre ciclos.
+    """
+
+    IP_RECVERR = getattr(socket, 'IP_RECVERR', 11)
+    MSG_ERRQUEUE = getattr(socket, 'MSG_ERRQUEUE', 0x2000)
+    SO_EE_ORIGIN_ICMP = 2
+    ICMP_DEST_UNREACH = 3
+    ICMP_TIME_EXCEEDED = 11
+    # struct sock_extended_err seguido do sockaddr_in de quem enviou o erro
+    EXTENDED_ERR = struct.Struct('=IBBBBII')
+    UDP_BASE_PORT = 33434
+
+    def __init__(self, protocol='auto', max_hops=30, count=10, interval=0.5, timeout=1.0):
+        self.protocol = protocol
+        self.max_hops = max_hops
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.prober = IcmpProber(payload_size=24, timeout=timeout)
+        self.last_paths = {}
+
+    def _open_socket(self, protocol, ttl):
+        if protocol == 'icmp':
+            sock = self.prober.open_socket()
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, IcmpProber.SO_TIMESTAMPNS, 1)
+            sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, self.IP_RECVERR, 1)
+        return sock
+
+    def _open_sockets(self):
+        protocols = ['icmp', 'udp'] if self.protocol == 'auto' else [self.protocol]
+        for protocol in protocols:
+            sockets = {}
+            try:
+                for ttl in range(1, self.max_hops + 1):
+                    sockets[ttl] = self._open_socket(protocol, ttl)
+                return protocol, sockets
+            except PermissionError:
+                for sock in sockets.values():
+                    sock.close()
+                if protocol == protocols[-1]:
+                    raise
+
+    def _send(self, protocol, sock, address, ttl, probe_round, sent):
+        sent[(ttl, probe_round)] = time.time_ns()
+        try:
+            if protocol == 'icmp':
+                sock.sendto(self.prober._echo_request(probe_round), (address, 0))
+            else:
+                sock.sendto(struct.pack('!HH', ttl, probe_round), (address, self.UDP_BASE_PORT + ttl))
+        except OSError:
+            pass  # Ex.: rede inalcançável; a sonda conta como perdida
+
+    def _offender(self, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.IPPROTO_IP and kind == self.IP_RECVERR and len(data) >= self.EXTENDED_ERR.size + 8:
+                _, origin, icmp_type, icmp_code, _, _, _ = self.EXTENDED_ERR.unpack_from(data)
+                if origin != self.SO_EE_ORIGIN_ICMP:
+                    return None
+                offset = self.EXTENDED_ERR.size
+                return socket.inet_ntoa(data[offset + 4:offset + 8]), icmp_type, icmp_code
+        return None
+
+    def _drain(self, protocol, ttl, sock, sent, replies):
+        # Erros ICMP (time exceeded / unreachable) ficam na fila de erros
+        while True:
+            try:
+                data, ancdata, _, _ = sock.recvmsg(512, 1024, self.MSG_ERRQUEUE)
+            except (BlockingIOError, InterruptedError):
+                break
+            offender = self._offender(ancdata)
+            if protocol == 'icmp':
+                probe_round = struct.unpack('!H', data[6:8])[0] if len(data) >= 8 else None
+            else:
+                probe_round = struct.unpack('!HH', data[:4])[1] if len(data) >= 4 else None
+            key = (ttl, probe_round)
+            if offender and key in sent and key not in replies:
+                received_ns, _ = self.prober._receive_time_ns(ancdata)
+                host, icmp_type, icmp_code = offender
+                replies[key] = {
+                    'host': host,
+                    'rtt_ms': (received_ns - sent[key]) / 1e6,
+                    'icmp_type': icmp_type,
+                    'icmp_code': icmp_code,
+                }
+
+        if protocol != 'icmp':
+            return
+        # Echo replies: o destino foi alcançado com este TTL
+        while True:
+            try:
+                data, ancdata, _, address = sock.recvmsg(512, socket.CMSG_SPACE(IcmpProber.TIMESPEC.size))
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # erro pendente sinalizado na leitura normal
+            if len(data) < 8 or data[0] != IcmpProber.ICMP_ECHO_REPLY:
+                continue
+            key = (ttl, struct.unpack('!H', data[6:8])[0])
+            if key in sent and key not in replies:
+                received_ns, _ = self.prober._receive_time_ns(ancdata)
+                replies[key] = {
+                    'host': address[0],
+                    'rtt_ms': (received_ns - sent[key]) / 1e6,
+                    'icmp_type': IcmpProber.ICMP_ECHO_REPLY,
+                    'icmp_code': 0,
+                }
+
+    def _destination_ttl(self, address, replies):
+        ttls = [ttl for (ttl, _), reply in replies.items() if reply['host'] == address]
+        return min(ttls) if ttls else None
+
+    def trace(self, target):
+        """
+        Traça o caminho até `target` e retorna Target, Address, Protocol,
+        Reached, Hops (Hop, Host, Hosts, Sent, Received, Loss, Latency, Best,
+        Worst, StDev) e a comparação com o caminho anterior (Path_Changed,
+        Changed_Hops). Levanta PermissionError se nenhum tipo de socket for
+        permitido e OSError (ex.: socket.gaierror) se o alvo não resolver.
+        """
+        address = socket.gethostbyname(target)
+        protocol, sockets = self._open_sockets()
+        by_fd = {sock.fileno(): ttl for ttl, sock in sockets.items()}
+        sent, replies = {}, {}
+        # Se o caminho anterior chegou ao destino, a primeira rodada vai só um
+        # pouco além dele: cada sonda excedente gera um ICMP do destino, que
+        # tem taxa limitada (no Linux, rajada de 6 e depois 1/s por origem)
+        previous = self.last_paths.get(target)
+        first_round_ttl = self.max_hops
+        if previous and previous[-1] == address:
+            first_round_ttl = min(self.max_hops, len(previous) + 2)
+        try:
+            probe_round = 0
+            next_send = time.monotonic()
+            deadline = None
+            while True:
+                now = time.monotonic()
+                if probe_round < self.count and now >= next_send:
+                    probe_round += 1
+                    # TTLs além do destino já encontrado não são mais sondados
+                    last_ttl = self._destination_ttl(address, replies) or self.max_hops
+                    if probe_round == 1:
+                        last_ttl = first_round_ttl
+                    for ttl in range(1, last_ttl + 1):
+                        self._send(protocol, sockets[ttl], address, ttl, probe_round, sent)
+                    next_send += self.interval
+                    if probe_round == self.count:
+                        deadline = now + self.timeout
+
+                if probe_round == self.count and (len(replies) == len(sent) or now >= deadline):
+                    break
+
+                wait_for = (next_send if probe_round < self.count else deadline) - time.monotonic()
+                readable, _, errored = select.select(list(sockets.values()), [], list(sockets.values()), max(0.0, wait_for))
+                for sock in set(readable) | set(errored):
+                    ttl = by_fd[sock.fileno()]
+                    self._drain(protocol, ttl, sock, sent, replies)
+        finally:
+            for sock in sockets.values():
+                sock.close()
+
+        hops = self._hops(address, sent, replies)
+        hosts = [hop['Host'] for hop in hops]
+        previous = self.last_paths.get(target)
+        self.last_paths[target] = hosts
+        changed_hops = self.compare_paths(previous, hosts)
+        return {
+            'Target': target,
+            'Address': address,
+            'Protocol': protocol,
+            'Reached': bool(hops) and hops[-1]['Host'] == address,
+            'Hops': hops,
+            'Path_Changed': bool(changed_hops),
+            'Changed_Hops': changed_hops,
+        }
+
+    def _hops(self, address, sent, replies):
+        destination_ttl = last_ttl = self._destination_ttl(address, replies)
+        if last_ttl is None:
+            # Destino não respondeu: vai até o último TTL com alguma resposta
+            last_ttl = max((ttl for ttl, _ in replies), default=0)
+
+        hops = []
+        for ttl in range(1, last_ttl + 1):
+            probes = [key for key in sent if key[0] == ttl]
+            answers = [replies[key] for key in probes if key in replies]
+            if ttl == destination_ttl:
+                # Sondas com TTL além do destino também chegam a ele; a rodada
+                # conta como respondida se o destino respondeu em qualquer TTL
+                answers = []
+                for _, probe_round in probes:
+                    for key in sorted(k for k in replies if k[1] == probe_round and k[0] >= ttl):
+                        if replies[key]['host'] == address:
+                            answers.append(replies[key])
+                            break
+            rtts = [answer['rtt_ms'] for answer in answers]
+            hosts = [answer['host'] for answer in answers]
+            # Com ECMP mais de um roteador responde pelo mesmo TTL
+            host = max(set(hosts), key=hosts.count) if hosts else None
+            hops.append({
+                'Hop': ttl,
+                'Host': host,
+                'Hosts': sorted(set(hosts)),
+                'Sent': len(probes),
+                'Received': len(answers),
+                'Loss': round(100.0 * (len(probes) - len(answers)) / len(probes), 2) if probes else 100.0,
+                'Latency': round(statistics.mean(rtts), 3) if rtts else None,
+                'Best': round(min(rtts), 3) if rtts else None,
+                'Worst': round(max(rtts), 3) if rtts else None,
+                'StDev': round(statistics.pstdev(rtts), 3) if rtts else None,
+            })
+        return hops
+
+    @staticmethod
+    def compare_paths(previous, current):
+        """
+        Saltos cujo roteador mudou em relação ao caminho anterior. Saltos sem
+        resposta em um dos dois caminhos não contam como mudança.
+        """
+        if previous is None:
+            return []
+        changed = []
+        for index in range(max(len(previous), len(current))):
+            before = previous[index] if index < len(previous) else None
+            after = current[index] if index < len(current) else None
+            if before != after and (index >= len(previous) or index >= len(current) or (before and after)):
+                changed.append(index + 1)
+        return changed
+
+PATH_TRACER = PathTracer(
+    protocol=os.environ.get('NETWORK_ANALYZER_TRACE_PROTOCOL', 'auto'),
+    count=int(os.environ.get('NETWORK_ANALYZER_TRACE_COUNT', 10)),
+    interval=float(os.environ.get('NETWORK_ANALYZER_TRACE_INTERVAL', 0.5)),
+)
+
+class _StopStream(Exception):
+    """Interrompe um upload em andamento quando a medição termina."""
+
+class _UploadBody:
+    """
+    Corpo de upload de tamanho fixo lido em blocos de um buffer aleatório
+    pré-alocado (sem cópias), contando os bytes entregues ao socket.
+    """
+
+    def __init__(self, payload: memoryview, size, on_read, stop):
+        self.payload = payload
+        self.remaining = size
+        self.len = size  # usado pelo requests para o Content-Length
+        self.on_read = on_read
+        self.stop = stop
+
+    def read(self, amount=-1):
+        if self.stop.is_set():
+            raise _StopStream()
+        if amount is None or amount < 0:
+            amount = self.remaining
+        amount = min(amount, self.remaining, len(self.payload))
+        self.remaining -= amount
+        self.on_read(amount)
+        return self.payload[:amount]
+
+class ThroughputEngine:
+    """
+    Mede throughput com `streams` fluxos TCP paralelos, cada um com sua
+    sessão HTTP keep-alive (reaproveitada entre requisições e entre
+    download e upload) e buffers de leitura grandes. Os primeiros
+    `warmup_s` segundos (slow start do TCP) são descartados: a taxa
+    reportada é a do intervalo após o aquecimento, por fluxo e agregada.
+
+    No modo adaptativo a taxa é amostrada a cada `sample_interval` segundos
+    e a medição para assim que o intervalo de confiança de 95% da média
+    fica dentro de `tolerance` (relativo), com `duration` como limite.
+    """
+
+    def __init__(self, streams=4, warmup_s=3.0, chunk_size=1 << 16, read_buffer_size=1 << 18,
+                 upload_request_size=16 * 1024 * 1024, timeout=(5, 15),
+                 sample_interval=0.5, tolerance=0.05, min_samples=6):
+        self.streams = streams
+        self.read_buffer_size = read_buffer_size
+        self.warmup_s = warmup_s
+        self.sample_interval = sample_interval
+        self.tolerance = tolerance
+        self.min_samples = min_samples
+        self.chunk_size = chunk_size
+        self.upload_request_size = upload_request_size
+        self.timeout = timeout
+        self.sessions = [requests.Session() for _ in range(streams)]
+        self.payload = memoryview(os.urandom(chunk_size))
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+    def _connection(self, url):
+        parsed = urlparse(url)
+        connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        path = parsed.path + (f'?{parsed.query}' if parsed.query else '')
+        return connection_class(parsed.netloc, timeout=self.timeout[1]), path or '/'
+
+    def _download_worker(self, index, url, counters, stop):
+        """
+        Recebe o download direto em um buffer pré-alocado (readinto, que
+        chega ao recv_into do socket) e descarta o conteúdo, sem criar um
+        objeto bytes por bloco. A conexão keep-alive é reaproveitada entre
+        as requisições do fluxo.
+        """
+        connection, path = self._connection(url)
+        view = memoryview(bytearray(self.read_buffer_size))
+        headers = {'User-Agent': 'network-analyzer', 'Accept-Encoding': 'identity'}
+        try:
+            while not stop.is_set():
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise RuntimeError(f"HTTP {response.status} {response.reason}")
+                received = response.readinto(view)
+                while received:
+                    counters[index] += received
+                    if stop.is_set():
+                        return  # resposta incompleta: a conexão é fechada abaixo
+                    received = response.readinto(view)
+        finally:
+            connection.close()
+
+    def _proxied_download_worker(self, index, url, counters, stop):
+        """
+        Download pelo requests, usado quando há proxy para a URL (HTTP(S)_PROXY
+        / NO_PROXY), que a conexão http.client direta não atravessa. Também lê
+        com readinto no buffer pré-alocado.
+        """
+        session = self.sessions[index]
+        view = memoryview(bytearray(self.read_buffer_size))
+        headers = {'User-Agent': 'network-analyzer', 'Accept-Encoding': 'identity'}
+        while not stop.is_set():
+            with session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                received = response.raw.readinto(view)
+                while received:
+                    counters[index] += received
+                    if stop.is_set():
+                        return
+                    received = response.raw.readinto(view)
+
+    def _upload_worker(self, index, url, counters, stop):
+        session = self.sessions[index]
+
+        def on_read(amount):
+            counters[index] += amount
 
-            # Test download speed
-            start_time = time.time()
-            response = requests.get(self.download_url, stream=True)
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    downloaded += len(chunk)
-                if time.time() - start_time >= duration:
+        while not stop.is_set():
+            body = _UploadBody(self.payload, self.upload_request_size, on_read, stop)
+            try:
+                session.post(url, data=body, timeout=self.timeout).raise_for_status()
+            except _StopStream:
+                break
+            except requests.exceptions.RequestException:
+                # O requests pode embrulhar a interrupção do corpo
+                if stop.is_set():
                     break
+                raise
+
+    def _run_stream(self, worker, index, url, counters, stop, errors, cpu):
+        cpu_start = time.thread_time()
+        try:
+            worker(index, url, counters, stop)
+        except Exception as e:
+            errors[index] = str(e)
+        finally:
+            cpu[index] = time.thread_time() - cpu_start
+
+    def _confidence(self, samples):
+        """Meia largura relativa do IC de 95% da média das amostras, ou None."""
+        if len(samples) < 2:
+            return None
+        mean = statistics.mean(samples)
+        if mean <= 0:
+            return None
+        return 1.96 * statistics.stdev(samples) / math.sqrt(len(samples)) / mean
+
+    def _measure(self, worker, url, duration, adaptive=False):
+        counters = [0] * self.streams
+        errors = [None] * self.streams
+        # Fluxos que não terminam dentro do join abaixo ficam com 0.0 de CPU
+        # (ver `stalled_streams`)
+        cpu = [0.0] * self.streams
+        stop = Event()
+        threads = [
+            Thread(target=self._run_stream, args=(worker, i, url, counters, stop, errors, cpu), daemon=True)
+            for i in range(self.streams)
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        warmup = self.warmup_s if duration > self.warmup_s else 0.0
+        time.sleep(warmup)
+        warm_counters, warm_time = list(counters), time.perf_counter()
+
+        # Série de taxas agregadas (Mbps) por intervalo após o aquecimento
+        samples = []
+        convergence_s = None
+        previous_total, previous_time = sum(warm_counters), warm_time
+        deadline = start + duration
+        while any(thread.is_alive() for thread in threads):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.sample_interval, remaining))
+            total, now = sum(counters), time.perf_counter()
+            samples.append(round((total - previous_total) * 8 / (now - previous_time) / 1e6, 2))
+            previous_total, previous_time = total, now
+
+            if adaptive and len(samples) >= self.min_samples:
+                confidence = self._confidence(samples)
+                if confidence is not None and confidence <= self.tolerance:
+                    convergence_s = round(now - start, 2)
+                    break
+
+        end_counters, end_time = list(counters), time.perf_counter()
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=self.timeout[1])
+        stalled = sum(thread.is_alive() for thread in threads)
+
+        if all(errors) and not any(end_counters):
+            raise RuntimeError(f"All {self.streams} streams failed: {errors[0]}")
+
+        elapsed = end_time - warm_time
+        confidence = self._confidence(samples)
+        streams_mbps = [
+            round((end - warm) * 8 / elapsed / 1e6, 2) for warm, end in zip(warm_counters, end_counters)
+        ]
+        total_bytes = sum(counters)
+        return {
+            'aggregate_mbps': round(sum(streams_mbps), 2),
+            'streams_mbps': streams_mbps,
+            'bytes': sum(end_counters),
+            # Custo da medição: CPU dos fluxos por GB transferido
+            'cpu_s': round(sum(cpu), 3),
+            'cpu_s_per_gb': round(sum(cpu) / (total_bytes / 1e9), 3) if total_bytes else None,
+            'stalled_streams': stalled,
+            'measured_bytes': sum(end_counters) - sum(warm_counters),
+            'warmup_s': round(warm_time - start, 2),
+            'measured_s': round(elapsed, 2),
+            'adaptive': adaptive,
+            'converged': convergence_s is not None,
+            'convergence_s': convergence_s,
+            'confidence_pct': round(100 * confidence, 2) if confidence is not None else None,
+            'sample_interval_s': self.sample_interval,
+            'samples_mbps': samples,
+            'errors': [error for error in errors if error],
+        }
+
+    def measure_download(self, url, duration, adaptive=False):
+        worker = self._download_worker
+        if requests.utils.get_environ_proxies(url):
+            worker = self._proxied_download_worker
+        return self._measure(worker, url, duration, adaptive)
+
+    def measure_upload(self, url, duration, adaptive=False):
+        return self._measure(self._upload_worker, url, duration, adaptive)
+
+class ConnectionInfoCache:
+    """
+    Cache persistente (opcional, em JSON) das informações de conexão do
+    ip-api, que raramente mudam entre ciclos e cujo serviço gratuito limita
+    as requisições. A entrada vale por `ttl` segundos e é invalidada antes
+    disso se o gateway (IP e MAC) ou o IP público mudarem. O IP público é
+    conferido pelo cabeçalho `cf-meta-ip` de uma requisição vazia ao
+    servidor do teste de banda, no máximo a cada `public_ip_ttl` segundos.
+    """
+
+    def __init__(self, path=None, ttl=3600, public_ip_ttl=300, timeout=(3.05, 5)):
+        self.path = path
+        self.ttl = ttl
+        self.public_ip_ttl = public_ip_ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.entry = None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entry = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring connection info cache {path}: {e}")
+
+    @staticmethod
+    def network_key(gateway):
+        """Identifica a rede pelo IP e pelo MAC do gateway (de /proc/net/arp)."""
+        mac = None
+        try:
+            with open('/proc/net/arp') as f:
+                for line in f.readlines()[1:]:
+                    fields = line.split()
+                    if fields and fields[0] == gateway:
+                        mac = fields[3]
+                        break
+        except OSError:
+            pass
+        return f"{gateway}/{mac}"
+
+    def public_ip(self, url):
+        """IP público visto pelo servidor do teste de banda, ou None."""
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                return response.headers.get('cf-meta-ip')
+        except requests.exceptions.RequestException:
+            return None
+
+    def fetch(self):
+        """Consulta o ip-api; levanta RequestException em caso de falha."""
+        connection_info = {
+            'IPv4': 'Unknown',
+            'ISP': 'Unknown',
+            'Location': 'Unknown',
+            'Primary DNS': 'Unknown',
+        }
+
+        # Coletar informações de IP e ISP
+        ip_info_response = self.session.get('http://ip-api.com/json/', timeout=self.timeout)
+        ip_info_response.raise_for_status()
+        ip_info = ip_info_response.json()
+        if ip_info.get('status') != 'success':
+            raise requests.exceptions.RequestException(f"ip-api: {ip_info.get('message', 'failed')}")
+        connection_info.update({
+            'IPv4': ip_info.get('query', 'Unknown'),
+            'ISP': ip_info.get('isp', 'Unknown'),
+            'Location': f"{ip_info.get('city', '')}, {ip_info.get('country', '')}"
+        })
+
+        # Coletar DNS do ISP
+        dns_info_response = self.session.get('https://edns.ip-api.com/json', timeout=self.timeout)
+        if dns_info_response.status_code == 200:
+            connection_info['Primary DNS'] = dns_info_response.json().get('dns', {}).get('ip', 'Unknown')
+        return connection_info
+
+    def get(self, gateway, public_ip_url):
+        network = self.network_key(gateway)
+        entry = self.entry
+        now = time.time()
+        public_ip = None
+        if entry and entry['network'] == network and now - entry['fetched_at'] < self.ttl:
+            if now - entry.get('public_ip_checked_at', 0) < self.public_ip_ttl:
+                return dict(entry['info'])
+            public_ip = self.public_ip(public_ip_url)
+            if not public_ip or not entry.get('public_ip') or public_ip == entry['public_ip']:
+                entry['public_ip'] = entry.get('public_ip') or public_ip
+                entry['public_ip_checked_at'] = now
+                self.save()
+                return dict(entry['info'])
+
+        try:
+            info = self.fetch()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error fetching connection info: {e}")
+            # Na mesma rede, uma informação antiga é melhor que nenhuma
+            if entry and entry['network'] == network:
+                return dict(entry['info'])
+            return None
+
+        # Sem conferência do IP público nesta chamada, ele é registrado na próxima
+        self.entry = {
+            'network': network, 'public_ip': public_ip, 'fetched_at': now,
+            'public_ip_checked_at': now if public_ip else 0, 'info': info,
+        }
+        self.save()
+        return dict(info)
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entry, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error saving connection info cache: {e}")
+
+# Compartilhado entre os NetworkPerformanceTester criados a cada ciclo
+CONNECTION_INFO_CACHE = ConnectionInfoCache(
+    os.environ.get('NETWORK_ANALYZER_CONNECTION_CACHE'),
+    ttl=float(os.environ.get('NETWORK_ANALYZER_CONNECTION_TTL', 3600)),
+    public_ip_ttl=float(os.environ.get('NETWORK_ANALYZER_PUBLIC_IP_TTL', 300)),
+)
+
+class NetworkPerformanceTester:
+    def test_gateway_ping(self, network_info=None):
+        """Test ping to local gateway"""
+        try:
+            # Get the default gateway from network info
+            if network_info is None:
+                network_analyzer = NetworkAnalyzer()
+                network_info = network_analyzer.get_network_info()
             
-            download_speed = (downloaded * 8) / (time.time() - start_time) / 1000000  # Mbps
+            if not network_info or not network_info.get('Default_Gateway'):
+                print("Unable to retrieve default gateway")
+                return None
+
+            gateway = network_info['Default_Gateway']
+            
+            # Run ping test to gateway
+            ping = self._run_ping(gateway)
+            return {'Gateway': gateway, **self._summarize_ping(ping)}
             
-            # Test upload speed
-            data = os.urandom(1000000)  # 1MB of random data
-            start_time = time.time()
-            uploaded = 0
-            while time.time() - start_time < duration:
-                response = requests.post(self.upload_url, data=data)
-                if response.status_code == 200:
-                    uploaded += len(data)
+        except Exception as e:
+            print(f"Error in gateway ping test: {e}")
+            return None    
+    
+    def __init__(self, ping_backend=None):
+        # Alvo dos testes de ping/MTR e servidor do teste de banda, configuráveis
+        # para rodar contra o speedtest_server.py local
+        self.google_dns = os.environ.get('NETWORK_ANALYZER_PING_TARGET', "8.8.8.8")
+        # 'auto' tenta o socket ICMP e cai para o `ping`; 'socket' ou 'subprocess' forçam um deles
+        self.ping_backend = ping_backend or os.environ.get('NETWORK_ANALYZER_PING_BACKEND', 'auto')
+        self.icmp_prober = IcmpProber()
+        self.wan_targets = list(dict.fromkeys([self.google_dns] + WAN_TARGETS))
+        self.multi_prober = MultiTargetProber(
+            self.icmp_prober,
+            fallback=self._run_subprocess_ping if self.ping_backend != 'socket' else None,
+        )
+        speedtest_url = os.environ.get('NETWORK_ANALYZER_SPEEDTEST_URL', "https://speed.cloudflare.com").rstrip('/')
+        self.download_url = f"{speedtest_url}/__down?bytes=25000000"  # 25MB test file
+        self.upload_url = f"{speedtest_url}/__up"
+        self.dns_names = DNS_TEST_NAMES
+        self.path_tracer = PATH_TRACER
+        self.trace_targets = TRACE_TARGETS
+        self.bandwidth_streams = int(os.environ.get('NETWORK_ANALYZER_BANDWIDTH_STREAMS', 4))
+        self.bandwidth_warmup = float(os.environ.get('NETWORK_ANALYZER_BANDWIDTH_WARMUP', 3.0))
+        # Modo adaptativo: para cada direção quando a taxa converge (duration vira o limite)
+        self.bandwidth_adaptive = os.environ.get('NETWORK_ANALYZER_BANDWIDTH_ADAPTIVE', '1') != '0'
+        self.bandwidth_tolerance = float(os.environ.get('NETWORK_ANALYZER_BANDWIDTH_TOLERANCE', 0.05))
+
+    def test_dns(self, network_info=None):
+        """
+        Testa todos os servidores DNS do sistema em paralelo (consultas diretas
+        por UDP/TCP, ver DnsProbe), registrando a latência das consultas. Os
+        campos legados (DNS_Server, Port_Test, Resolution_Test, Resolved_IPs)
+        refletem o primeiro servidor da lista.
+        """
+        results = {
+            'DNS_Server': 'Unknown',
+            'Port_Test': 'Failed',
+            'Resolution_Test': 'Failed',
+            'Resolved_IPs': [],
+            'resolvers': [],
+        }
+
+        try:
+            # Obtém o DNS do sistema Linux usando NetworkAnalyzer
+            if network_info is None:
+                network_analyzer = NetworkAnalyzer()
+                network_info = network_analyzer.get_linux_info()
             
-            upload_speed = (uploaded * 8) / (time.time() - start_time) / 1000000  # Mbps
+            if network_info and network_info.get('DNS_Servers'):
+                probe = DnsProbe(self.dns_names)
+                results['names'] = probe.names
+                results['resolvers'] = probe.run(network_info['DNS_Servers'])
+
+                first = results['resolvers'][0]
+                results['DNS_Server'] = first['server']
+
+                # Conectividade na porta 53 (TCP)
+                if first['tcp_connect_ms'] is not None:
+                    results['Port_Test'] = 'Success'
+                else:
+                    results['Port_Test_Error'] = first['tcp_error']
+
+                # Resolução do primeiro nome
+                resolved = first['resolved'].get(probe.names[0])
+                if resolved:
+                    results['Resolution_Test'] = 'Success'
+                    results['Resolved_IPs'] = resolved
+                else:
+                    results['Resolution_Test_Error'] = first['error'] or 'No answer'
+
+        except Exception as e:
+            print(f"Erro no teste de DNS: {e}")
+            results['Error'] = str(e)
+
+        return results
+
+    def _parse_ping_output(self, stdout):
+        """
+        Extrai do texto do `ping` os RTTs (em ordem de sequência), os números
+        de sequência perdidos, o total transmitido e a perda de pacotes.
+        """
+        # Extract ping times, keyed by sequence number (duplicates ignored)
+        replies = {}
+        for m in re.finditer(r'icmp_seq=(\d+).*?time=(\d+\.?\d*)', stdout):
+            replies.setdefault(int(m.group(1)), float(m.group(2)))
+        times = [replies[seq] for seq in sorted(replies)]
+        
+        # Extract packet loss with improved regex and validation
+        packet_loss = None
+        transmitted = len(replies)
+        
+        # Look for the statistics line that contains packet loss information
+        # This regex looks for the pattern "X packets transmitted, Y received, Z% packet loss"
+        stats_match = re.search(r'(\d+) packets transmitted,\s*(\d+) (?:received|packets received),.*?(\d+(?:\.\d+)?)% packet loss', stdout)
+        
+        if stats_match:
+            transmitted = int(stats_match.group(1))
+            received = int(stats_match.group(2))
+            reported_loss = float(stats_match.group(3))
+            
+            # Calculate actual packet loss to validate
+            if transmitted > 0:
+                calculated_loss = ((transmitted - received) / transmitted) * 100
+                
+                # Use the calculated value if it's reasonable, otherwise cap at 100%
+                if 0 <= calculated_loss <= 100:
+                    packet_loss = calculated_loss
+                elif reported_loss <= 100:
+                    packet_loss = reported_loss
+                else:
+                    # If both values are problematic, calculate from the data we have
+                    packet_loss = min(calculated_loss, 100.0)
+            else:
+                packet_loss = 0
+        else:
+            # Fallback: try the original regex but cap at 100%
+            packet_loss_match = re.search(r'(\d+(?:\.\d+)?)% packet loss', stdout)
+            if packet_loss_match:
+                raw_loss = float(packet_loss_match.group(1))
+                packet_loss = min(raw_loss, 100.0)  # Cap at 100%
+        
+        # Ensure packet_loss is not None and is within valid range
+        if packet_loss is None:
+            packet_loss = 0  # Default to 0 if we can't determine packet loss
+        
+        # Final validation: ensure packet loss is between 0 and 100
+        packet_loss = max(0.0, min(packet_loss, 100.0))
+
+        # O ping do Linux numera as sequências a partir de 1
+        lost_seq = [seq for seq in range(1, transmitted + 1) if seq not in replies]
+
+        return {
+            'times': times,
+            'lost_seq': lost_seq,
+            'transmitted': transmitted,
+            'packet_loss': packet_loss,
+        }
+
+    def _run_ping(self, target, count=300, interval=0.1):
+        """
+        Executa o ping para `target` e retorna o resultado estruturado. Usa o
+        IcmpProber quando o socket ICMP é permitido e o `ping` caso contrário.
+        """
+        if self.ping_backend in ('auto', 'socket'):
+            try:
+                probes = self.icmp_prober.ping(target, count, interval)
+                result = IcmpProber.summarize(probes)
+                result['backend'] = 'socket'
+                return result
+            except PermissionError as e:
+                if self.ping_backend == 'socket':
+                    raise
+                print(f"ICMP socket not permitted ({e}), falling back to ping subprocess")
+                # Não adianta tentar de novo a cada teste
+                self.ping_backend = 'subprocess'
+
+        return self._run_subprocess_ping(target, count, interval)
+
+    def _run_subprocess_ping(self, target, count=300, interval=0.1):
+        stdout = subprocess.getoutput(f"ping -c {count} -i {interval} {target}")
+        result = self._parse_ping_output(stdout)
+        result['backend'] = 'subprocess'
+        return result
+
+    @staticmethod
+    def _summarize_ping(ping):
+        """Resumo de um resultado de ping no formato salvo nos documentos."""
+        times = ping['times']
+        return {
+            'Min': round(min(times), 2) if times else None,
+            'Max': round(max(times), 2) if times else None,
+            'Avg': round(statistics.mean(times), 2) if times else None,
+            'Packet Loss': round(ping['packet_loss'], 1),
+            'rtt_samples': pack_rtt_samples(times, ping['lost_seq'], ping['transmitted']),
+        }
+
+    def test_ping(self, count=300, interval=0.1):
+        """Test ping to Google DNS with improved packet loss validation"""
+        try:
+            ping = self._run_ping(self.google_dns, count, interval)
+            return self._summarize_ping(ping) if ping['times'] else None
+            
+        except Exception as e:
+            print(f"Error in ping test: {e}")
+            return None
+
+    def test_targets(self, network_info=None, count=300, interval=0.1):
+        """
+        Sonda ao mesmo tempo o gateway, todos os servidores DNS do
+        /etc/resolv.conf e os alvos WAN. Retorna uma lista com um resultado
+        por alvo (Target, Role e os campos de test_gateway_ping).
+        """
+        try:
+            if network_info is None:
+                network_info = NetworkAnalyzer().get_network_info()
+            network_info = network_info or {}
+
+            targets = []
+            if network_info.get('Default_Gateway'):
+                targets.append((network_info['Default_Gateway'], 'gateway'))
+            targets += [(dns, 'dns') for dns in network_info.get('DNS_Servers', [])]
+            targets += [(wan, 'wan') for wan in self.wan_targets]
+
+            pings = self.multi_prober.sweep(
+                [target for target, _ in targets], count, interval,
+                use_socket=self.ping_backend != 'subprocess',
+            )
+            return [
+                {'Target': target, 'Role': role, **self._summarize_ping(pings[target])}
+                for target, role in targets
+                if pings.get(target)
+            ]
+
+        except Exception as e:
+            print(f"Error in multi-target ping test: {e}")
+            return []
+
+    @staticmethod
+    def target_result(target_results, role, target=None):
+        """Seleciona o resultado de um alvo na lista de test_targets."""
+        for entry in target_results or []:
+            if entry['Role'] == role and (target is None or entry['Target'] == target):
+                return {k: v for k, v in entry.items() if k not in ('Target', 'Role')}
+        return None
+
+    def test_paths(self):
+        """
+        Traça o caminho até o alvo principal e os destinos de TRACE_TARGETS,
+        todos ao mesmo tempo (ver PathTracer). Se nenhum socket for permitido,
+        volta ao `mtr`; um alvo que falha sozinho (ex.: não resolve) fica com
+        `Error` e sem saltos.
+        """
+        targets = list(dict.fromkeys([self.google_dns] + self.trace_targets))
+
+        def trace(target):
+            try:
+                return self.path_tracer.trace(target)
+            except PermissionError:
+                raise
+            except OSError as e:
+                print(f"Error tracing path to {target}: {e}")
+                return {'Target': target, 'Protocol': None, 'Reached': False, 'Hops': [], 'Error': str(e)}
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+                return list(executor.map(trace, targets))
+        except PermissionError as e:
+            print(f"Native traceroute unavailable ({e}), falling back to mtr")
+        return [{'Target': target, 'Protocol': 'mtr', 'Hops': self.test_mtr(target)} for target in targets]
+
+    @staticmethod
+    def path_hops(path_results, target):
+        """Saltos do caminho até `target` na lista de test_paths."""
+        for path in path_results or []:
+            if path['Target'] == target:
+                return path['Hops']
+        return []
+
+    def test_mtr(self, target=None):
+        try:
+            output = subprocess.getoutput(f"mtr -rn -c 10 --report-wide {target or self.google_dns}")
+            hops_data = []
+            for line in output.splitlines()[2:]:  # Ignorar cabeçalho
+                parts = line.split()
+                if len(parts) < 9:  # Verificar formato esperado
+                    continue
+                
+                #Extrair dados
+                raw_hop = parts[0].strip()
+                hop_match = re.match(r'(\d+)', raw_hop)
+                hop = int(hop_match.group(1)) if hop_match else None
+                # As colunas numéricas são as últimas; o host pode ter espaços
+                loss, sent, _, avg_latency, best, worst, stdev = parts[-7:]
+                host = ' '.join(parts[1:-7])
+
+                hops_data.append({
+                    "Hop": hop,
+                    "Host": None if host == '???' else host,
+                    "Sent": int(sent),
+                    "Loss": float(loss.strip('%')),
+                    "Latency": float(avg_latency),
+                    "Best": float(best),
+                    "Worst": float(worst),
+                    "StDev": float(stdev),
+                })
+
+            return hops_data
+        except Exception as e:
+            print(f"Error in MTR test: {e}")
+            return []
+
+    def get_connection_info(self, network_info=None):
+        """Get IP, ISP, Primary DNS and location information"""
+        gateway = (network_info or {}).get('Default_Gateway')
+        if gateway is None:
+            try:
+                gateway = NetworkAnalyzer()._default_gateway()
+            except OSError:
+                pass
+
+        speedtest_url = self.upload_url.rsplit('/', 1)[0]
+        connection_info = CONNECTION_INFO_CACHE.get(gateway, f"{speedtest_url}/__down?bytes=0")
+        return connection_info or {
+            'IPv4': 'Unknown',
+            'ISP': 'Unknown',
+            'Location': 'Unknown',
+            'Primary DNS': 'Unknown',
+        }
+
+    def test_bandwidth(self, duration=60, include_dns=True):
+        """Test download and upload speeds."""
+        try:
+            # Get connection info first
+            connection_info = self.get_connection_info()
+
+            # Fluxos paralelos com conexões reaproveitadas, descartando o slow start
+            engine = ThroughputEngine(
+                streams=self.bandwidth_streams, warmup_s=self.bandwidth_warmup,
+                tolerance=self.bandwidth_tolerance,
+            )
+            try:
+                download = engine.measure_download(self.download_url, duration, self.bandwidth_adaptive)
+                upload = engine.measure_upload(self.upload_url, duration, self.bandwidth_adaptive)
+            finally:
+                engine.close()
                         
             # Return all results
             results = {
                 'bandwidth': {
-                    'Download': f"{round(download_speed, 2)} Mbps",
-                    'Upload': f"{round(upload_speed, 2)} Mbps"
+                    'Download': download['aggregate_mbps'],
+                    'Upload': upload['aggregate_mbps']
+                },
+                'streams': {
+                    'count': self.bandwidth_streams,
+                    'download': download,
+                    'upload': upload,
                 },
                 'connection_info': connection_info,
-                'dns_tests': self.test_dns()
+                'dns_tests': self.test_dns() if include_dns else {}
             }
             return results
             
@@ -549,8 +2557,8 @@ class NetworkPerformanceTester:
             print(f"Error testing bandwidth: {e}")
             return {
                 'bandwidth': {
-                    'Download': 'N/A',
-                    'Upload': 'N/A'
+                    'Download': None,
+                    'Upload': None
                 },
                 'connection_info': {
                     'IPv4': 'Unknown',
@@ -565,194 +2573,759 @@ class NetworkPerformanceTester:
                 }
             }
 
-class HTMLExporter:
-    @staticmethod
-    def format_for_dashboard(
-        network_info: Dict[str, Any],
-        wifi_info: Dict[str, Any],
-        ieee_standard_info: Dict[str, Any],  # Corrigido: posição do parâmetro
-        performance_results: Dict[str, Any],
-        gateway_ping_results: Dict[str, Any],
-        mtr_results: list,
-        bandwidth_results: Dict[str, Any]
-    ) -> Dict[str, Any]:
-        """Format results for dashboard display"""
-        connection_info = bandwidth_results.get('connection_info', {})
-        bandwidth_data = bandwidth_results.get('bandwidth', {})
-        dns_tests = bandwidth_results.get('dns_tests', {})
-        
-        # Process DNS test results
-        formatted_dns_results = {
-            'DNS_Server': dns_tests.get('DNS_Server', 'Unknown'),
-            'Port_Test': {
-                'Status': dns_tests.get('Port_Test', 'Unknown'),
-                'Error': dns_tests.get('Port_Test_Error', '')
+class ProbeScheduler:
+    """
+    Executa as sondas de um ciclo respeitando dependências entre elas.
+
+    Sondas que não interferem entre si (pings, DNS, MTR, coleta de
+    informações locais) rodam em paralelo no mesmo estágio; sondas marcadas
+    como exclusivas (ex.: teste de banda, que satura o link) rodam sozinhas
+    em um estágio próprio. O tempo de parede de cada estágio e de cada sonda
+    é registrado para ser salvo junto com os resultados.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.probes = {}
+
+    def add_probe(self, name: str, func: Callable[..., Any], depends_on: Iterable[str] = (), exclusive=False):
+        """
+        Registra uma sonda. `func` recebe como argumentos nomeados os
+        resultados das sondas listadas em `depends_on`.
+        """
+        self.probes[name] = {
+            'func': func,
+            'depends_on': tuple(depends_on),
+            'exclusive': exclusive,
+        }
+
+    def _run_probe(self, name: str, results: Dict[str, Any]) -> Tuple[Any, float]:
+        probe = self.probes[name]
+        kwargs = {dep: results.get(dep) for dep in probe['depends_on']}
+        start = time.perf_counter()
+        try:
+            result = probe['func'](**kwargs)
+        except Exception as e:
+            print(f"Error running probe {name}: {e}")
+            result = None
+        return result, time.perf_counter() - start
+
+    def _ready(self, pending, done, exclusive):
+        return [
+            name for name in pending
+            if self.probes[name]['exclusive'] == exclusive
+            and all(dep in done for dep in self.probes[name]['depends_on'])
+        ]
+
+    def _run_concurrent_stage(self, pending, done, results, timings):
+        """
+        Roda as sondas não exclusivas em um pool, disparando cada uma assim
+        que suas dependências terminam, até não restar nenhuma pronta.
+        """
+        stage = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while True:
+                for name in self._ready(pending, done, exclusive=False):
+                    running[executor.submit(self._run_probe, name, results)] = name
+                    pending.remove(name)
+                    stage.append(name)
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    results[name], timings['probes'][name] = future.result()
+                    done.add(name)
+        return stage
+
+    def run(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Executa todas as sondas e retorna (resultados, tempos)."""
+        for name, probe in self.probes.items():
+            unknown = [dep for dep in probe['depends_on'] if dep not in self.probes]
+            if unknown:
+                raise ValueError(f"Probe {name} depends on unknown probes: {unknown}")
+
+        results = {}
+        timings = {'stages': [], 'probes': {}, 'cycle_time_s': None}
+        pending = list(self.probes)
+        done = set()
+        cycle_start = time.perf_counter()
+
+        while pending:
+            stage_start = time.perf_counter()
+            stage = self._run_concurrent_stage(pending, done, results, timings)
+            exclusive = False
+
+            # Sem sondas concorrentes prontas: a próxima exclusiva roda sozinha
+            if not stage:
+                ready = self._ready(pending, done, exclusive=True)
+                if not ready:
+                    raise ValueError(f"Unresolvable probe dependencies: {sorted(pending)}")
+                name = ready[0]
+                pending.remove(name)
+                results[name], timings['probes'][name] = self._run_probe(name, results)
+                done.add(name)
+                stage, exclusive = [name], True
+
+            timings['stages'].append({
+                'probes': stage,
+                'exclusive': exclusive,
+                'wall_time_s': round(time.perf_counter() - stage_start, 3),
+            })
+
+        timings['probes'] = {name: round(elapsed, 3) for name, elapsed in timings['probes'].items()}
+        timings['cycle_time_s'] = round(time.perf_counter() - cycle_start, 3)
+        return results, timings
+
+class _GroupLock:
+    """
+    Trava de leitura/escrita de um grupo de exclusão (asyncio): jobs comuns
+    do grupo rodam juntos, um job exclusivo roda sozinho. Um job exclusivo
+    esperando tem prioridade, para não ser adiado indefinidamente por jobs
+    frequentes.
+    """
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.waiting_exclusive = 0
+
+    async def acquire(self, exclusive):
+        async with self.condition:
+            if exclusive:
+                self.waiting_exclusive += 1
+                try:
+                    await self.condition.wait_for(lambda: not self.exclusive and not self.shared)
+                finally:
+                    self.waiting_exclusive -= 1
+                self.exclusive = True
+            else:
+                await self.condition.wait_for(lambda: not self.exclusive and not self.waiting_exclusive)
+                self.shared += 1
+
+    async def release(self, exclusive):
+        async with self.condition:
+            if exclusive:
+                self.exclusive = False
+            else:
+                self.shared -= 1
+            self.condition.notify_all()
+
+class JobScheduler:
+    """
+    Agendador asyncio dos jobs do agente: cadência fixa com `jitter`, timeout
+    por execução, grupos de exclusão (um job `exclusive` roda sozinho no
+    grupo) e `overrun` 'skip' ou 'delay'. No SIGINT/SIGTERM os jobs em
+    andamento têm `grace` segundos; os que passarem disso ficam em
+    `abandoned`. Um segundo sinal encerra o processo na hora.
+    """
+
+    def __init__(self, grace=30.0):
+        self.grace = grace
+        self.jobs = {}
+        self.loop = None
+        self.stopping = None
+        self.locks = {}
+        self.abandoned = []
+
+    def add_job(self, name: str, func: Callable[..., Any], interval: float, jitter=0.0, timeout=None,
+                groups: Iterable[str] = (), exclusive=False, overrun='skip', run_at_start=True):
+        if overrun not in ('skip', 'delay'):
+            raise ValueError(f"Unknown overrun policy for job {name}: {overrun}")
+        self.jobs[name] = {
+            'func': func,
+            'interval': interval,
+            'jitter': jitter,
+            'timeout': timeout,
+            'groups': tuple(sorted(set(groups))),  # ordem fixa evita deadlock entre grupos
+            'exclusive': exclusive,
+            'overrun': overrun,
+            'run_at_start': run_at_start,
+            'future': None,
+            'wake': None,
+            'request': None,
+            'stats': {
+                'runs': 0, 'failures': 0, 'timeouts': 0, 'skipped': 0, 'requested': 0,
+                'total_duration_s': 0.0, 'max_duration_s': 0.0, 'last_duration_s': None,
+                'total_delay_s': 0.0, 'max_delay_s': 0.0, 'last_error': None,
             },
-            'Resolution_Test': {
-                'Status': dns_tests.get('Resolution_Test', 'Unknown'),
-                'Error': dns_tests.get('Resolution_Test_Error', ''),
-                'Resolved_IPs': dns_tests.get('Resolved_IPs', [])
-            }
         }
-        
-        formatted_ieee_info = {}
-        if ieee_standard_info and not ieee_standard_info.get('error'):
-            formatted_ieee_info = {
-                'interface': ieee_standard_info.get('interface', 'Unknown'),
-                'highest_standard': ieee_standard_info.get('highest_standard', 'Unknown'),
-                'supported_standards': ieee_standard_info.get('supported_standards', []),
-                'supported_bands': ieee_standard_info.get('supported_bands', {}),
-                'supported_channel_widths': ieee_standard_info.get('supported_channel_widths', []),
-                'current_connection': ieee_standard_info.get('current_connection', {}),
-                'capabilities': ieee_standard_info.get('capabilities', {})
-            }
+
+    def run_now(self, name: str, **kwargs):
+        """Pede uma execução imediata de `name` (pode ser chamado de qualquer thread)."""
+        job = self.jobs[name]
+
+        def request():
+            job['request'] = kwargs
+            job['stats']['requested'] += 1
+            job['wake'].set()
+
+        if self.loop is None:
+            raise RuntimeError("Scheduler is not running")
+        self.loop.call_soon_threadsafe(request)
+
+    def stats(self):
+        """Tempos por job: execuções, falhas, timeouts, execuções perdidas, duração e atraso."""
+        result = {}
+        for name, job in self.jobs.items():
+            stats = dict(job['stats'])
+            runs = stats['runs']
+            stats['mean_duration_s'] = round(stats.pop('total_duration_s') / runs, 3) if runs else None
+            stats['mean_delay_s'] = round(stats.pop('total_delay_s') / runs, 3) if runs else None
+            stats['max_duration_s'] = round(stats['max_duration_s'], 3)
+            stats['max_delay_s'] = round(stats['max_delay_s'], 3)
+            result[name] = stats
+        return result
+
+    def stop(self):
+        if self.stopping.is_set():
+            print("Forced exit.")
+            os._exit(130)
+        print("Stopping scheduler...")
+        self.stopping.set()
+
+    async def _acquire(self, job):
+        acquired = []
+        try:
+            for group in job['groups']:
+                await self.locks[group].acquire(job['exclusive'])
+                acquired.append(group)
+        except asyncio.CancelledError:
+            await self._release(job, acquired)
+            raise
+
+    async def _release(self, job, groups=None):
+        for group in reversed(job['groups'] if groups is None else groups):
+            await self.locks[group].release(job['exclusive'])
+
+    async def _release_when_done(self, job, future):
+        # Thread que passou do timeout: os grupos continuam ocupados até ela terminar
+        try:
+            await asyncio.wait([future])
+        finally:
+            await self._release(job)
+
+    def _run_in_thread(self, name, func, kwargs):
+        """Roda `func` numa thread daemon e retorna um future do loop com o resultado."""
+        future = self.loop.create_future()
+
+        def resolve(method, value):
+            if not future.done():
+                method(value)
+
+        def target():
+            try:
+                outcome = (future.set_result, func(**kwargs))
+            except Exception as e:
+                outcome = (future.set_exception, e)
+            try:
+                self.loop.call_soon_threadsafe(resolve, *outcome)
+            except RuntimeError:
+                pass  # loop já encerrado: job abandonado depois do grace
+
+        Thread(target=target, name=f'job-{name}', daemon=True).start()
+        return future
+
+    async def _run_job(self, name, job, scheduled, kwargs):
+        stats = job['stats']
+        await self._acquire(job)
+        started = self.loop.time()
+        if asyncio.iscoroutinefunction(job['func']):
+            future = asyncio.ensure_future(job['func'](**kwargs))
         else:
-            formatted_ieee_info = {
-                'error': ieee_standard_info.get('error', 'Unable to detect IEEE standard') if ieee_standard_info else 'IEEE standard info not available'
-            }
-        
-        return {
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'network_info': network_info,
-            'wifi_info': wifi_info,
-            'ieee_standard_info': formatted_ieee_info,
-            'performance_results': performance_results,
-            'gateway_ping_results': gateway_ping_results,
-            'mtr_results': mtr_results,
-            'connection_info': connection_info,
-            'bandwidth_data': bandwidth_data,
+            future = self._run_in_thread(name, job['func'], kwargs)
+        job['future'] = future
+
+        release_now = True
+        try:
+            await asyncio.wait_for(asyncio.shield(future), job['timeout'])
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+            stats['last_error'] = f"timeout after {job['timeout']} s"
+            print(f"Job {name} timed out after {job['timeout']} s")
+            if isinstance(future, asyncio.Task):
+                future.cancel()
+            release_now = False
+        except asyncio.CancelledError:
+            if isinstance(future, asyncio.Task):
+                future.cancel()
+            release_now = False
+            raise
+        except Exception as e:
+            stats['failures'] += 1
+            stats['last_error'] = str(e)
+            print(f"Error running job {name}: {e}")
+        finally:
+            if release_now:
+                await self._release(job)
+            else:
+                asyncio.ensure_future(self._release_when_done(job, future))
+            duration = self.loop.time() - started
+            delay = max(0.0, started - scheduled)
+            stats['runs'] += 1
+            stats['last_duration_s'] = round(duration, 3)
+            stats['total_duration_s'] += duration
+            stats['max_duration_s'] = max(stats['max_duration_s'], duration)
+            stats['total_delay_s'] += delay
+            stats['max_delay_s'] = max(stats['max_delay_s'], delay)
+
+    async def _job_loop(self, name, job):
+        interval = job['interval']
+        next_time = self.loop.time() + (0.0 if job['run_at_start'] else interval)
+        jitter = 0.0 if job['run_at_start'] else job['jitter']
+        while True:
+            scheduled = next_time + random.uniform(0, jitter)
+            jitter = job['jitter']
+            try:
+                await asyncio.wait_for(job['wake'].wait(), max(0.0, scheduled - self.loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            requested = job['wake'].is_set()
+            job['wake'].clear()
+            kwargs, job['request'] = job['request'] or {}, None
+            if requested:
+                scheduled = self.loop.time()
+
+            if job['future'] is not None and not job['future'].done():
+                job['stats']['skipped'] += 1  # execução anterior (com timeout) ainda rodando
+            else:
+                await self._run_job(name, job, scheduled, kwargs)
+
+            now = self.loop.time()
+            if requested or job['overrun'] == 'delay' and next_time + interval <= now:
+                next_time = now + interval if requested else now
+                continue
+            next_time += interval
+            if next_time <= now:
+                missed = int((now - next_time) // interval) + 1
+                job['stats']['skipped'] += missed
+                next_time += missed * interval
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.locks = {group: _GroupLock() for job in self.jobs.values() for group in job['groups']}
+        for job in self.jobs.values():
+            job['wake'] = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stop)
+
+        tasks = [asyncio.ensure_future(self._job_loop(name, job)) for name, job in self.jobs.items()]
+        try:
+            await self.stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Os handlers continuam instalados durante a espera: um segundo
+            # sinal ainda encerra o processo na hora
+            running = {name: job['future'] for name, job in self.jobs.items()
+                       if job['future'] and not job['future'].done()}
+            if running:
+                print(f"Waiting up to {self.grace:.0f} s for {len(running)} running job(s)...")
+                await asyncio.wait(running.values(), timeout=self.grace)
+                self.abandoned = [name for name, future in running.items() if not future.done()]
+                if self.abandoned:
+                    print(f"Abandoning job(s) still running after {self.grace:.0f} s: {', '.join(self.abandoned)}")
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.remove_signal_handler(sig)
+
+    def run(self):
+        """Roda os jobs até SIGINT/SIGTERM e retorna as estatísticas."""
+        asyncio.run(self._main())
+        return self.stats()
+
+class ChangeDetector:
+    """
+    Detector de mudança de regime de uma métrica: CUSUM bilateral sobre o
+    resíduo em relação a uma linha de base EWMA (`alpha`), limitado a `clip`
+    desvios. `threshold` e `slack` são em desvios; `noise_floor` é o menor
+    desvio considerado, na unidade da métrica.
+    """
+
+    def __init__(self, threshold=8.0, slack=0.5, noise_floor=0.0, alpha=0.05, warmup=30,
+                 clip=3.0, freeze=0.5):
+        self.threshold = threshold
+        self.slack = slack
+        self.noise_floor = noise_floor
+        self.alpha = alpha
+        self.warmup = warmup
+        self.clip = clip
+        self.freeze = freeze
+        self.count = 0
+        self.mean = 0.0
+        self.deviation = 0.0
+        self.upper = 0.0
+        self.lower = 0.0
+        self.excursion = []
+        self.changes = 0
+
+    def scale(self):
+        # Desvio absoluto médio * sqrt(pi/2) estima o desvio padrão (normal)
+        return max(self.deviation * 1.2533, self.noise_floor, 1e-9)
+
+    def _track(self, value, scale, track_mean=True, track_scale=True):
+        """Atualiza a linha de base com o resíduo limitado a `clip` desvios."""
+        residual = min(max(value - self.mean, -self.clip * scale), self.clip * scale)
+        if track_scale:
+            self.deviation += self.alpha * (abs(residual) - self.deviation)
+        if track_mean:
+            self.mean += self.alpha * residual
+
+    def update(self, value):
+        """Acrescenta uma amostra; retorna a mudança detectada ou None."""
+        if value is None or math.isnan(value):
+            return None
+        self.count += 1
+        if self.count <= self.warmup:
+            # Linha de base: média simples das primeiras amostras do regime; o
+            # desvio só é estimado assim na partida
+            self.mean += (value - self.mean) / self.count
+            if not self.changes:
+                self.deviation += (abs(value - self.mean) - self.deviation) / self.count
+            return None
+
+        scale = self.scale()
+        limit = self.threshold / 2
+        z = min(max((value - self.mean) / scale, -limit), limit)
+        self.upper = max(0.0, self.upper + z - self.slack)
+        self.lower = max(0.0, self.lower - z - self.slack)
+
+        if not self.upper and not self.lower:
+            self.excursion = []
+        else:
+            self.excursion.append(value)
+        statistic = max(self.upper, self.lower)
+        self._track(value, scale, track_mean=statistic <= self.freeze * self.threshold,
+                    track_scale=statistic < self.threshold / 2)
+        if statistic < self.threshold:
+            return None
+
+        level = statistics.median(self.excursion)
+        change = {
+            'direction': 'up' if self.upper >= self.threshold else 'down',
+            'baseline': round(self.mean, 3),
+            'value': round(level, 3),
+            'shift': round(level - self.mean, 3),
+            'statistic': round(max(self.upper, self.lower), 2),
+            'scale': round(scale, 3),
+            'samples': len(self.excursion),
         }
+        # Novo regime: a média é reaprendida a partir das próximas amostras
+        self.changes += 1
+        self.count = 0
+        self.upper = self.lower = 0.0
+        self.excursion = []
+        return change
 
-    @staticmethod
-    def save_to_mongo(formatted_results: Dict[str, Any], db_handler: DatabaseHandler):
-        """Save formatted results to MongoDB"""
-        db_handler.save_results(formatted_results)
-        
-def execute_main_code():
+class ChangeTrigger:
+    """
+    Gatilho das medições completas: cada step() faz uma varredura barata
+    (poucos pings no gateway e/ou no alvo WAN, e o RSSI já amostrado pelo
+    SignalSampler) e passa cada métrica pelo seu ChangeDetector. Só quando
+    algum detector aponta mudança de regime a medição completa é pedida
+    (`on_change`), respeitando `cooldown`. Gateway e WAN podem ser sondados
+    em cadências diferentes, cada um pelo seu job do JobScheduler.
+
+    Cada decisão é reavaliada depois de `confirm_samples` amostras: se a
+    métrica voltou para perto da linha de base anterior, o alarme conta como
+    falso positivo. As decisões avaliadas são entregues a `recorder` e a taxa
+    de falsos positivos por métrica fica em stats(), para ajustar as
+    sensibilidades e o orçamento de sondas.
+    """
+
+    # threshold/slack em desvios; noise_floor na unidade da métrica
+    SENSITIVITIES = {
+        'gateway_latency': {'threshold': 8.0, 'slack': 0.5, 'noise_floor': 0.5},  # ms
+        # Um pacote perdido em 5 já é 20%: o piso evita que perda esporádica
+        # conte como desvio de vários sigmas
+        'gateway_loss': {'threshold': 8.0, 'slack': 0.5, 'noise_floor': 10.0},  # %
+        'wan_latency': {'threshold': 8.0, 'slack': 0.5, 'noise_floor': 2.0},  # ms
+        'wan_loss': {'threshold': 8.0, 'slack': 0.5, 'noise_floor': 10.0},  # %
+        'wifi_rssi': {'threshold': 8.0, 'slack': 0.5, 'noise_floor': 2.0},  # dBm
+    }
+
+    def __init__(self, tester, on_change, recorder=None, count=5, probe_interval=0.2,
+                 cooldown=300.0, confirm_samples=6, thresholds=None):
+        self.tester = tester
+        self.analyzer = NetworkAnalyzer()
+        self.on_change = on_change
+        self.recorder = recorder
+        self.count = count
+        self.probe_interval = probe_interval
+        self.cooldown = cooldown
+        self.confirm_samples = confirm_samples
+        thresholds = CHANGE_THRESHOLDS if thresholds is None else thresholds
+        self.detectors = {
+            metric: ChangeDetector(**{**sensitivity, 'threshold': thresholds.get(metric, sensitivity['threshold'])})
+            for metric, sensitivity in self.SENSITIVITIES.items()
+        }
+        self.pending = []
+        self.last_run = None
+        self.rssi_since = time.monotonic()
+        self.probes = 0
+        self.lock = Lock()
+        self.counters = {
+            metric: {'alarms': 0, 'measured': 0, 'suppressed': 0, 'evaluated': 0, 'false_positives': 0}
+            for metric in self.detectors
+        }
+
+    def measure(self, roles=('gateway', 'wan', 'wifi')):
+        """
+        Varredura barata das métricas de `roles` (gateway, wan, wifi); métricas
+        indisponíveis ficam como None.
+        """
+        targets = {}
+        if 'gateway' in roles:
+            targets['gateway'] = (self.analyzer.get_network_info() or {}).get('Default_Gateway')
+        if 'wan' in roles:
+            targets['wan'] = self.tester.google_dns
+        pings = self.tester.multi_prober.sweep(
+            [target for target in targets.values() if target], self.count, self.probe_interval,
+            use_socket=self.tester.ping_backend != 'subprocess',
+        )
+
+        metrics = {}
+        for role, target in targets.items():
+            ping = pings.get(target) if target else None
+            # Mediana em vez da média: uma sonda atrasada não move a métrica
+            metrics[f'{role}_latency'] = statistics.median(ping['times']) if ping and ping['times'] else None
+            metrics[f'{role}_loss'] = ping['packet_loss'] if ping else None
+        if 'wifi' in roles and SIGNAL_SAMPLER.running:
+            now = time.monotonic()
+            metrics['wifi_rssi'] = SIGNAL_SAMPLER.stats(self.rssi_since)['rssi_mean']
+            self.rssi_since = now
+        return metrics
+
+    def _evaluate(self, metric, value):
+        """Confirma ou descarta os alarmes pendentes desta métrica."""
+        for decision in [d for d in self.pending if d['metric'] == metric]:
+            decision['confirmation_samples'].append(value)
+            if len(decision['confirmation_samples']) < self.confirm_samples:
+                continue
+            self.pending.remove(decision)
+            level = statistics.median(decision['confirmation_samples'])
+            decision['confirmation_level'] = round(level, 3)
+            decision['false_positive'] = abs(level - decision['baseline']) < abs(level - decision['value'])
+            counters = self.counters[metric]
+            counters['evaluated'] += 1
+            counters['false_positives'] += decision['false_positive']
+            if self.recorder:
+                self.recorder(decision)
+
+    def step(self, roles=('gateway', 'wan', 'wifi')):
+        """Uma varredura: atualiza os detectores e pede a medição se preciso."""
+        metrics = self.measure(roles)
+        with self.lock:
+            self.probes += 1
+            changes = []
+            for metric, value in metrics.items():
+                if value is None:
+                    continue
+                self._evaluate(metric, value)
+                change = self.detectors[metric].update(value)
+                if change:
+                    changes.append({'metric': metric, **change})
+
+            if not changes:
+                return None
+
+            now = time.monotonic()
+            measure = self.last_run is None or now - self.last_run >= self.cooldown
+            action = 'measure' if measure else 'suppressed'
+            for change in changes:
+                print(f"Change detected in {change['metric']}: {change['baseline']} -> {change['value']} ({action})")
+                counters = self.counters[change['metric']]
+                counters['alarms'] += 1
+                counters['measured' if measure else 'suppressed'] += 1
+                self.pending.append({
+                    'timestamp': datetime.now(),
+                    **change,
+                    'action': action,
+                    'confirmation_samples': [],
+                })
+
+            if not measure:
+                return None
+            self.last_run = now
+            info = {'changes': changes, 'stats': self.stats()}
+        return self.on_change(info)
+
+    def stats(self):
+        """Contadores por métrica e taxa de falsos positivos dos alarmes já avaliados."""
+        metrics = {}
+        for metric, counters in self.counters.items():
+            rate = counters['false_positives'] / counters['evaluated'] if counters['evaluated'] else None
+            metrics[metric] = {**counters, 'false_positive_rate': round(rate, 3) if rate is not None else None}
+        return {'probes': self.probes, 'metrics': metrics}
+
+def check_detectors(samples=2000, step=3.0, max_alarms=1, max_delay=20, seed=0, thresholds=None):
+    """
+    Verifica as sensibilidades de ChangeTrigger em ruído sintético: para cada
+    métrica, `samples` amostras normais estacionárias (desvio de duas vezes o
+    piso de ruído) não podem gerar mais que `max_alarms` alarmes, e um degrau
+    de `step` desvios em seguida tem de ser detectado em até `max_delay`
+    amostras. Retorna a lista de falhas (vazia se tudo passou).
+    """
+    thresholds = CHANGE_THRESHOLDS if thresholds is None else thresholds
+    failures = []
+    for metric, sensitivity in ChangeTrigger.SENSITIVITIES.items():
+        detector = ChangeDetector(**{**sensitivity, 'threshold': thresholds.get(metric, sensitivity['threshold'])})
+        rng = random.Random(seed)
+        sd = 2 * sensitivity['noise_floor']
+        baseline = 10 * sd
+        alarms = sum(1 for _ in range(samples) if detector.update(rng.gauss(baseline, sd)))
+        delay = next((i for i in range(max_delay) if detector.update(rng.gauss(baseline + step * sd, sd))), None)
+        print(f"{metric}: {alarms} alarms in {samples} stationary samples, "
+              f"{step:g}-sigma step detected after {'-' if delay is None else delay + 1} samples")
+        if alarms > max_alarms:
+            failures.append(f"{metric}: {alarms} false alarms in {samples} stationary samples")
+        if delay is None:
+            failures.append(f"{metric}: {step:g}-sigma step not detected within {max_delay} samples")
+    return failures
+
+def execute_main_code(trigger=None):
     # Instanciar as classes necessárias
     analyzer = NetworkAnalyzer()
     wifi_analyzer = WifiAnalyzer()
     tester = NetworkPerformanceTester()
-    db_handler = DatabaseHandler()
-
-    # Executar os testes de rede
-    performance_results = tester.test_ping()
-    gateway_ping_results = tester.test_gateway_ping()
-    mtr_results = tester.test_mtr()
-    bandwidth_results = tester.test_bandwidth()
+    db_handler = DatabaseHandler.shared()
 
-    # Garantir que dns_results seja sempre definido
-    dns_results = {}
+    # Executar os testes de rede: sondas independentes rodam em paralelo,
+    # o teste de banda roda sozinho para não contaminar as demais medições
+    scheduler = ProbeScheduler()
+    scheduler.add_probe('network_info', analyzer.get_network_info)
+    scheduler.add_probe('wifi_info', wifi_analyzer.get_connected_wifi_info)
+    scheduler.add_probe('ieee_standard_info', wifi_analyzer.get_ieee_standard)
+    scheduler.add_probe('target_results', tester.test_targets, depends_on=['network_info'])
+    scheduler.add_probe('path_results', tester.test_paths)
+    scheduler.add_probe('dns_results', tester.test_dns, depends_on=['network_info'])
+    scheduler.add_probe(
+        'bandwidth_results', lambda: tester.test_bandwidth(include_dns=False), exclusive=True
+    )
+    probe_results, cycle_timings = scheduler.run()
+    print(f"Cycle completed in {cycle_timings['cycle_time_s']:.1f} s")
 
-    try:
-        dns_results = tester.test_dns()
-        if dns_results is None:  # Caso a função retorne None, definir como dicionário vazio
-            dns_results = {}
-    except Exception as e:
-        print(f"Erro ao testar DNS: {e}")
-        dns_results = {}
+    network_info = probe_results['network_info']
+    wifi_info = probe_results['wifi_info'] or {}
+    ieee_standard_info = probe_results['ieee_standard_info']
+    # Gateway e Google DNS saem da mesma varredura multi-alvo
+    target_results = probe_results['target_results'] or []
+    performance_results = tester.target_result(target_results, 'wan', tester.google_dns)
+    if performance_results and performance_results['Avg'] is None:
+        performance_results = None
+    gateway_ping_results = tester.target_result(target_results, 'gateway')
+    if gateway_ping_results:
+        gateway_ping_results = {'Gateway': network_info['Default_Gateway'], **gateway_ping_results}
+    path_results = probe_results['path_results'] or []
+    mtr_results = tester.path_hops(path_results, tester.google_dns)
+    bandwidth_results = probe_results['bandwidth_results'] or {}
 
     # Adicionar os resultados do DNS ao dicionário de bandwidth_results
-    bandwidth_results['dns_tests'] = dns_results
-
-    # Obter informações da rede
-    network_info = analyzer.get_network_info()
-    wifi_info = wifi_analyzer.get_connected_wifi_info()
-    
-    # NOVO: Obter informações do padrão IEEE 802.11
-    ieee_standard_info = wifi_analyzer.get_ieee_standard()  # Corrigido para wifi_analyzer
+    bandwidth_results['dns_tests'] = probe_results['dns_results'] or {}
 
     # Consolidar resultados
     results = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": datetime.now(),
         "network_info": network_info,
         "wifi_info": wifi_info,
         "ieee_standard_info": ieee_standard_info,
         "performance_results": performance_results,
         "gateway_ping_results": gateway_ping_results,
+        "target_results": target_results,
         "mtr_results": mtr_results,
-        "bandwidth_results": bandwidth_results  # Agora inclui os testes de DNS
+        "path_results": path_results,
+        "bandwidth_results": bandwidth_results,  # Agora inclui os testes de DNS
+        "cycle_timings": cycle_timings
     }
 
-    # Salvar os resultados no banco de dados
-    db_handler.save_results(results)
+    # Mudanças de regime que dispararam este ciclo (ver ChangeTrigger)
+    if trigger:
+        results["trigger"] = trigger
 
-    # Formatar os resultados para o dashboard
-    formatted_results = HTMLExporter.format_for_dashboard(
-        network_info, wifi_info, ieee_standard_info, performance_results, gateway_ping_results, mtr_results, bandwidth_results
-    )
-    HTMLExporter.save_to_mongo(formatted_results, db_handler)
+    # Estatísticas do sinal amostrado continuamente desde o ciclo anterior
+    if SIGNAL_SAMPLER.running:
+        results["wifi_signal_stats"] = SIGNAL_SAMPLER.interval_stats()
+
+    # Salvar os resultados no banco de dados (um documento por ciclo, gravado
+    # em segundo plano; o formato do dashboard é montado na leitura)
+    db_handler.save_results(results)
 
     # Retornar a latência média para monitoramento
-    return float(performance_results["Avg"].split()[0]) if performance_results else None
+    return performance_results["Avg"] if performance_results else None
 
-def background_ping_monitor(last_latency):
-    tester = NetworkPerformanceTester()
-    analyzer = NetworkAnalyzer()
-    db_handler = DatabaseHandler()
-    
-    # Get initial gateway ping results
-    gateway_results = tester.test_gateway_ping()
-    last_gateway_latency = float(gateway_results["Avg"].split()[0]) if gateway_results else None
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Network Analyzer")
+    parser.add_argument('--migrate-schema', action='store_true',
+                        help="migra os documentos antigos para o esquema numérico e sai")
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help="reconstrói os rollups por minuto/hora a partir do histórico e sai")
+    parser.add_argument('--remove-dashboard-copies', action='store_true',
+                        help="remove os documentos duplicados no formato do dashboard e sai")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="tamanho do lote usado na migração e na reconstrução dos rollups")
+    parser.add_argument('--check-detectors', action='store_true',
+                        help="verifica os detectores de mudança em ruído sintético e sai")
+    args = parser.parse_args()
 
-    while True:
-        time.sleep(60)  # Changed to 60-second interval
-        print("Running gateway ping test...")
-        
-        # Test gateway latency first
-        new_gateway_results = tester.test_gateway_ping()
-        if not new_gateway_results or "Avg" not in new_gateway_results:
-            print("LAN ping test failed or no average latency available.")
-            continue
-            
-        new_gateway_latency = float(new_gateway_results["Avg"].split()[0])
-        print(f"New LAN latency: {new_gateway_latency} ms (Last: {last_gateway_latency} ms)")
+    if args.check_detectors:
+        failures = check_detectors()
+        for failure in failures:
+            print(f"FAIL {failure}")
+        raise SystemExit(1 if failures else 0)
 
-        # Calculate gateway latency variation
-        gateway_variation = abs(new_gateway_latency - last_gateway_latency) / last_gateway_latency if last_gateway_latency else 0
+    if args.migrate_schema or args.rebuild_rollups or args.remove_dashboard_copies:
+        # Manutenção roda sempre no MongoDB local, mesmo num agente que envia
+        # os resultados a um coletor
+        db_handler = DatabaseHandler(ingest_url=None)
+        if args.remove_dashboard_copies:
+            db_handler.remove_dashboard_copies()
+        if args.migrate_schema:
+            db_handler.migrate_numeric_schema(batch_size=args.batch_size)
+        if args.rebuild_rollups:
+            db_handler.rebuild_rollups(batch_size=args.batch_size)
+        raise SystemExit(0)
 
-        # Only proceed with WAN test if gateway variation exceeds threshold
-        if gateway_variation >= 0.1:
-            print("Gateway latency variation exceeds 10%. Testing WAN latency...")
-            
-            # Test internet latency
-            new_results = tester.test_ping()
-            if not new_results or "Avg" not in new_results:
-                print("WAN ping test failed or no average latency available.")
-                continue
-            
-            new_latency = float(new_results["Avg"].split()[0])
-            print(f"New WAN latency: {new_latency} ms (Last: {last_latency} ms)")
-
-            # Calculate internet latency variation
-            internet_variation = abs(new_latency - last_latency) / last_latency if last_latency else 0
-
-            # Only re-execute main code if both variations exceed threshold
-            if internet_variation >= 0.1:
-                print("Both Gateway and WAN latency variations exceed 10%. Re-executing main code.")
-                last_latency = execute_main_code()  # Update both latencies after re-execution
-                gateway_results = tester.test_gateway_ping()
-                last_gateway_latency = float(gateway_results["Avg"].split()[0]) if gateway_results else None
-            else:
-                print("WAN latency variation within acceptable range. Continuing monitoring.")
-                last_latency = new_latency
-                last_gateway_latency = new_gateway_latency
-        else:
-            print("Gateway latency variation within acceptable range. Continuing monitoring.")
-            last_gateway_latency = new_gateway_latency
+    scheduler = JobScheduler()
+    change_trigger = ChangeTrigger(
+        NetworkPerformanceTester(),
+        on_change=lambda info: scheduler.run_now('full_cycle', trigger=info),
+        recorder=DatabaseHandler.shared().record_decision,
+        cooldown=float(os.environ.get('NETWORK_ANALYZER_MEASURE_COOLDOWN', 300)),
+    )
 
-if __name__ == "__main__":
-    # Executar o código principal inicialmente
-    last_latency = execute_main_code()
+    def full_cycle(trigger=None):
+        execute_main_code(trigger=trigger)
+        change_trigger.last_run = time.monotonic()  # conta para o cooldown do gatilho
 
-    # Iniciar a thread de monitoramento em segundo plano
-    monitor_thread = Thread(target=background_ping_monitor, args=(last_latency,))
-    monitor_thread.daemon = True  # Permitir que o programa principal finalize a thread
-    monitor_thread.start()
+    gateway_interval = float(os.environ.get('NETWORK_ANALYZER_PROBE_INTERVAL', 10))
+    wan_interval = float(os.environ.get('NETWORK_ANALYZER_WAN_INTERVAL', 60))
+    cycle_interval = float(os.environ.get('NETWORK_ANALYZER_CYCLE_INTERVAL', 3600))
 
-    # Manter o programa em execução
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("Exiting...")
+    # Amostragem do sinal: local, roda na sua própria thread (inclusive
+    # durante o teste de banda) em vez de um job a 10 Hz no agendador. O
+    # buffer cobre o intervalo entre ciclos mais o timeout do ciclo
+    SIGNAL_SAMPLER.start(window_s=cycle_interval + 900)
+    # Sondas baratas do gatilho de mudança de regime
+    scheduler.add_job('gateway_check', lambda: change_trigger.step(roles=('gateway', 'wifi')),
+                      interval=gateway_interval, jitter=gateway_interval / 10, timeout=30, groups=['network'])
+    scheduler.add_job('wan_latency', lambda: change_trigger.step(roles=('wan',)),
+                      interval=wan_interval, jitter=wan_interval / 10, timeout=30, groups=['network'])
+    # Ciclo completo (inclui o teste de banda): sozinho na rede, periódico e
+    # também disparado pelo gatilho
+    scheduler.add_job('full_cycle', full_cycle, interval=cycle_interval, jitter=cycle_interval / 60,
+                      timeout=900, groups=['network'], exclusive=True)
+
+    stats = scheduler.run()
+    SIGNAL_SAMPLER.stop()
+    print("Exiting...")
+    for name, job_stats in stats.items():
+        print(f"  {name}: {job_stats}")
+    if scheduler.abandoned:
+        # A saída normal esperaria as threads dos jobs presos: grava as filas
+        # (handlers do atexit) e sai sem esperar
+        atexit._run_exitfuncs()
+        os._exit(1)
@@ -0,0 +1,357 @@
+"""
+Esquema dos documentos de resultados compartilhado pelo analisador e pelo
+dashboard: conversão das medições para o formato numérico, índices, rollups
+com sketches de quantis e as amostras binárias de RTT.
+"""
+import math
+import os
+import socket
+import struct
+import numpy as np
+from datetime import datetime
+from typing import Dict, Any, Iterable
+
+# Versão do esquema dos documentos: a partir da 2 as medições são numéricas,
+# a partir da 3 o timestamp é um datetime nativo do BSON e a partir da 4
+# `units` é aninhado como o documento (sem pontos nos nomes de campo)
+SCHEMA_VERSION = 4
+
+# Retenção opcional dos dados brutos (índice TTL em `timestamp`), em dias
+RAW_RETENTION_DAYS = float(os.environ.get('NETWORK_ANALYZER_RETENTION_DAYS', 0)) or None
+
+# Unidade de cada campo numérico, por seção do documento
+FIELD_UNITS = {
+    'performance_results': {'Min': 'ms', 'Max': 'ms', 'Avg': 'ms', 'Packet Loss': '%'},
+    'gateway_ping_results': {'Min': 'ms', 'Max': 'ms', 'Avg': 'ms', 'Packet Loss': '%'},
+    'target_results': {'Min': 'ms', 'Max': 'ms', 'Avg': 'ms', 'Packet Loss': '%'},
+    'wifi_info': {'Frequency': 'GHz', 'RSSI': 'dBm', 'Channel Width': 'MHz', 'TX Bitrate': 'Mbps', 'RX Bitrate': 'Mbps'},
+    'wifi_signal_stats': {
+        'rssi_min': 'dBm', 'rssi_mean': 'dBm', 'rssi_p5': 'dBm', 'rssi_p95': 'dBm', 'dip_threshold': 'dBm',
+        'noise_mean': 'dBm', 'bitrate_min': 'Mbps', 'bitrate_mean': 'Mbps', 'window_s': 's',
+    },
+    'mtr_results': {'Loss': '%', 'Latency': 'ms', 'Best': 'ms', 'Worst': 'ms', 'StDev': 'ms'},
+    'bandwidth_results.bandwidth': {'Download': 'Mbps', 'Upload': 'Mbps'},
+    'bandwidth_data': {'Download': 'Mbps', 'Upload': 'Mbps'},
+}
+
+def parse_measurement(value):
+    """
+    Converte uma medição para float. Aceita números e o formato texto dos
+    documentos antigos ("12.34 ms", "0.0 %", "-55 dBm"); "N/A"/"Unknown"
+    viram None.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace('%', ' ').split()[0])
+        except (ValueError, IndexError):
+            return None
+    return None
+
+def _get_section(document, path):
+    for key in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+def nested_units() -> Dict[str, Any]:
+    """FIELD_UNITS no formato gravado em `units`: um nível por seção do caminho."""
+    units = {}
+    for path, fields in FIELD_UNITS.items():
+        *parents, leaf = path.split('.')
+        section = units
+        for key in parents:
+            section = section.setdefault(key, {})
+        section[leaf] = dict(fields)
+    return units
+
+def section_units(units: Dict[str, Any], path: str) -> Dict[str, str]:
+    """Unidades de uma seção; aceita também a chave com pontos do esquema 3."""
+    return _get_section(units, path) or (units or {}).get(path) or {}
+
+def to_numeric_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converte (in place) os campos de medição de um documento para o esquema
+    numérico, o timestamp para datetime, e registra as unidades em `units`.
+    É idempotente, servindo tanto para novos documentos quanto para a
+    migração dos antigos.
+    """
+    if 'timestamp' in document:
+        document['timestamp'] = as_datetime(document['timestamp']) or document['timestamp']
+
+    for path, fields in FIELD_UNITS.items():
+        section = _get_section(document, path)
+        entries = section if isinstance(section, list) else [section]
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            for field in fields:
+                if field in entry:
+                    entry[field] = parse_measurement(entry[field])
+            if isinstance(entry.get('Hop'), str):
+                entry['Hop'] = int(entry['Hop']) if entry['Hop'].isdigit() else None
+
+    document['schema_version'] = SCHEMA_VERSION
+    document['units'] = nested_units()
+    return document
+
+# Métricas consolidadas nos rollups: nome -> campo de origem no documento
+METRIC_FIELDS = {
+    "gateway_latency": "gateway_ping_results.Avg",
+    "wifi_signal": "wifi_info.RSSI",
+    "internet_latency": "performance_results.Avg",
+    "download_speed": "bandwidth_results.bandwidth.Download",
+    "upload_speed": "bandwidth_results.bandwidth.Upload",
+    "gateway_packet_loss": "gateway_ping_results.Packet Loss",
+    "internet_packet_loss": "performance_results.Packet Loss",
+}
+
+# Erro relativo máximo dos quantis estimados pelos sketches dos rollups
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Granularidades dos rollups: nome -> função que trunca o timestamp
+ROLLUP_GRANULARITIES = {
+    "minute": lambda ts: ts.replace(second=0, microsecond=0),
+    "hour": lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+}
+
+HOSTNAME = socket.gethostname()
+
+def as_datetime(value):
+    """Converte o timestamp de um documento (texto ou datetime) para datetime."""
+    if isinstance(value, datetime):
+        return value
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def extract_metrics(document: Dict[str, Any]) -> Dict[str, float]:
+    """Retorna as métricas numéricas presentes em um documento de resultados."""
+    metrics = {}
+    for metric, path in METRIC_FIELDS.items():
+        value = parse_measurement(_get_section(document, path))
+        if value is not None:
+            metrics[metric] = value
+    return metrics
+
+class DDSketch:
+    """
+    Sketch de quantis com erro relativo garantido (DDSketch). Os valores são
+    contados em bins logarítmicos, então dois sketches se combinam somando
+    os contadores bin a bin, o que permite mantê-los no MongoDB com $inc.
+    """
+
+    # Valores com módulo abaixo deste limite caem no contador de zeros
+    MIN_INDEXABLE = 1e-9
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+
+    def key(self, value):
+        """Índice do bin de um valor positivo."""
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def bin_of(self, value):
+        """Retorna (store, índice) do bin de `value`: 'pos', 'neg' ou 'zero'."""
+        if value > self.MIN_INDEXABLE:
+            return 'pos', self.key(value)
+        if value < -self.MIN_INDEXABLE:
+            return 'neg', self.key(-value)
+        return 'zero', None
+
+    def add(self, value, weight=1):
+        store, index = self.bin_of(value)
+        if store == 'zero':
+            self.zero += weight
+        else:
+            bins = self.positive if store == 'pos' else self.negative
+            bins[index] = bins.get(index, 0) + weight
+        self.count += weight
+
+    def merge(self, other: 'DDSketch'):
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """Estimativa do quantil `q` (0-1), ou None se o sketch estiver vazio."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+
+        # Ordem crescente: negativos (do maior módulo ao menor), zero, positivos
+        cumulative = 0
+        for index in sorted(self.negative, reverse=True):
+            cumulative += self.negative[index]
+            if cumulative > rank:
+                return -self._value(index)
+        cumulative += self.zero
+        if cumulative > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            cumulative += self.positive[index]
+            if cumulative > rank:
+                return self._value(index)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def to_dict(self):
+        return {
+            'pos': {str(index): count for index, count in self.positive.items()},
+            'neg': {str(index): count for index, count in self.negative.items()},
+            'zero': self.zero,
+        }
+
+    @classmethod
+    def from_dict(cls, data, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        sketch = cls(relative_accuracy)
+        data = data or {}
+        sketch.positive = {int(index): count for index, count in data.get('pos', {}).items()}
+        sketch.negative = {int(index): count for index, count in data.get('neg', {}).items()}
+        sketch.zero = data.get('zero', 0)
+        sketch.count = sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zero
+        return sketch
+
+def merge_rollups(rollups: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Combina documentos de rollup em estatísticas por métrica: count, sum,
+    min, max, o sketch de quantis e o valor mais recente. Com vários hosts ou
+    SSIDs no mesmo intervalo, o valor mais recente é o do rollup com o maior
+    `last_timestamp`, independente da ordem dos documentos.
+    """
+    merged = {}
+    latest = {}
+    for rollup in rollups:
+        last = rollup.get('last', {})
+        last_timestamp = rollup.get('last_timestamp') or rollup.get('bucket')
+        for metric, stats in rollup.get('metrics', {}).items():
+            current = merged.setdefault(metric, {
+                'count': 0, 'sum': 0.0, 'min': None, 'max': None, 'sketch': DDSketch(), 'current': None
+            })
+            current['count'] += stats.get('count', 0)
+            current['sum'] += stats.get('sum', 0.0)
+            if stats.get('min') is not None:
+                current['min'] = stats['min'] if current['min'] is None else min(current['min'], stats['min'])
+            if stats.get('max') is not None:
+                current['max'] = stats['max'] if current['max'] is None else max(current['max'], stats['max'])
+            current['sketch'].merge(DDSketch.from_dict(stats.get('sketch')))
+            if last.get(metric) is not None and (
+                    metric not in latest or last_timestamp is None or last_timestamp >= latest[metric]):
+                current['current'] = last[metric]
+                latest[metric] = last_timestamp
+    return merged
+
+def ensure_indexes(collection, retention_days=None):
+    """
+    Garante os índices usados pelas consultas de "último resultado" e por
+    intervalo de tempo. Com `retention_days`, o índice de `timestamp` vira
+    um índice TTL que expira os dados brutos (os rollups são mantidos).
+    """
+    timestamp_options = {'name': 'timestamp_1'}
+    if retention_days:
+        timestamp_options['expireAfterSeconds'] = int(retention_days * 86400)
+
+    # Só mexe no índice existente se o TTL dele for outro; erros de acesso,
+    # cota ou estado do replica set sobem para quem chamou
+    existing = collection.index_information().get('timestamp_1')
+    expire = timestamp_options.get('expireAfterSeconds')
+    if existing is None:
+        collection.create_index([('timestamp', 1)], **timestamp_options)
+    elif existing.get('expireAfterSeconds') != expire:
+        if expire:
+            collection.database.command(
+                'collMod', collection.name, index={'name': 'timestamp_1', 'expireAfterSeconds': expire}
+            )
+        else:
+            collection.drop_index('timestamp_1')
+            collection.create_index([('timestamp', 1)], **timestamp_options)
+
+    collection.create_index([('wifi_info.SSID', 1), ('timestamp', 1)])
+    # Filtro por agente no dashboard coletor (vários hosts na mesma coleção)
+    collection.create_index([('host', 1), ('timestamp', 1)])
+
+def pack_rtt_samples(rtts, lost_seq, sent):
+    """
+    Empacota as amostras de um teste de ping em campos binários compactos:
+    RTTs em float32 little-endian (ms) e sequências perdidas em uint16.
+    """
+    return {
+        'rtt_ms': struct.pack(f'<{len(rtts)}f', *rtts),
+        'lost_seq': struct.pack(f'<{len(lost_seq)}H', *(seq & 0xFFFF for seq in lost_seq)),
+        'sent': sent,
+    }
+
+class RttSamples:
+    """
+    Leitor vetorizado (NumPy) das amostras gravadas por `pack_rtt_samples`,
+    para calcular percentis, jitter (RFC 3550), histogramas e rajadas de
+    perda depois do teste.
+    """
+
+    def __init__(self, samples: Dict[str, Any]):
+        samples = samples or {}
+        self.rtt = np.frombuffer(samples.get('rtt_ms', b''), dtype='<f4').astype(np.float64)
+        self.lost_seq = np.frombuffer(samples.get('lost_seq', b''), dtype='<u2').astype(np.int64)
+        self.sent = samples.get('sent', len(self.rtt) + len(self.lost_seq))
+
+    def percentile(self, p):
+        return float(np.percentile(self.rtt, p)) if len(self.rtt) else None
+
+    def jitter(self):
+        """
+        Jitter da RFC 3550 (J += (|D| - J) / 16) sobre RTTs consecutivos,
+        calculado de forma fechada: soma de |D| ponderada por (15/16)^k / 16.
+        """
+        deltas = np.abs(np.diff(self.rtt))
+        if not len(deltas):
+            return None
+        weights = (15 / 16) ** np.arange(len(deltas) - 1, -1, -1) / 16
+        return float(np.dot(weights, deltas))
+
+    def histogram(self, bins=20):
+        if not len(self.rtt):
+            return {'edges': [], 'counts': []}
+        counts, edges = np.histogram(self.rtt, bins=bins)
+        return {'edges': edges.round(3).tolist(), 'counts': counts.tolist()}
+
+    def loss_bursts(self):
+        """Tamanhos das rajadas de perda (sequências perdidas consecutivas)."""
+        if not len(self.lost_seq):
+            return []
+        breaks = np.flatnonzero(np.diff(self.lost_seq) != 1) + 1
+        bounds = np.concatenate(([0], breaks, [len(self.lost_seq)]))
+        return np.diff(bounds).tolist()
+
+    def summary(self):
+        bursts = self.loss_bursts()
+        return {
+            'sent': self.sent,
+            'received': int(len(self.rtt)),
+            'loss_pct': round(100 * len(self.lost_seq) / self.sent, 2) if self.sent else None,
+            'mean': float(self.rtt.mean()) if len(self.rtt) else None,
+            'stdev': float(self.rtt.std()) if len(self.rtt) else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'jitter': self.jitter(),
+            'loss_bursts': len(bursts),
+            'max_loss_burst': max(bursts) if bursts else 0,
+        }
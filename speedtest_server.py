@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Servidor local de teste de banda com o mesmo contrato do speed.cloudflare.com
+usado pelo NetworkPerformanceTester:
+
+    GET  /__down?bytes=N   devolve N bytes
+    POST /__up             consome o corpo e responde 200
+
+Serve para medir o analisador offline e de forma reprodutível (ver
+benchmark_netns.py). Aponte o analisador para ele com:
+
+    export NETWORK_ANALYZER_SPEEDTEST_URL=http://127.0.0.1:8080
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Bloco enviado repetidamente nas respostas de download
+BLOCK_SIZE = 1 << 20
+MAX_DOWNLOAD_BYTES = 10 * 1000 ** 3
+
+
+class SpeedTestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, como o servidor real
+    block = memoryview(bytes(BLOCK_SIZE))
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # cliente interrompeu um fluxo no fim da medição
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/__down':
+            self._send_empty(404)
+            return
+        try:
+            remaining = int(parse_qs(url.query).get('bytes', ['0'])[0])
+        except ValueError:
+            self._send_empty(400)
+            return
+        remaining = max(0, min(remaining, MAX_DOWNLOAD_BYTES))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(remaining))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        try:
+            while remaining > 0:
+                size = min(remaining, BLOCK_SIZE)
+                self.wfile.write(self.block[:size])
+                remaining -= size
+        except (BrokenPipeError, ConnectionResetError):
+            # O cliente encerra o fluxo quando a medição termina
+            self.close_connection = True
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/__up':
+            self._send_empty(404)
+            return
+        remaining = int(self.headers.get('Content-Length') or 0)
+        buffer = bytearray(BLOCK_SIZE)
+        view = memoryview(buffer)
+        try:
+            while remaining > 0:
+                received = self.rfile.readinto(view[:min(remaining, BLOCK_SIZE)])
+                if not received:
+                    self.close_connection = True
+                    return
+                remaining -= received
+        except ConnectionResetError:
+            self.close_connection = True
+            return
+        self._send_empty(200)
+
+
+class SpeedTestServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local de teste de banda")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    server = SpeedTestServer((args.host, args.port), SpeedTestHandler)
+    print(f"Speed test server listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
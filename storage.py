@@ -0,0 +1,453 @@
+"""
+Gravação dos resultados, compartilhada pelo analisador e pelo dashboard
+coletor: MongoDB com rollups idempotentes, fila de gravação em segundo plano
+e envio em lotes para o `POST /api/ingest` de um coletor.
+"""
+import atexit
+import gzip
+import os
+import time
+import requests
+from collections import deque
+from typing import Dict, Any
+from bson import ObjectId, json_util
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import (
+    BulkWriteError, ConnectionFailure, ExecutionTimeout, PyMongoError, WriteConcernError
+)
+from threading import Condition, Lock, Thread
+
+from schema import (
+    FIELD_UNITS, HOSTNAME, METRIC_FIELDS, RAW_RETENTION_DAYS, ROLLUP_GRANULARITIES, SCHEMA_VERSION,
+    DDSketch, as_datetime, ensure_indexes, extract_metrics, to_numeric_document
+)
+
+INGEST_URL = os.environ.get('NETWORK_ANALYZER_INGEST_URL')
+
+def is_transient(error):
+    """Erros em que vale repetir o lote: rede, failover do MongoDB ou coletor indisponível."""
+    if isinstance(error, (ConnectionFailure, ExecutionTimeout, WriteConcernError, requests.RequestException)):
+        return True
+    if isinstance(error, BulkWriteError):
+        return bool(error.details.get('writeConcernErrors'))
+    return isinstance(error, PyMongoError) and error.has_error_label('RetryableWriteError')
+
+def insert_unordered(collection, documents):
+    """
+    insert_many não ordenado em que `_id` duplicado conta como gravado: o
+    documento já entrou numa tentativa anterior do mesmo lote. Retorna as
+    mensagens dos documentos recusados pelo servidor (ex.: validação), que
+    não adianta repetir; os demais documentos do lote são gravados.
+    """
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if is_transient(e):
+            raise
+        return [
+            f"{documents[error['index']].get('_id')}: {error.get('errmsg')}"
+            for error in e.details.get('writeErrors', []) if error.get('code') != 11000
+        ]
+    return []
+
+def write_isolating(write, batch):
+    """
+    Grava o lote com `write` e retorna as mensagens dos documentos recusados.
+    Se um erro não transitório escapar de `write` (ex.: InvalidDocument),
+    grava documento a documento para recusar só os que falham; erros
+    transitórios sobem para quem chamou repetir. Repetir é seguro porque os
+    `_id` já estão atribuídos.
+    """
+    try:
+        return write(batch) or []
+    except Exception as e:
+        if is_transient(e):
+            raise
+        if len(batch) == 1:
+            return [f"{batch[0].get('_id')}: {type(e).__name__}: {e}"]
+    rejected = []
+    for document in batch:
+        rejected += write_isolating(write, [document])
+    return rejected
+
+class WriteBehindQueue:
+    """
+    Fila de gravação em segundo plano: o ciclo de testes só enfileira o
+    documento e uma thread grava em lotes com `write` (no MongoDB local ou
+    no coletor HTTP). Se o destino estiver lento ou fora do ar, o lote é
+    repetido com backoff exponencial sem bloquear as sondas. `write(batch)`
+    retorna as mensagens dos documentos recusados de vez; esses, e os que
+    levantam erros não transitórios (ex.: InvalidDocument), são registrados
+    e descartados em vez de travar a fila. Com a fila cheia, os documentos
+    mais antigos são descartados.
+    """
+
+    def __init__(self, write, name, batch_size=100, max_size=1000, max_backoff=60.0):
+        self.write = write
+        self.name = name
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.max_backoff = max_backoff
+        self.pending = deque()
+        self.condition = Condition()
+        self.writing = False
+        self.dropped = 0
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, document: Dict[str, Any]):
+        with self.condition:
+            if len(self.pending) >= self.max_size:
+                self.pending.popleft()
+                self.dropped += 1
+                print(f"Write queue full, dropped oldest document ({self.dropped} so far)")
+            self.pending.append(document)
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Espera a fila esvaziar; retorna False se o tempo acabar antes."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+                self.writing = True
+            try:
+                self._write(batch)
+            except Exception as e:
+                # A thread de gravação não pode morrer: o lote é perdido
+                print(f"Dropped {len(batch)} documents for {self.name}: {e}")
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def _write(self, batch):
+        # O _id é atribuído antes da primeira tentativa, então repetir um lote
+        # depois de uma falha parcial não duplica documentos
+        for document in batch:
+            document.setdefault('_id', ObjectId())
+        backoff = 1.0
+        while True:
+            try:
+                rejected = write_isolating(self.write, batch)
+                break
+            except Exception as e:
+                print(f"Error saving to {self.name}: {e}; retrying in {backoff:.0f} s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+        for message in rejected[:5]:
+            print(f"Rejected by {self.name}: {message}")
+        if len(rejected) > 5:
+            print(f"... and {len(rejected) - 5} more rejections")
+        print(f"Saved {len(batch) - len(rejected)} of {len(batch)} documents to {self.name}.")
+
+class HttpReporter:
+    """
+    Envia documentos ao `POST /api/ingest` de um dashboard coletor, em
+    NDJSON (Extended JSON do bson, preservando datas, ObjectId e binários)
+    comprimido com gzip. Erros de rede, 5xx, 408 e 429 sobem como exceção
+    para a WriteBehindQueue repetir o lote; os demais 4xx descartam o lote,
+    que seria recusado de novo. Retorna as mensagens dos registros recusados.
+    """
+    RETRY_STATUS = (408, 429)
+
+    def __init__(self, url, agent_id=HOSTNAME, token=None, timeout=30):
+        self.url = url
+        self.agent_id = agent_id
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, documents, kind='results'):
+        body = '\n'.join(json_util.dumps(document) for document in documents).encode()
+        headers = {
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            'X-Agent-Id': self.agent_id,
+        }
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        response = self.session.post(
+            self.url, params={'kind': kind}, data=gzip.compress(body),
+            headers=headers, timeout=self.timeout,
+        )
+        if 400 <= response.status_code < 500 and response.status_code not in self.RETRY_STATUS:
+            return [f"batch of {len(documents)}: HTTP {response.status_code} {response.text[:200]}"]
+        response.raise_for_status()
+        return response.json().get('errors', [])
+
+class DatabaseHandler:
+    _shared = None
+    _shared_lock = Lock()
+
+    def __init__(self, db_name="network_analysis", collection_name="test_results",
+                 retention_days=RAW_RETENTION_DAYS, write_behind=False, ingest_url=INGEST_URL):
+        token = os.environ.get('NETWORK_ANALYZER_INGEST_TOKEN')
+        if ingest_url and not token:
+            # O coletor recusa lotes sem token, e a fila descartaria todos
+            raise ValueError("NETWORK_ANALYZER_INGEST_TOKEN is required with NETWORK_ANALYZER_INGEST_URL")
+        self.reporter = HttpReporter(ingest_url, token=token) if ingest_url else None
+        if self.reporter:
+            # Agente remoto: os documentos vão para o coletor (POST /api/ingest)
+            # e não há MongoDB local
+            self.client = self.db = self.collection = self.decisions = None
+            self.rollups = {}
+            self.write_results = self.reporter.send
+            self.write_decisions = lambda batch: self.reporter.send(batch, kind='trigger_decisions')
+            destination = ingest_url
+        else:
+            self.client = MongoClient("mongodb://localhost:27017/")
+            self.db = self.client[db_name]
+            self.collection = self.db[collection_name]
+            # Rollups por minuto e por hora, atualizados a cada inserção
+            self.rollups = {
+                granularity: self.db[f"{collection_name}_{granularity}"]
+                for granularity in ROLLUP_GRANULARITIES
+            }
+            try:
+                ensure_indexes(self.collection, retention_days)
+                for rollup in self.rollups.values():
+                    rollup.create_index([("bucket", 1), ("ssid", 1), ("host", 1)], unique=True)
+            except Exception as e:
+                print(f"Error creating indexes: {e}")
+            # Decisões do gatilho de mudança de regime (ver ChangeTrigger)
+            self.decisions = self.db[f"{collection_name}_trigger_decisions"]
+            self.write_results = self.insert_documents
+            self.write_decisions = lambda batch: insert_unordered(self.decisions, batch)
+            destination = collection_name
+        self.writer = WriteBehindQueue(
+            self.write_results, destination,
+            batch_size=int(os.environ.get('NETWORK_ANALYZER_WRITE_BATCH_SIZE', 100)),
+            max_size=int(os.environ.get('NETWORK_ANALYZER_WRITE_QUEUE_SIZE', 1000)),
+        ) if write_behind else None
+        self.decision_writer = WriteBehindQueue(
+            self.write_decisions, f"{destination} (trigger decisions)"
+        ) if write_behind else None
+
+    @classmethod
+    def shared(cls):
+        """
+        Handler único do processo, com gravação em segundo plano. Na saída,
+        espera a fila ser gravada (no máximo 10 s).
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(write_behind=True)
+                atexit.register(cls._shared.writer.flush, 10)
+                atexit.register(cls._shared.decision_writer.flush, 10)
+            return cls._shared
+
+    def save_results(self, data: Dict[str, Any]):
+        """Grava o documento canônico de um ciclo (na fila, se houver)."""
+        try:
+            data.setdefault('host', HOSTNAME)
+            to_numeric_document(data)
+            if self.writer:
+                self.writer.put(data)
+                return
+            data.setdefault('_id', ObjectId())
+            rejected = write_isolating(self.write_results, [data])
+            print(f"Results rejected: {rejected[0]}" if rejected else "Results saved.")
+        except Exception as e:
+            print(f"Error saving results: {e}")
+
+    def record_decision(self, decision: Dict[str, Any]):
+        """Grava uma decisão do gatilho de mudança de regime."""
+        try:
+            decision.setdefault('host', HOSTNAME)
+            if self.decision_writer:
+                self.decision_writer.put(decision)
+            else:
+                decision.setdefault('_id', ObjectId())
+                for message in write_isolating(self.write_decisions, [decision]):
+                    print(f"Trigger decision rejected: {message}")
+        except Exception as e:
+            print(f"Error saving trigger decision: {e}")
+
+    def insert_documents(self, documents):
+        """
+        Grava documentos com `_id` já atribuído: rollups e depois um
+        insert_many não ordenado. Os rollups vêm antes da inserção porque o
+        dashboard usa o último documento bruto como versão do seu cache de
+        respostas. Repetir o lote (depois de uma falha parcial, ou o mesmo
+        lote reenviado a outro processo do coletor) é seguro: cada bucket
+        guarda os `_id` já somados e o `_id` duplicado conta como gravado.
+        Um documento recusado na inserção (ex.: InvalidDocument) pode já ter
+        entrado nos rollups. Retorna as mensagens dos documentos recusados
+        pelo servidor.
+        """
+        self.update_rollups(documents)
+        return insert_unordered(self.collection, documents)
+
+    @staticmethod
+    def _rollup_key(document, truncate):
+        """Bucket, métricas e timestamp de um documento, ou None se não entra nos rollups."""
+        metrics = extract_metrics(document)
+        timestamp = as_datetime(document.get('timestamp'))
+        if not metrics or timestamp is None:
+            return None
+        key = {
+            'bucket': truncate(timestamp),
+            'ssid': (document.get('wifi_info') or {}).get('SSID'),
+            'host': document.get('host'),
+        }
+        return key, metrics, timestamp
+
+    def _rollup_operation(self, document, truncate, upsert=True):
+        """
+        Monta o upsert que acumula um documento em um bucket de rollup. O
+        filtro exclui buckets que já têm o `_id` em `applied`, então repetir
+        a operação não soma de novo: sem bucket que case, o upsert tenta
+        criar um e esbarra no índice único (ver update_rollups).
+        """
+        rollup_key = self._rollup_key(document, truncate)
+        if rollup_key is None:
+            return None
+        key, metrics, timestamp = rollup_key
+
+        sketch = DDSketch()
+        increments, minimums, maximums = {}, {}, {'last_timestamp': timestamp}
+        for metric, value in metrics.items():
+            prefix = f"metrics.{metric}"
+            store, bin_index = sketch.bin_of(value)
+            sketch_field = f"{prefix}.sketch.zero" if store == 'zero' else f"{prefix}.sketch.{store}.{bin_index}"
+            increments[f"{prefix}.count"] = 1
+            increments[f"{prefix}.sum"] = value
+            increments[sketch_field] = 1
+            minimums[f"{prefix}.min"] = value
+            maximums[f"{prefix}.max"] = value
+
+        return UpdateOne(
+            {**key, 'applied': {'$ne': document['_id']}},
+            {'$inc': increments, '$min': minimums, '$max': maximums, '$push': {'applied': document['_id']}},
+            upsert=upsert
+        )
+
+    def _latest_operation(self, document, truncate):
+        """
+        Atualiza os valores `last.*` do bucket só se o documento for o mais
+        recente dele, para que um documento fora de ordem (reconstrução,
+        reenvio) não sobrescreva uma leitura mais nova.
+        """
+        rollup_key = self._rollup_key(document, truncate)
+        if rollup_key is None:
+            return None
+        key, metrics, timestamp = rollup_key
+        return UpdateOne(
+            {**key, 'last_timestamp': {'$lte': timestamp}},
+            {'$set': {f"last.{metric}": value for metric, value in metrics.items()}}
+        )
+
+    def update_rollups(self, documents):
+        """
+        Acumula as métricas dos documentos nos rollups por minuto e por hora,
+        no máximo uma vez por documento em cada bucket, e depois atualiza os
+        valores mais recentes de cada bucket.
+        """
+        for granularity, truncate in ROLLUP_GRANULARITIES.items():
+            pending, upsert = documents, True
+            while pending:
+                batch = [(document, self._rollup_operation(document, truncate, upsert)) for document in pending]
+                batch = [(document, operation) for document, operation in batch if operation]
+                if not batch:
+                    break
+                try:
+                    self.rollups[granularity].bulk_write([operation for _, operation in batch], ordered=False)
+                    break
+                except BulkWriteError as e:
+                    errors = e.details.get('writeErrors', [])
+                    if is_transient(e) or not upsert or any(error.get('code') != 11000 for error in errors):
+                        raise
+                    # Chave duplicada: o bucket já tem o _id (nada a fazer) ou
+                    # foi criado por um upsert concorrente; repetir sem upsert
+                    # soma só no segundo caso
+                    pending, upsert = [batch[error['index']][0] for error in errors], False
+
+            # Depois do $max em last_timestamp: só o documento mais recente de
+            # cada bucket casa com o filtro
+            latest = [self._latest_operation(document, truncate) for document in documents]
+            latest = [operation for operation in latest if operation]
+            if latest:
+                self.rollups[granularity].bulk_write(latest, ordered=False)
+
+    def rebuild_rollups(self, batch_size=500):
+        """
+        Reconstrói os rollups a partir do histórico bruto. Documentos no
+        formato do dashboard (com `bandwidth_data`) duplicam as medições do
+        documento principal do ciclo e são ignorados.
+        """
+        for rollup in self.rollups.values():
+            rollup.delete_many({})
+
+        projection = {section: 1 for section in ('timestamp', 'host', 'wifi_info', 'bandwidth_data')}
+        projection.update({path.rsplit('.', 1)[0]: 1 for path in METRIC_FIELDS.values()})
+        last_id = None
+        processed = 0
+
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = list(self.collection.find(query, projection, sort=[('_id', 1)], limit=batch_size))
+            if not batch:
+                break
+
+            self.update_rollups([document for document in batch if 'bandwidth_data' not in document])
+
+            last_id = batch[-1]['_id']
+            processed += len(batch)
+            print(f"Rolled up {processed} documents")
+
+        print(f"Rollup rebuild finished: {processed} documents processed.")
+        return processed
+
+    def remove_dashboard_copies(self):
+        """
+        Remove os documentos no formato do dashboard (com `bandwidth_data`)
+        gravados por versões antigas ao lado do documento principal de cada
+        ciclo; o formato do dashboard agora é montado na leitura.
+        """
+        result = self.collection.delete_many({'bandwidth_data': {'$exists': True}})
+        print(f"Removed {result.deleted_count} dashboard copies.")
+        return result.deleted_count
+
+    def migrate_numeric_schema(self, batch_size=500):
+        """
+        Reescreve, em lotes, os documentos gravados com medições e timestamps
+        em texto para o esquema atual. Documentos já migrados ficam de fora da
+        consulta, então a migração pode ser interrompida e retomada.
+        """
+        sections = sorted({path.split('.')[0] for path in FIELD_UNITS} | {'timestamp'})
+        query = {'schema_version': {'$ne': SCHEMA_VERSION}}
+        last_id = None
+        migrated = 0
+
+        while True:
+            batch_query = dict(query)
+            if last_id is not None:
+                batch_query['_id'] = {'$gt': last_id}
+            batch = list(self.collection.find(
+                batch_query, {section: 1 for section in sections},
+                sort=[('_id', 1)], limit=batch_size
+            ))
+            if not batch:
+                break
+
+            operations = []
+            for document in batch:
+                converted = to_numeric_document(document)
+                updates = {key: converted[key] for key in sections if key in converted}
+                updates['schema_version'] = converted['schema_version']
+                updates['units'] = converted['units']
+                operations.append(UpdateOne({'_id': document['_id']}, {'$set': updates}))
+
+            self.collection.bulk_write(operations, ordered=False)
+            last_id = batch[-1]['_id']
+            migrated += len(batch)
+            print(f"Migrated {migrated} documents (last _id: {last_id})")
+
+        print(f"Schema migration finished: {migrated} documents updated.")
+        return migrated